@@ -5,7 +5,10 @@
 from odoo import api, fields, models, _
 from odoo.exceptions import UserError
 from dateutil.relativedelta import relativedelta
+from odoo.tools import split_every
 from odoo.tools.misc import format_date
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 logger = logging.getLogger(__name__)
 
@@ -34,38 +37,253 @@ class AccountBalanceRest(models.TransientModel):
         'account.journal', required=True,
         domain="[('company_id', '=', company_id), ('type', '=', 'general')]")
     ref = fields.Char(string="Reference")
+    split_mode = fields.Selection([
+        ('none', 'Single Journal Entry'),
+        ('account', 'One Journal Entry per Account'),
+        ('lines', 'Split by Number of Lines'),
+        ], default='none', required=True, string='Split',
+        help="For very large trial balances, the reset can be split in several "
+        "journal entries, each one balanced against the transition account.")
+    lines_per_move = fields.Integer(default=1000, string='Lines per Journal Entry')
+    transition_account_id = fields.Many2one(
+        'account.account',
+        domain="[('company_id', '=', company_id), ('deprecated', '=', False)]")
+    balance_sql = fields.Boolean(
+        string='Compute Balances in SQL',
+        help="Compute the trial balance with a direct SQL aggregation "
+        "instead of the ORM read_group.")
 
     def run(self):
         self.ensure_one()
-        company_id = self.company_id.id
-        ccur = self.company_id.currency_id
-        amo = self.env['account.move']
-        amlo = self.env['account.move.line']
-        domain = [
-            ('company_id', '=', company_id),
-            ('date', '<=', self.date),
-        ]
-        draft_count = amo.search_count(domain + [('state', '=', 'draft')])
+        if self.split_mode != 'none':
+            if not self.transition_account_id:
+                raise UserError(_(
+                    "You must select a transition account to split the reset."))
+            if self.split_mode == 'lines' and self.lines_per_move < 2:
+                raise UserError(_(
+                    "The number of lines per journal entry must be at least 2."))
+        self._check_draft_moves(self.company_id, self.date)
+        if self.balance_sql:
+            balances = self._get_balances_sql(self.company_id, self.date)
+        else:
+            balances = self._get_balances(self.company_id, self.date)
+        moves = self._generate_reset_moves(
+            self.company_id, self.date, self.journal_id, balances, ref=self.ref,
+            split_mode=self.split_mode, lines_per_move=self.lines_per_move,
+            transition_account=self.transition_account_id)
+        self._reconcile_after_reset(moves)
+        action = self.env["ir.actions.actions"]._for_xml_id(
+            "account.action_move_journal_line")
+        if len(moves) == 1:
+            action.update({
+                'view_mode': 'form,tree',
+                'res_id': moves.id,
+                'view_id': False,
+                'views': False,
+            })
+        else:
+            action['domain'] = [('id', 'in', moves.ids)]
+        return action
+
+    @api.model
+    def _check_draft_moves(self, company, date):
+        draft_count = self.env['account.move'].search_count([
+            ('company_id', '=', company.id),
+            ('date', '<=', date),
+            ('state', '=', 'draft'),
+            ])
         if draft_count:
             raise UserError(_(
-                "There are %d draft journal entries dated before %s.") % (
-                    draft_count, format_date(self.env, self.date)))
-        domain += [('parent_state', '=', 'posted'), ('display_type', '=', False)]
-        rg_res = amlo.read_group(
+                "There are %d draft journal entries dated before %s in company '%s'.") % (
+                    draft_count, format_date(self.env, date), company.display_name))
+
+    # Return a list of (account_id, partner_id, balance)
+    @api.model
+    def _get_balances(self, company, date):
+        domain = [
+            ('company_id', '=', company.id),
+            ('date', '<=', date),
+            ('parent_state', '=', 'posted'),
+            ('display_type', '=', False),
+        ]
+        rg_res = self.env['account.move.line'].read_group(
             domain,
             ['account_id', 'partner_id', 'balance'],
             ['account_id', 'partner_id'], lazy=False)
-        vals = {
-            'date': self.date,
-            'company_id': company_id,
-            'journal_id': self.journal_id.id,
-            'ref': self.ref,
-            'line_ids': [],
-        }
+        balances = []
         for res in rg_res:
-            account_id = res['account_id'][0]
-            partner_id = res['partner_id'] and res['partner_id'][0] or False
-            balance = ccur.round(res['balance'])
+            balances.append((
+                res['account_id'][0],
+                res['partner_id'] and res['partner_id'][0] or False,
+                res['balance']))
+        return balances
+
+    # Same as _get_balances(), but with a direct SQL aggregation,
+    # which avoids the overhead of read_group on very large trial balances
+    @api.model
+    def _get_balances_sql(self, company, date):
+        self.env['account.move.line'].flush()
+        self._cr.execute("""
+            SELECT account_id, partner_id, SUM(balance)
+            FROM account_move_line
+            WHERE company_id = %s
+            AND date <= %s
+            AND parent_state = 'posted'
+            AND display_type IS NULL
+            GROUP BY account_id, partner_id
+            """, (company.id, date))
+        return [
+            (account_id, partner_id or False, balance)
+            for (account_id, partner_id, balance) in self._cr.fetchall()]
+
+    # Batch mode, to reset the trial balance of many companies at once
+    # company2date: {company_id: reset date}
+    # The trial balances of all the companies are computed with a single
+    # grouped query partitioned by company, then the reset moves of each
+    # company are created/posted/reconciled. With workers > 1, the companies
+    # are processed in parallel, each one in its own transaction (committed
+    # when the company is done). An error on a company doesn't stop the
+    # other companies: it is rolled back and reported in the result.
+    # Return {company_id: {'move_ids': move IDs, 'error': error message or False}}
+    @api.model
+    def _batch_run(
+            self, company2date, ref=False, split_mode='none', lines_per_move=1000,
+            transition_account_code=False, workers=0):
+        companies = self.env['res.company'].browse(list(company2date))
+        company2journal = {}
+        for journal in self.env['account.journal'].search([
+                ('company_id', 'in', companies.ids),
+                ('type', '=', 'general'),
+                ], order='sequence, id'):
+            company2journal.setdefault(journal.company_id.id, journal.id)
+        company2transition = {}
+        if split_mode != 'none':
+            if not transition_account_code:
+                raise UserError(_(
+                    "You must give the code of the transition account to split the reset."))
+            for account in self.env['account.account'].search([
+                    ('company_id', 'in', companies.ids),
+                    ('code', '=', transition_account_code),
+                    ]):
+                company2transition[account.company_id.id] = account.id
+        for company in companies:
+            if company.id not in company2journal:
+                raise UserError(_(
+                    "There is no general journal in company '%s'.") % company.display_name)
+            if split_mode != 'none' and company.id not in company2transition:
+                raise UserError(_(
+                    "There is no account with code '%s' in company '%s'.") % (
+                        transition_account_code, company.display_name))
+            self._check_draft_moves(company, company2date[company.id])
+        company2balances = self._get_balances_multi_company(company2date)
+        jobs = []
+        for company in companies:
+            jobs.append({
+                'company_id': company.id,
+                'date': company2date[company.id],
+                'journal_id': company2journal[company.id],
+                'transition_account_id': company2transition.get(company.id, False),
+                'balances': company2balances.get(company.id, []),
+                'ref': ref,
+                'split_mode': split_mode,
+                'lines_per_move': lines_per_move,
+                })
+        res = {}
+        if workers and workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    executor.submit(self._batch_run_company_new_cursor, job): job['company_id']
+                    for job in jobs}
+                for future in as_completed(futures):
+                    res[futures[future]] = future.result()
+        else:
+            for job in jobs:
+                try:
+                    with self.env.cr.savepoint():
+                        res[job['company_id']] = {
+                            'move_ids': self._batch_run_company(job),
+                            'error': False,
+                            }
+                except Exception as e:
+                    res[job['company_id']] = self._batch_run_company_error(job, e)
+        failed = [company_id for company_id, company_res in res.items() if company_res['error']]
+        if failed:
+            logger.warning(
+                'Trial balance reset failed for %d/%d companies (IDs %s)',
+                len(failed), len(res), failed)
+        return res
+
+    @api.model
+    def _batch_run_company(self, job):
+        company = self.env['res.company'].browse(job['company_id'])
+        moves = self._generate_reset_moves(
+            company, job['date'], self.env['account.journal'].browse(job['journal_id']),
+            job['balances'], ref=job['ref'], split_mode=job['split_mode'],
+            lines_per_move=job['lines_per_move'],
+            transition_account=self.env['account.account'].browse(job['transition_account_id']))
+        self._reconcile_after_reset(moves)
+        logger.info(
+            'Trial balance of company %s reset with %d journal entries',
+            company.display_name, len(moves))
+        return moves.ids
+
+    # Run in a thread of the ThreadPoolExecutor of _batch_run()
+    @api.model
+    def _batch_run_company_new_cursor(self, job):
+        with api.Environment.manage():
+            try:
+                with self.pool.cursor() as new_cr:
+                    new_env = api.Environment(new_cr, self.env.uid, dict(
+                        self.env.context, allowed_company_ids=[job['company_id']]))
+                    return {
+                        'move_ids': new_env[self._name]._batch_run_company(job),
+                        'error': False,
+                        }
+            except Exception as e:
+                # the cursor has been rolled back when leaving the with block
+                return self._batch_run_company_error(job, e)
+
+    @api.model
+    def _batch_run_company_error(self, job, error):
+        logger.exception(
+            'Failed to reset the trial balance of company ID %d', job['company_id'])
+        return {'move_ids': [], 'error': str(error)}
+
+    # Return {company_id: [(account_id, partner_id, balance)]}
+    @api.model
+    def _get_balances_multi_company(self, company2date):
+        if not company2date:
+            return {}
+        self.env['account.move.line'].flush()
+        values_sql = ', '.join(['(%s, %s::date)'] * len(company2date))
+        params = []
+        for company_id, date in company2date.items():
+            params += [company_id, date]
+        self._cr.execute("""
+            SELECT aml.company_id, aml.account_id, aml.partner_id, SUM(aml.balance)
+            FROM account_move_line aml
+            JOIN (VALUES %s) AS cut (company_id, date)
+            ON cut.company_id = aml.company_id AND aml.date <= cut.date
+            WHERE aml.parent_state = 'posted'
+            AND aml.display_type IS NULL
+            GROUP BY aml.company_id, aml.account_id, aml.partner_id
+            """ % values_sql, params)
+        res = defaultdict(list)
+        for company_id, account_id, partner_id, balance in self._cr.fetchall():
+            res[company_id].append((account_id, partner_id or False, balance))
+        return res
+
+    # split_mode: 'none' (a single move), 'account' (one move per account)
+    # or 'lines' (one move per lines_per_move lines)
+    # When the reset is split, each move is balanced against transition_account
+    @api.model
+    def _generate_reset_moves(
+            self, company, date, journal, balances, ref=False, split_mode='none',
+            lines_per_move=1000, transition_account=False, moves_per_batch=20):
+        ccur = company.currency_id
+        line_vals_list = []
+        for account_id, partner_id, balance in balances:
+            balance = ccur.round(balance)
             fc = ccur.compare_amounts(balance, 0)
             if not fc:
                 continue
@@ -75,47 +293,105 @@ class AccountBalanceRest(models.TransientModel):
             else:
                 credit = 0
                 debit = balance * -1
-            vals['line_ids'].append((0, 0, {
+            line_vals_list.append({
                 'partner_id': partner_id,
                 'account_id': account_id,
                 'debit': debit,
                 'credit': credit,
-            }))
-        move = self.env['account.move'].create(vals)
-        move._post(soft=False)
-        # reconciliation strategy:
-        # we decided that we don't want to delete existing reconcilication
-        # accross self.date
-        # so we just reconcile what we can easily reconcile,
-        # and nothing else
-        for line in move.line_ids:
-            if not line.account_id.reconcile:
-                continue
-            rec_domain = [
-                ('account_id', '=', line.account_id.id),
-                ('partner_id', '=', line.partner_id.id or False),
-                ('full_reconcile_id', '=', False),
-                ('date', '<=', self.date),
-                ('company_id', '=', company_id),
-            ]
-            rec_rg = amlo.read_group(
-                rec_domain, ['account_id', 'balance'], ['account_id'])
-            # There is always at least the line of the move we juste created
-            balance = rec_rg[0]['balance']
-            if ccur.is_zero(balance):
-                lines = amlo.search(rec_domain)
-                lines.reconcile()
-                logger.info(
-                    'Reconciled %d lines for account %s partner %s',
-                    len(lines), line.account_id.code,
-                    line.partner_id.display_name or False)
+            })
+        if split_mode == 'account':
+            account2lines = defaultdict(list)
+            for line_vals in line_vals_list:
+                account2lines[line_vals['account_id']].append(line_vals)
+            groups = list(account2lines.values())
+        elif split_mode == 'lines':
+            # keep a line for the counterpart on the transition account
+            groups = list(split_every(lines_per_move - 1, line_vals_list, list))
+        else:
+            groups = [line_vals_list]
+        move_vals_list = []
+        for group in groups:
+            if split_mode != 'none':
+                diff = ccur.round(sum([lv['debit'] - lv['credit'] for lv in group]))
+                fc = ccur.compare_amounts(diff, 0)
+                if fc:
+                    group = group + [{
+                        'account_id': transition_account.id,
+                        'debit': fc < 0 and -diff or 0,
+                        'credit': fc > 0 and diff or 0,
+                    }]
+            move_vals_list.append({
+                'date': date,
+                'company_id': company.id,
+                'journal_id': journal.id,
+                'ref': ref,
+                'line_ids': [(0, 0, line_vals) for line_vals in group],
+            })
+        move_ids = []
+        for batch in split_every(moves_per_batch, move_vals_list, list):
+            moves = self.env['account.move'].create(batch)
+            moves._post(soft=False)
+            move_ids += moves.ids
+            logger.info(
+                'Company %s: %d/%d reset journal entries created and posted',
+                company.display_name, len(move_ids), len(move_vals_list))
+        return self.env['account.move'].browse(move_ids)
 
-        action = self.env["ir.actions.actions"]._for_xml_id(
-            "account.action_move_journal_line")
-        action.update({
-            'view_mode': 'form,tree',
-            'res_id': move.id,
-            'view_id': False,
-            'views': False,
-        })
-        return action
+    # reconciliation strategy:
+    # we decided that we don't want to delete existing reconcilication
+    # accross the reset date
+    # so we just reconcile what we can easily reconcile,
+    # and nothing else
+    # The balances of the unreconciled lines of all the (account, partner)
+    # pairs are computed with a single grouped query, then the lines of
+    # the balanced pairs are fetched with a single search
+    @api.model
+    def _reconcile_after_reset(self, moves, chunk_size=500):
+        if not moves:
+            return
+        company = moves[0].company_id
+        date = moves[0].date
+        ccur = company.currency_id
+        amlo = self.env['account.move.line']
+        pairs = set()
+        for line in moves.line_ids:
+            if line.account_id.reconcile:
+                pairs.add((line.account_id.id, line.partner_id.id or False))
+        if not pairs:
+            return
+        rec_domain = [
+            ('account_id', 'in', list({pair[0] for pair in pairs})),
+            ('full_reconcile_id', '=', False),
+            ('date', '<=', date),
+            ('company_id', '=', company.id),
+        ]
+        rec_rg = amlo.read_group(
+            rec_domain, ['account_id', 'partner_id', 'balance'],
+            ['account_id', 'partner_id'], lazy=False)
+        balanced_pairs = set()
+        for res in rec_rg:
+            pair = (res['account_id'][0], res['partner_id'] and res['partner_id'][0] or False)
+            # There is always at least the line of the move we juste created
+            if pair in pairs and ccur.is_zero(res['balance']):
+                balanced_pairs.add(pair)
+        logger.info(
+            '%d (account, partner) pairs to reconcile out of %d',
+            len(balanced_pairs), len(pairs))
+        if not balanced_pairs:
+            return
+        pair2line_ids = defaultdict(list)
+        lines = amlo.search_read(rec_domain + [
+            ('account_id', 'in', list({pair[0] for pair in balanced_pairs})),
+            ('partner_id', 'in', list({pair[1] for pair in balanced_pairs})),
+            ], ['account_id', 'partner_id'], load=None)
+        for line in lines:
+            pair = (line['account_id'], line['partner_id'] or False)
+            if pair in balanced_pairs:
+                pair2line_ids[pair].append(line['id'])
+        done = 0
+        for chunk in split_every(chunk_size, list(pair2line_ids.items())):
+            for pair, line_ids in chunk:
+                amlo.browse(line_ids).reconcile()
+            done += len(chunk)
+            logger.info(
+                'Reconciled %d/%d (account, partner) pairs', done, len(pair2line_ids))
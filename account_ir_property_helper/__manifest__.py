@@ -17,6 +17,8 @@ Adds a wizard to easily set default ir.property for:
 * payable/receivable accounts on partners
 * income/expense accounts on product categories
 
+It also adds a wizard to set any default company property (payment terms, fiscal positions, stock valuation accounts, etc.) on several companies from a CSV mapping file, with a preview of the changes.
+
 I developped this module for a project with many companies where the accountant needed to be autonomous to setup new companies by himself.
 
     """,
@@ -26,6 +28,7 @@ I developped this module for a project with many companies where the accountant
     "data": [
         "security/ir.model.access.csv",
         "wizards/account_default_ir_property_view.xml",
+        "wizards/account_default_ir_property_mapping_view.xml",
     ],
     "installable": True,
 }
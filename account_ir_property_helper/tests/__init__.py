@@ -0,0 +1 @@
+from . import test_account_default_ir_property_mapping
@@ -0,0 +1,64 @@
+# Copyright 2023 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import base64
+
+from odoo.tests.common import TransactionCase
+
+
+class TestAccountDefaultIrPropertyMapping(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.env = cls.env(context=dict(cls.env.context, tracking_disable=True))
+        cls.company = cls.env.company
+        cls.company2 = cls.env['res.company'].create({'name': 'Test Mapping Company'})
+        cls.fiscal_position = cls.env['account.fiscal.position'].create({
+            'name': 'Test Mapping <FP>',
+            'company_id': cls.company.id,
+            })
+        cls.payment_term = cls.env.ref('account.account_payment_term_30days')
+        # company-dependent boolean field
+        cls.env['ir.model.fields'].create({
+            'model_id': cls.env['ir.model']._get_id('res.partner'),
+            'name': 'x_test_mapping_flag',
+            'field_description': 'Test Mapping Flag',
+            'ttype': 'boolean',
+            'company_dependent': True,
+            })
+
+    def _run_mapping(self, content):
+        wizard = self.env['account.default.ir.property.mapping'].create({
+            'company_ids': [(6, 0, self.company.ids)],
+            'mapping_file': base64.b64encode(content.encode('utf-8')),
+            'mapping_filename': 'mapping.csv',
+            })
+        wizard.preview_mapping()
+        preview = wizard.preview
+        action = wizard.run()
+        return preview, action['domain'][0][2]
+
+    def test_mapping(self):
+        content = (
+            'model,field,company,value\n'
+            'res.partner,property_account_position_id,,Test Mapping <FP>\n'
+            'res.partner,x_test_mapping_flag,,false\n'
+            'res.partner,property_payment_term_id,Test Mapping Company,'
+            'account.account_payment_term_30days\n')
+        preview, property_ids = self._run_mapping(content)
+        self.assertEqual(len(property_ids), 3)
+        # the values are escaped and the many2one are displayed with their name
+        self.assertIn('Test Mapping &lt;FP&gt;', preview)
+        self.assertNotIn('<FP>', preview)
+        self.assertIn(self.payment_term.display_name, preview)
+        partner = self.env['res.partner'].create({'name': 'Test Mapping Partner'})
+        self.assertEqual(partner.property_account_position_id, self.fiscal_position)
+        self.assertIs(partner.x_test_mapping_flag, False)
+        self.assertEqual(
+            partner.with_company(self.company2).property_payment_term_id, self.payment_term)
+        # second run: nothing is written
+        preview, property_ids = self._run_mapping(content)
+        self.assertFalse(property_ids)
+        self.assertIn('No change', preview)
@@ -1 +1,2 @@
 from . import account_default_ir_property
+from . import account_default_ir_property_mapping
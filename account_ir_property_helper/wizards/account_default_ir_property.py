@@ -2,8 +2,9 @@
 # @author: Alexis de Lattre <alexis.delattre@akretion.com>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from odoo import api, fields, models
-# from odoo.exceptions import UserError
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+from collections import defaultdict
 import logging
 
 logger = logging.getLogger(__name__)
@@ -57,72 +58,150 @@ class AccountDefaultIrProperty(models.TransientModel):
     product_categ_expense_account_property_id = fields.Many2one(
         'ir.property', readonly=True)
 
+    company_ids = fields.Many2many(
+        'res.company', string='Other Companies',
+        help="Also set these default properties on these companies, using "
+        "the accounts that have the same codes in each company.")
+
     @api.model
-    def _get_field_id(self, field_dict):
-        assert field_dict
+    def _get_field_ids(self):
+        # Return {wizard_field: field_id} with a single query
         imfo = self.env['ir.model.fields']
-        field = imfo.search([
-            ('name', '=', field_dict['field']),
+        fields_res = imfo.search_read([
+            ('name', 'in', [fd['field'] for fd in WIZARD2FIELD.values()]),
+            ('model', 'in', list({fd['model'] for fd in WIZARD2FIELD.values()})),
             ('ttype', '=', 'many2one'),
             ('relation', '=', 'account.account'),
-            ('model', '=', field_dict['model']),
-            ])
-        assert len(field) == 1
-        return field.id
+            ], ['model', 'name'])
+        model_field2id = {(field['model'], field['name']): field['id'] for field in fields_res}
+        res = {}
+        for wizard_field, field_dict in WIZARD2FIELD.items():
+            res[wizard_field] = model_field2id[(field_dict['model'], field_dict['field'])]
+        return res
 
     @api.model
     def default_get(self, fields_list):
         res = super().default_get(fields_list)
         company_id = self.env.company.id
         res['company_id'] = company_id
-        ipo = self.env['ir.property']
-        for wizard_field, field_dict in WIZARD2FIELD.items():
-
-            ir_property = ipo.search([
-                ('company_id', '=', company_id),
-                ('type', '=', 'many2one'),
-                ('res_id', '=', False),
-                ('fields_id', '=', self._get_field_id(field_dict)),
-                ], limit=1)
-            if ir_property:
-                res[wizard_field.replace('_id', '_property_id')] = ir_property.id
-                if ir_property.value_reference:
-                    account_id = int(ir_property.value_reference.split(',')[1])
-                    res[wizard_field] = account_id
+        field_ids = self._get_field_ids()
+        field_id2wizard_field = {field_id: wizard_field for (wizard_field, field_id) in field_ids.items()}
+        ir_properties = self.env['ir.property'].search([
+            ('company_id', '=', company_id),
+            ('type', '=', 'many2one'),
+            ('res_id', '=', False),
+            ('fields_id', 'in', list(field_ids.values())),
+            ])
+        for ir_property in ir_properties:
+            wizard_field = field_id2wizard_field[ir_property.fields_id.id]
+            res[wizard_field.replace('_id', '_property_id')] = ir_property.id
+            if ir_property.value_reference:
+                account_id = int(ir_property.value_reference.split(',')[1])
+                res[wizard_field] = account_id
         return res
 
     def run(self):
         self.ensure_one()
-        ipo = self.env['ir.property']
-        company_id = self.company_id.id
-        property_ids = []
-        for wizard_field, field_dict in WIZARD2FIELD.items():
-            field_id = self._get_field_id(field_dict)
-            if self['del_existing_property_%s' % field_dict['model'].replace('.', '_')]:
-                properties = ipo.search([
-                    ('company_id', '=', company_id),
-                    ('type', '=', 'many2one'),
-                    ('fields_id', '=', field_id),
-                    ('res_id', '!=', False),
-                    ])
-                logger.info('Deleted %d ir.properties %s', len(properties), wizard_field)
-                properties.sudo().unlink()
-            prop_field_name = wizard_field.replace('_id', '_property_id')
-            value_reference = 'account.account,%d' % self[wizard_field].id
-            if self[prop_field_name]:
-                self[prop_field_name].write({'value_reference': value_reference})
-                property_ids.append(self[prop_field_name].id)
-            else:
-                vals = {
-                    'company_id': company_id,
-                    'name': field_dict['field'],
-                    'fields_id': field_id,
+        field_ids = self._get_field_ids()
+        companies = self.company_id | self.company_ids
+        del_field_ids = [
+            field_ids[wizard_field]
+            for wizard_field, field_dict in WIZARD2FIELD.items()
+            if self['del_existing_property_%s' % field_dict['model'].replace('.', '_')]]
+        if del_field_ids:
+            self._delete_specific_properties(companies.ids, del_field_ids)
+        # For the other companies, we use the accounts with the same code
+        company_code2account_id = {}
+        if self.company_ids:
+            codes = [self[wizard_field].code for wizard_field in WIZARD2FIELD]
+            for account in self.env['account.account'].search_read([
+                    ('company_id', 'in', self.company_ids.ids),
+                    ('code', 'in', codes),
+                    ], ['company_id', 'code'], load=None):
+                company_code2account_id[(account['company_id'], account['code'])] = account['id']
+        key2vals = {}  # {(company_id, field_id): vals of the ir.property}
+        for company in companies:
+            for wizard_field in WIZARD2FIELD:
+                account = self[wizard_field]
+                if company == self.company_id:
+                    account_id = account.id
+                else:
+                    account_id = company_code2account_id.get((company.id, account.code))
+                    if not account_id:
+                        raise UserError(_(
+                            "There is no account with code '%s' in company '%s'.")
+                            % (account.code, company.display_name))
+                key2vals[(company.id, field_ids[wizard_field])] = {
                     'type': 'many2one',
-                    'res_id': False,
-                    'value_reference': value_reference,
+                    'value_reference': 'account.account,%d' % account_id,
                     }
-                new_prop = ipo.create(vals)
-                property_ids.append(new_prop.id)
+        property_ids = self._set_default_properties(key2vals)
         action = self.env["ir.actions.actions"]._for_xml_id("base.ir_property_form")
         action['domain'] = [('id', 'in', property_ids)]
         return action
+
+    @api.model
+    def _delete_specific_properties(self, company_ids, field_ids):
+        # Single set-based delete, without loading the properties in Python
+        self.env['ir.property'].flush_model()
+        self._cr.execute("""
+            DELETE FROM ir_property
+            WHERE company_id IN %s
+            AND fields_id IN %s
+            AND type = 'many2one'
+            AND res_id IS NOT NULL
+            """, (tuple(company_ids), tuple(field_ids)))
+        logger.info(
+            'Deleted %d specific ir.properties for fields IDs %s',
+            self._cr.rowcount, field_ids)
+        # the company-dependent fields (property_account_receivable_id
+        # on res.partner...) are cached on their own models
+        self.env.invalidate_all()
+        self.env['ir.property'].clear_caches()
+
+    # key2vals is a dict {(company_id, field_id): vals of the default ir.property}
+    # Existing default properties are written (one write per distinct vals),
+    # the missing ones are created with a single create()
+    # sudo() because the companies may not be in the allowed companies of
+    # the user: the multi-company record rules would hide their properties
+    # Return the IDs of the properties
+    @api.model
+    def _set_default_properties(self, key2vals):
+        ipo = self.env['ir.property'].sudo()
+        if not key2vals:
+            return []
+        company_ids = list({key[0] for key in key2vals})
+        field_ids = list({key[1] for key in key2vals})
+        existing = {}
+        for prop in ipo.search([
+                ('company_id', 'in', company_ids),
+                ('fields_id', 'in', field_ids),
+                ('res_id', '=', False),
+                ]):
+            existing[(prop.company_id.id, prop.fields_id.id)] = prop
+        field_id2name = {
+            field.id: field.name
+            for field in self.env['ir.model.fields'].browse(field_ids)}
+        vals2props = defaultdict(lambda: ipo)
+        key2vals_str = {}
+        create_vals_list = []
+        for (company_id, field_id), vals in key2vals.items():
+            prop = existing.get((company_id, field_id))
+            if prop:
+                vals_str = repr(sorted(vals.items()))
+                key2vals_str[vals_str] = vals
+                vals2props[vals_str] |= prop
+            else:
+                create_vals_list.append(dict(
+                    vals, company_id=company_id, fields_id=field_id,
+                    name=field_id2name[field_id], res_id=False))
+        property_ids = []
+        for vals_str, props in vals2props.items():
+            props.write(key2vals_str[vals_str])
+            property_ids += props.ids
+        if create_vals_list:
+            property_ids += ipo.create(create_vals_list).ids
+        logger.info(
+            'Default properties: %d updated, %d created',
+            len(property_ids) - len(create_vals_list), len(create_vals_list))
+        return property_ids
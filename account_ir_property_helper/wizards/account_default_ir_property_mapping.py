@@ -0,0 +1,237 @@
+# Copyright 2022 Akretion France
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import api, fields, models, _
+from odoo.exceptions import UserError
+from odoo.tools import html_escape
+from odoo.addons.base.models.ir_property import TYPE2FIELD
+from collections import defaultdict
+import base64
+import csv
+import io
+import logging
+
+logger = logging.getLogger(__name__)
+
+TRUE_VALUES = ('1', 'true', 'yes', 'y', 'x')
+
+
+class AccountDefaultIrPropertyMapping(models.TransientModel):
+    _name = "account.default.ir.property.mapping"
+    _description = "Set default ir.property from a mapping file"
+
+    company_ids = fields.Many2many(
+        'res.company', string='Companies', required=True,
+        default=lambda self: self.env.company,
+        help="Companies used for the lines of the mapping file that have "
+        "an empty 'company' column.")
+    mapping_file = fields.Binary(string='Mapping File', required=True)
+    mapping_filename = fields.Char()
+    preview = fields.Html(readonly=True)
+
+    # The mapping file is a CSV file with the columns:
+    # - model: technical name of the model, ex: res.partner
+    # - field: technical name of the company-dependent field,
+    #   ex: property_payment_term_id
+    # - company: ID or name of the company (optional)
+    # - value: for a many2one field, the value can be an XMLID, 'model,ID',
+    #   the code of the account (for accounts) or the exact name of
+    #   the related record. For the other fields, the raw value.
+    def _parse_mapping_file(self):
+        self.ensure_one()
+        content = base64.b64decode(self.mapping_file).decode('utf-8-sig')
+        reader = csv.DictReader(io.StringIO(content))
+        missing_cols = {'model', 'field', 'value'} - set(reader.fieldnames or [])
+        if missing_cols:
+            raise UserError(_(
+                "The mapping file doesn't have the column(s) %s.")
+                % ', '.join(sorted(missing_cols)))
+        rows = []
+        for line, row in enumerate(reader, start=2):
+            row = {key: (value or '').strip() for (key, value) in row.items() if key}
+            if row['model'] and row['field']:
+                row['line'] = line
+                rows.append(row)
+        return rows
+
+    # Return {(company_id, field_id): (field dict, value)}
+    # Errors are aggregated and raised in a single UserError
+    def _prepare_property_mapping(self, rows):
+        self.ensure_one()
+        errors = []
+        model_field2field = {}
+        for field in self.env['ir.model.fields'].search_read([
+                ('model', 'in', list({row['model'] for row in rows})),
+                ('name', 'in', list({row['field'] for row in rows})),
+                ('company_dependent', '=', True),
+                ], ['model', 'name', 'ttype', 'relation']):
+            model_field2field[(field['model'], field['name'])] = field
+        companies = self.env['res.company'].search_read([], ['name'])
+        company_key2id = {}
+        for company in companies:
+            company_key2id[str(company['id'])] = company['id']
+            company_key2id[company['name']] = company['id']
+        value_cache = {}
+        key2value = {}
+        for row in rows:
+            field = model_field2field.get((row['model'], row['field']))
+            if not field:
+                errors.append(_(
+                    "Line %s: %s is not a company-dependent field of model %s.")
+                    % (row['line'], row['field'], row['model']))
+                continue
+            if row.get('company'):
+                if row['company'] not in company_key2id:
+                    errors.append(_("Line %s: company '%s' not found.") % (row['line'], row['company']))
+                    continue
+                company_ids = [company_key2id[row['company']]]
+            else:
+                company_ids = self.company_ids.ids
+            for company_id in company_ids:
+                cache_key = (field['id'], company_id, row['value'])
+                if cache_key not in value_cache:
+                    value_cache[cache_key] = self._convert_property_value(
+                        field, row['value'], company_id)
+                value, error = value_cache[cache_key]
+                if error:
+                    errors.append(_("Line %s: %s") % (row['line'], error))
+                    continue
+                key2value[(company_id, field['id'])] = (field, value)
+        if errors:
+            raise UserError('\n'.join(errors))
+        return key2value
+
+    @api.model
+    def _prepare_property_vals(self, field, value):
+        if field['ttype'] == 'many2one':
+            return {
+                'type': 'many2one',
+                'value_reference': value and '%s,%d' % (field['relation'], value) or False,
+                }
+        # The typed column is written directly: ir.property ignores
+        # a falsy 'value' key, so False/0/0.0 would keep the old value
+        ptype = field['ttype'] == 'monetary' and 'float' or field['ttype']
+        if ptype not in TYPE2FIELD:
+            raise UserError(_(
+                "Fields of type %s are not supported.") % field['ttype'])
+        if ptype in ('boolean', 'integer'):
+            value = int(value or 0)
+        elif ptype == 'float':
+            value = float(value or 0)
+        return {'type': ptype, TYPE2FIELD[ptype]: value}
+
+    # Return (value, error)
+    @api.model
+    def _convert_property_value(self, field, raw_value, company_id):
+        if not raw_value:
+            return False, None
+        ttype = field['ttype']
+        try:
+            if ttype == 'integer':
+                return int(raw_value), None
+            elif ttype in ('float', 'monetary'):
+                return float(raw_value), None
+            elif ttype == 'boolean':
+                return raw_value.lower() in TRUE_VALUES, None
+        except ValueError:
+            return False, _("'%s' is not a valid value for a field of type %s.") % (raw_value, ttype)
+        if ttype != 'many2one':
+            return raw_value, None
+        relation = field['relation']
+        if ',' in raw_value:
+            model, res_id = raw_value.split(',', 1)
+            if model == relation and res_id.isdigit():
+                return int(res_id), None
+        if '.' in raw_value:
+            record = self.env.ref(raw_value, raise_if_not_found=False)
+            if record and record._name == relation:
+                return record.id, None
+        domain = [('name', '=', raw_value)]
+        if relation == 'account.account':
+            domain = [('code', '=', raw_value)]
+        if 'company_id' in self.env[relation]._fields:
+            domain.append(('company_id', 'in', (False, company_id)))
+        records = self.env[relation].search(domain, limit=2)
+        if not records:
+            return False, _("No %s found for '%s' in company ID %d.") % (relation, raw_value, company_id)
+        if len(records) > 1:
+            return False, _("Several %s found for '%s' in company ID %d.") % (relation, raw_value, company_id)
+        return records.id, None
+
+    # Return {(company_id, field_id): (current_value, new_value)} for the
+    # properties that will be created or changed
+    def _compute_property_diff(self, key2value):
+        company_ids = list({key[0] for key in key2value})
+        field_ids = list({key[1] for key in key2value})
+        key2current = {}
+        # sudo() like _set_default_properties(): the properties of the
+        # companies that are not allowed for the user must be compared too
+        for prop in self.env['ir.property'].sudo().search([
+                ('company_id', 'in', company_ids),
+                ('fields_id', 'in', field_ids),
+                ('res_id', '=', False),
+                ]):
+            value = prop.get_by_record()
+            if isinstance(value, models.BaseModel):
+                value = value.id
+            key2current[(prop.company_id.id, prop.fields_id.id)] = value
+        diff = {}
+        for key, (field, value) in key2value.items():
+            if key not in key2current:
+                diff[key] = (None, value)
+            elif (key2current[key] or False) != (value or False):
+                diff[key] = (key2current[key], value)
+        return diff
+
+    def _diff2html(self, diff):
+        companies = {c.id: c.display_name for c in self.env['res.company'].browse(list({k[0] for k in diff}))}
+        fields_by_id = {
+            field.id: field
+            for field in self.env['ir.model.fields'].browse(list({k[1] for k in diff}))}
+        company2rows = defaultdict(list)
+        for (company_id, field_id), (current, new) in diff.items():
+            field = fields_by_id[field_id]
+            company2rows[company_id].append(
+                '<li><b>%s</b>: %s &#8594; <b>%s</b></li>' % (
+                    html_escape('%s (%s)' % (field.field_description, field.model)),
+                    current is None and '<i>no default</i>' or self._property_value2html(field, current),
+                    self._property_value2html(field, new)))
+        if not company2rows:
+            return '<p>No change: all the default properties are already up to date.</p>'
+        html = ''
+        for company_id, rows in company2rows.items():
+            html += '<h3>%s</h3>\n<p><ul>%s</ul></p>' % (html_escape(companies[company_id]), '\n'.join(rows))
+        return html
+
+    @api.model
+    def _property_value2html(self, field, value):
+        if field.ttype == 'many2one' and value:
+            value = self.env[field.relation].sudo().browse(value).display_name
+        return html_escape(str(value))
+
+    def preview_mapping(self):
+        self.ensure_one()
+        key2value = self._prepare_property_mapping(self._parse_mapping_file())
+        self.preview = self._diff2html(self._compute_property_diff(key2value))
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': self.id,
+            'view_mode': 'form',
+            'target': 'new',
+            }
+
+    def run(self):
+        self.ensure_one()
+        key2value = self._prepare_property_mapping(self._parse_mapping_file())
+        diff = self._compute_property_diff(key2value)
+        # only write the properties that change
+        key2vals = {
+            key: self._prepare_property_vals(field, value)
+            for (key, (field, value)) in key2value.items() if key in diff}
+        property_ids = self.env['account.default.ir.property']._set_default_properties(key2vals)
+        logger.info('Mapping file applied: %d default properties set', len(property_ids))
+        action = self.env["ir.actions.actions"]._for_xml_id("base.ir_property_form")
+        action['domain'] = [('id', 'in', property_ids)]
+        return action
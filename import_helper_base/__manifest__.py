@@ -15,7 +15,10 @@
         ],
     'data': [
         'security/ir.model.access.csv',
+        'security/ir_rule.xml',
         'wizards/import_helper_view.xml',
+        'views/import_helper_job_view.xml',
+        'data/ir_cron.xml',
         ],
     'installable': True,
 }
@@ -0,0 +1,268 @@
+# Copyright 2023 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from odoo import api, fields, models, tools, _
+from odoo.exceptions import UserError
+from odoo.tools import split_every
+from odoo.addons.import_helper_base.tools import speedy_snapshot
+from datetime import date, datetime
+import json
+import os
+import shutil
+import time
+import traceback
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# The datetimes and dates of the vals (create_date...) are encoded
+# explicitly in the JSON payload, so that the import methods get them
+# back as datetimes/dates, cf _json_object_hook()
+def _json_default(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, date):
+        return {'__date__': value.isoformat()}
+    return str(value)
+
+
+def _json_object_hook(obj):
+    if len(obj) == 1:
+        if '__datetime__' in obj:
+            return datetime.fromisoformat(obj['__datetime__'])
+        if '__date__' in obj:
+            return date.fromisoformat(obj['__date__'])
+    return obj
+
+
+class ImportHelperJob(models.Model):
+    _name = "import.helper.job"
+    _description = "Import Helper Background Job"
+    _order = "id desc"
+
+    name = fields.Char(required=True)
+    method = fields.Char(required=True, readonly=True)
+    mode = fields.Selection([
+        ('row', 'Row'),
+        ('batch', 'Batch'),
+        ], required=True, default='row', readonly=True)
+    aiengine = fields.Char(readonly=True)
+    kwargs = fields.Text(readonly=True)
+    company_id = fields.Many2one(
+        'res.company', required=True, readonly=True,
+        default=lambda self: self.env.company)
+    user_id = fields.Many2one(
+        'res.users', required=True, readonly=True,
+        default=lambda self: self.env.user)
+    state = fields.Selection([
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ], required=True, default='running', readonly=True)
+    chunk_ids = fields.One2many(
+        'import.helper.job.chunk', 'job_id', string='Chunks', readonly=True)
+    chunk_count = fields.Integer(readonly=True)
+    logs = fields.Html(readonly=True)
+    snapshot_path = fields.Char(readonly=True)
+
+    # The jobs and chunks can only be created by this method (the users
+    # only have read access): the method must be one of the import entry
+    # points of _import_job_methods() and the job is run as the current user
+    @api.model
+    def _submit(self, method, vals_list, mode=False, chunk_size=1000, aiengine='chatgpt', name=False, snapshot=False, kwargs=None):
+        method2mode = self.env['import.helper']._import_job_methods()
+        if method not in method2mode:
+            raise UserError(_("The method '%s' cannot be run in an import job.") % method)
+        if mode and mode != method2mode[method]:
+            raise UserError(_("The method '%s' must be run in mode '%s'.") % (method, method2mode[method]))
+        chunks_vals = []
+        for sequence, chunk in enumerate(split_every(chunk_size, vals_list, list), start=1):
+            chunks_vals.append((0, 0, {
+                'sequence': sequence,
+                'payload': json.dumps(chunk, default=_json_default),
+                }))
+        job = self.sudo().create({
+            'name': name or method,
+            'method': method,
+            'mode': method2mode[method],
+            'aiengine': aiengine or False,
+            'kwargs': json.dumps(kwargs or {}, default=_json_default),
+            'user_id': self.env.user.id,
+            'company_id': self.env.company.id,
+            'chunk_ids': chunks_vals,
+            'chunk_count': len(chunks_vals),
+            })
+        if snapshot:
+            # in the data_dir, like the filestore, so that it is shared by the workers
+            directory = os.path.join(
+                tools.config['data_dir'], 'import_helper_snapshots', self._cr.dbname, 'job_%d' % job.id)
+            iho = self.env['import.helper']
+            iho._export_speedy_snapshot(iho._prepare_speedy(aiengine=aiengine), directory)
+            job.snapshot_path = directory
+        logger.info('Import job %s submitted with %d chunks', job.name, job.chunk_count)
+        chunk_obj = self.env['import.helper.job.chunk'].sudo()
+        if hasattr(chunk_obj, 'with_delay'):  # queue_job is installed
+            for chunk in job.chunk_ids:
+                chunk.with_delay(description='%s (%d/%d)' % (
+                    job.name, chunk.sequence, job.chunk_count))._process()
+            job.chunk_ids.write({'state': 'queued'})
+        return job.sudo(False)
+
+    def _finalize(self):
+        # Merge the logs of the chunks when all the chunks are processed
+        iho = self.env['import.helper']
+        for job in self:
+            chunks = job.chunk_ids.sorted('sequence')
+            if job.state != 'running' or any(c.state not in ('done', 'failed') for c in chunks):
+                continue
+            speedy = {
+                'aiengine': job.aiengine,
+                'openai_tokens': sum(chunks.mapped('openai_tokens')),
+                'field2label': {},
+                'external_skipped': {},
+                'logs': {},
+                }
+            deltas = []
+            for chunk in chunks:
+                deltas.append(json.loads(chunk.speedy_delta or '{}'))
+                for service, count in json.loads(chunk.external_skipped or '{}').items():
+                    speedy['external_skipped'][service] = speedy['external_skipped'].get(service, 0) + count
+                for obj_name, logs in json.loads(chunk.logs_data or '{}').items():
+                    speedy['logs'].setdefault(obj_name, []).extend(logs)
+            html = ''
+            failed_chunks = chunks.filtered(lambda c: c.state == 'failed')
+            for chunk in failed_chunks:
+                html += '<p style="color: red"><b>Chunk %d failed</b>: <pre>%s</pre></p>' % (
+                    chunk.sequence, chunk.error)
+            if job.snapshot_path:
+                html += job._snapshot_conflicts2html(deltas)
+                shutil.rmtree(job.snapshot_path, ignore_errors=True)
+            html += iho._convert_logs2html(speedy)
+            job.write({
+                'logs': html,
+                'state': failed_chunks and 'failed' or 'done',
+                })
+            logger.info('Import job %s finished', job.name)
+
+    def _snapshot_conflicts2html(self, deltas):
+        # The entries added to the lookup tables by the chunks are reconciled:
+        # an entry added with different values by several chunks (ex: the same
+        # category created by 2 workers in parallel) must be checked by the user
+        merged, conflicts = speedy_snapshot.reconcile_deltas(deltas)
+        html = ''
+        for path, key2values in conflicts.items():
+            for key, values in key2values.items():
+                html += '<li><b>%s</b>: %s &#8594; %s</li>' % (
+                    path, key, ', '.join(str(value) for value in values))
+        if html:
+            html = '<p style="color: darkorange">The following entries were created by several chunks in parallel, please check the duplicates:<ul>%s</ul></p>' % html
+        logger.info(
+            'Import job %s: %d new entries in the lookup tables, %d conflicts',
+            self.name, sum(len(table) for table in merged.values()),
+            sum(len(key2values) for key2values in conflicts.values()))
+        return html
+
+    def action_show_result(self):
+        self.ensure_one()
+        if self.state == 'running':
+            raise UserError(_("The import job '%s' is still running.") % self.name)
+        return self.env['import.helper']._result_action_html(self.logs)
+
+    @api.model
+    def _cron_process_chunks(self, max_duration=600):
+        # Several crons (or several executions of the same cron in different
+        # workers) can run this method in parallel: each chunk is locked
+        # with SKIP LOCKED and processed/committed in its own transaction
+        start = time.monotonic()
+        chunk_obj = self.env['import.helper.job.chunk']
+        while time.monotonic() - start < max_duration:
+            self._cr.execute("""
+                SELECT id FROM import_helper_job_chunk
+                WHERE state = 'pending'
+                ORDER BY job_id, sequence
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+                """)
+            res = self._cr.fetchone()
+            if not res:
+                break
+            chunk_obj.browse(res[0])._process()
+            self._cr.commit()
+        self.search([('state', '=', 'running')])._finalize()
+
+
+class ImportHelperJobChunk(models.Model):
+    _name = "import.helper.job.chunk"
+    _description = "Import Helper Background Job Chunk"
+    _order = "job_id, sequence"
+
+    job_id = fields.Many2one(
+        'import.helper.job', required=True, ondelete='cascade', index=True)
+    sequence = fields.Integer(required=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('queued', 'Queued'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ], required=True, default='pending', index=True)
+    payload = fields.Text()
+    logs_data = fields.Text()
+    openai_tokens = fields.Integer()
+    external_skipped = fields.Text()
+    speedy_delta = fields.Text()
+    error = fields.Text()
+
+    def _process(self):
+        self.ensure_one()
+        # the chunk is updated in sudo, the import runs as the user of the job
+        self = self.sudo()
+        job = self.job_id
+        iho = self.env['import.helper'].with_user(job.user_id).with_company(job.company_id)
+        speedy = None
+        try:
+            with self.env.cr.savepoint():
+                if job.method not in iho._import_job_methods():
+                    raise UserError(_("The method '%s' cannot be run in an import job.") % job.method)
+                if job.snapshot_path:
+                    speedy = iho._prepare_speedy_from_snapshot(job.snapshot_path, aiengine=job.aiengine)
+                else:
+                    speedy = iho._prepare_speedy(aiengine=job.aiengine)
+                vals_list = json.loads(self.payload, object_hook=_json_object_hook)
+                kwargs = json.loads(job.kwargs or '{}', object_hook=_json_object_hook)
+                method = getattr(iho, job.method)
+                if job.mode == 'batch':
+                    method(vals_list, speedy, **kwargs)
+                else:
+                    for vals in vals_list:
+                        method(vals, speedy, **kwargs)
+            self.write({
+                'state': 'done',
+                'logs_data': json.dumps(self._serialize_logs(speedy), default=str),
+                'openai_tokens': speedy.get('openai_tokens', 0),
+                'external_skipped': json.dumps(speedy['external'].skipped),
+                'speedy_delta': job.snapshot_path and json.dumps(iho._speedy_snapshot_delta(speedy), default=str) or False,
+                'payload': False,
+                })
+        except Exception:
+            logger.exception('Import job %s: chunk %d failed', job.name, self.sequence)
+            self.write({'state': 'failed', 'error': traceback.format_exc()})
+        finally:
+            if speedy:
+                speedy['external'].shutdown()
+                iho._close_speedy_snapshot(speedy)
+        job._finalize()
+
+    @api.model
+    def _serialize_logs(self, speedy):
+        # the vals of the logs are only used for the line number and the
+        # created record, cf _convert_logs2html()
+        res = {}
+        for obj_name, logs in speedy['logs'].items():
+            res[obj_name] = []
+            for log in logs:
+                vals = log['vals']
+                res[obj_name].append(dict(log, vals={
+                    key: vals[key] for key in ('line', 'id', 'display_name') if key in vals}))
+        return res
@@ -0,0 +1,5 @@
+from . import test_identifier
+from . import test_external_call
+from . import test_mapped_index
+from . import test_fuzzy
+from . import test_import_helper_job
@@ -0,0 +1,102 @@
+# Copyright 2023 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import threading
+
+from odoo.tests.common import TransactionCase
+from odoo.addons.import_helper_base.tools.external_call import (
+    ExternalCalls, ExternalServiceSkipped, ExternalServiceTimeout)
+
+
+class FakeService:
+    # Local fake of an external service that answers, hangs or fails
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = 0
+
+    def answer(self, value):
+        self.calls += 1
+        return value
+
+    def hang(self):
+        self.calls += 1
+        self.release.wait(5)
+
+    def error(self):
+        self.calls += 1
+        raise ConnectionError('connection refused')
+
+    def invalid(self):
+        self.calls += 1
+        raise ValueError('not valid')
+
+
+class TestExternalCall(TransactionCase):
+
+    def setUp(self):
+        super().setUp()
+        self.service = FakeService()
+        self.external = ExternalCalls(timeouts={'fake': 0.05}, max_failures=3)
+
+    def tearDown(self):
+        self.service.release.set()
+        self.external.shutdown()
+        super().tearDown()
+
+    def test_answer(self):
+        self.assertEqual(self.external.call('fake', self.service.answer, 42), 42)
+        self.assertFalse(self.external.skipped)
+
+    def test_circuit_breaker_hang(self):
+        for i in range(3):
+            with self.assertRaises(ExternalServiceTimeout):
+                self.external.call('fake', self.service.hang)
+        for i in range(2):
+            with self.assertRaises(ExternalServiceSkipped):
+                self.external.call('fake', self.service.hang)
+        self.assertEqual(self.service.calls, 3)
+        self.assertEqual(self.external.skipped['fake'], 2)
+        # the other services are not affected
+        self.assertEqual(self.external.call('other', self.service.answer, 1), 1)
+
+    def test_hung_service_isolated(self):
+        # the threads of the hung calls are still running, but they don't
+        # take the threads of the other services
+        external = ExternalCalls(timeouts={'fake': 0.05, 'other': 1}, max_failures=10, max_workers=2)
+        with external:
+            for i in range(4):
+                with self.assertRaises(ExternalServiceTimeout):
+                    external.call('fake', self.service.hang)
+            self.assertEqual(external.call('other', self.service.answer, 1), 1)
+            self.assertFalse(external.failures['other'])
+        self.assertFalse(external._executors)
+
+    def test_circuit_breaker_error(self):
+        with self.assertRaises(ConnectionError):
+            self.external.call('fake', self.service.error)
+        # a success resets the counter of consecutive failures
+        self.external.call('fake', self.service.answer, 1)
+        for i in range(3):
+            with self.assertRaises(ConnectionError):
+                self.external.call('fake', self.service.error)
+        with self.assertRaises(ExternalServiceSkipped):
+            self.external.call('fake', self.service.answer, 1)
+        self.assertEqual(self.external.skipped['fake'], 1)
+
+    def test_ok_exceptions(self):
+        for i in range(5):
+            with self.assertRaises(ValueError):
+                self.external.call('fake', self.service.invalid, ok_exceptions=(ValueError, ))
+        self.assertFalse(self.external.tripped)
+
+    def test_budget(self):
+        external = ExternalCalls(timeouts={'fake': 10}, max_failures=10, budget=0.05)
+        try:
+            with self.assertRaises(ExternalServiceTimeout):
+                external.call('fake', self.service.hang)
+            with self.assertRaises(ExternalServiceSkipped):
+                external.call('other', self.service.answer, 1)
+            self.assertEqual(external.skipped['other'], 1)
+        finally:
+            external.shutdown()
@@ -0,0 +1,39 @@
+# Copyright 2023 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo.tests.common import TransactionCase
+from odoo.addons.import_helper_base.tools import fuzzy
+
+
+class TestFuzzy(TransactionCase):
+
+    def test_normalize(self):
+        self.assertEqual(fuzzy.normalize(' Catégorie  Électronique '), 'categorie electronique')
+
+    def test_match(self):
+        index = fuzzy.FuzzyIndex(
+            ['Électronique', 'Informatique', 'Alimentation', 'allemagne', 'espagne'], threshold=0.6)
+        self.assertEqual(index.match('electronique'), ('Électronique', 1.0))
+        self.assertEqual(index.match('Informatiqe')[0], 'Informatique')
+        self.assertEqual(index.match('Alimentations')[0], 'Alimentation')
+        self.assertEqual(index.match('allemange')[0], 'allemagne')
+        self.assertIsNone(index.match('Jardinage'))
+        # too short
+        self.assertIsNone(index.match('ali'))
+        index.add('Jardinage')
+        self.assertEqual(index.match('jardinnage')[0], 'Jardinage')
+
+    def test_match_default_threshold(self):
+        index = fuzzy.FuzzyIndex(['Chaussures homme', 'Pantalons homme', 'Vêtements hommes'])
+        # names that only differ by one meaningful word are not matched
+        self.assertIsNone(index.match('Chaussures femme'))
+        self.assertIsNone(index.match('Pantalons femme'))
+        self.assertIsNone(index.match('Vetements femmes'))
+        # typos and plurals are still matched
+        self.assertEqual(index.match('Chaussures hommes')[0], 'Chaussures homme')
+        self.assertEqual(index.match('Vetements homme')[0], 'Vêtements hommes')
+        self.assertIsNone(index.match('Chaussures femmes'))
+        # the new names are matched once added
+        index.add('Chaussures femme')
+        self.assertEqual(index.match('Chaussures femmes')[0], 'Chaussures femme')
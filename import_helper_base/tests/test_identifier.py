@@ -0,0 +1,46 @@
+# Copyright 2023 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from odoo.tests.common import TransactionCase
+from odoo.addons.import_helper_base.tools import identifier
+
+
+class TestIdentifier(TransactionCase):
+
+    def test_clean(self):
+        self.assertEqual(identifier.clean_alnum(' fr-12.345 678 901 '), 'FR12345678901')
+        self.assertEqual(identifier.clean_digits('732 829 320 00074'), '73282932000074')
+        self.assertEqual(identifier.clean_digits(732829320), '732829320')
+
+    def test_siren_siret(self):
+        self.assertEqual(identifier.normalize_siren('732 829 320'), ('732829320', None))
+        self.assertTrue(identifier.normalize_siren('732829321')[1])
+        self.assertTrue(identifier.normalize_siren('73282932')[1])
+        self.assertEqual(identifier.normalize_siret('732 829 320 00074'), ('73282932000074', None))
+        self.assertTrue(identifier.normalize_siret('73282932000075')[1])
+        # La Poste: the head office uses Luhn, the other establishments
+        # a sum of digits multiple of 5
+        self.assertEqual(identifier.normalize_siret('356 000 000 00048'), ('35600000000048', None))
+        self.assertEqual(identifier.normalize_siret('35600000049837'), ('35600000049837', None))
+        self.assertTrue(identifier.normalize_siret('35600000012345')[1])
+        self.assertEqual(identifier.normalize_siren_or_siret('73282932000074'), ('73282932000074', None))
+
+    def test_iban_vat_ean(self):
+        self.assertEqual(
+            identifier.normalize_iban('fr76 3000 6000 0112 3456 7890 189'),
+            ('FR7630006000011234567890189', None))
+        self.assertTrue(identifier.normalize_iban('FR7630006000011234567890188')[1])
+        self.assertEqual(identifier.normalize_vat('fr 40 303 265 045'), ('FR40303265045', None))
+        self.assertTrue(identifier.normalize_vat('FR40303265046')[1])
+        self.assertEqual(identifier.normalize_ean('4006381333931'), ('4006381333931', None))
+        self.assertTrue(identifier.normalize_ean('4006381333932')[1])
+        self.assertTrue(identifier.normalize_ean('123')[1])
+
+    def test_normalize_column(self):
+        cache = {}
+        res = identifier.normalize_column('siren', ['732829320', False, '732829320', '1'], cache=cache)
+        self.assertEqual(res[0], ('732829320', None))
+        self.assertEqual(res[1], (False, None))
+        self.assertTrue(res[3][1])
+        self.assertEqual(len(cache), 2)
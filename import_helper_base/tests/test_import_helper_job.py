@@ -0,0 +1,44 @@
+# Copyright 2023 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+from datetime import date, datetime
+import json
+
+from odoo.exceptions import AccessError, UserError
+from odoo.tests.common import TransactionCase, new_test_user
+from odoo.addons.import_helper_base.models.import_helper_job import (
+    _json_default, _json_object_hook)
+
+
+class TestImportHelperJob(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.env = cls.env(context=dict(cls.env.context, tracking_disable=True))
+        cls.user = new_test_user(cls.env, login='import_job_user', groups='base.group_user')
+
+    def test_submit_method_not_allowed(self):
+        iho = self.env['import.helper'].with_user(self.user)
+        for method in ('_bulk_create', '_result_action', 'unlink'):
+            with self.assertRaises(UserError):
+                iho._submit_import_job(method, [{'line': 1}], aiengine=False)
+
+    def test_no_direct_create(self):
+        jobo = self.env['import.helper.job'].with_user(self.user)
+        with self.assertRaises(AccessError):
+            jobo.create({'name': 'Test', 'method': '_create_partner', 'user_id': 1})
+        with self.assertRaises(AccessError):
+            self.env['import.helper.job.chunk'].with_user(self.user).create({
+                'job_id': 1, 'sequence': 1})
+
+    def test_payload_datetime(self):
+        vals_list = [{
+            'line': 2,
+            'create_date': datetime(2021, 3, 4, 5, 6, 7),
+            'date': date(2021, 3, 4),
+            'name': 'Test',
+            }]
+        payload = json.dumps(vals_list, default=_json_default)
+        self.assertEqual(json.loads(payload, object_hook=_json_object_hook), vals_list)
@@ -0,0 +1,93 @@
+# Copyright 2023 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
+
+import json
+import os
+import tempfile
+
+from odoo.tests.common import TransactionCase
+from odoo.addons.import_helper_base.tools.mapped_index import MappedIndex, build_mapped_index
+from odoo.addons.import_helper_base.tools import speedy_snapshot
+
+
+class TestMappedIndex(TransactionCase):
+
+    def test_mapped_index(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'test.idx')
+            items = [('FR\x1f%05d' % i, 'City %d' % i) for i in range(1000)]
+            # the last value wins
+            items.append(('FR\x1f00042', 'Lyon'))
+            items.append(('DE\x1f10115', 'Berlin'))
+            self.assertEqual(build_mapped_index(path, items), 1001)
+            index = MappedIndex(path)
+            try:
+                self.assertEqual(len(index), 1001)
+                self.assertEqual(index.get('FR\x1f00041'), 'City 41')
+                self.assertEqual(index['FR\x1f00042'], 'Lyon')
+                self.assertEqual(index.get('DE\x1f10115'), 'Berlin')
+                self.assertIsNone(index.get('DE\x1f99999'))
+                self.assertNotIn('FR\x1f99999', index)
+                with self.assertRaises(KeyError):
+                    index['BE\x1f1000']
+                self.assertEqual(dict(index.items()), dict(items))
+            finally:
+                index.close()
+
+    def test_not_an_index(self):
+        with tempfile.NamedTemporaryFile(suffix='.idx') as f:
+            f.write(b'not an index file, just some bytes')
+            f.flush()
+            with self.assertRaises(ValueError):
+                MappedIndex(f.name)
+
+    def test_speedy_snapshot(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            speedy_snapshot.export_snapshot(tmp_dir, {
+                'country.code2id': {'FR': 75, 'DE': 57},
+                'country.id2code': {75: 'FR', 57: 'DE'},
+                })
+            deltas = []
+            for new_id in (10, 11):
+                # 2 workers
+                tables = speedy_snapshot.attach_snapshot(tmp_dir)
+                code2id = tables['country.code2id']
+                self.assertEqual(code2id['FR'], 75)
+                self.assertEqual(tables['country.id2code'][57], 'DE')
+                self.assertNotIn('BE', code2id)
+                code2id['BE'] = 21
+                tables['country.id2code'][new_id] = 'XX'
+                self.assertEqual(len(code2id), 3)
+                self.assertEqual(set(code2id), {'FR', 'DE', 'BE'})
+                deltas.append(speedy_snapshot.snapshot_delta(tables))
+                speedy_snapshot.close_snapshot(tables)
+            merged, conflicts = speedy_snapshot.reconcile_deltas(deltas)
+            self.assertEqual(merged['country.code2id'], {'BE': 21})
+            self.assertEqual(merged['country.id2code'], {10: 'XX', 11: 'XX'})
+            self.assertFalse(conflicts)
+            merged, conflicts = speedy_snapshot.reconcile_deltas([
+                {'product_categ2id': [["'Foo'", 1]]}, {'product_categ2id': [["'Foo'", 2]]}])
+            self.assertEqual(conflicts, {'product_categ2id': {'Foo': [1, 2]}})
+
+    def test_speedy_snapshot_tuple_keys(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            speedy_snapshot.export_snapshot(tmp_dir, {
+                'seller_code2product': {(7, 'A-1'): [3, 4], (7, 'B-2'): [5, False]},
+                })
+            tables = speedy_snapshot.attach_snapshot(tmp_dir)
+            try:
+                seller_code2product = tables['seller_code2product']
+                self.assertIn((7, 'A-1'), seller_code2product)
+                self.assertNotIn((8, 'A-1'), seller_code2product)
+                self.assertEqual(seller_code2product[(7, 'B-2')], [5, False])
+                self.assertEqual(set(seller_code2product), {(7, 'A-1'), (7, 'B-2')})
+                seller_code2product[(8, 'C-3')] = [6, 7]
+                self.assertEqual(len(seller_code2product), 3)
+                # the delta goes through JSON, like speedy_delta on the chunks
+                delta = json.loads(json.dumps(speedy_snapshot.snapshot_delta(tables)))
+            finally:
+                speedy_snapshot.close_snapshot(tables)
+            merged, conflicts = speedy_snapshot.reconcile_deltas([delta])
+            self.assertEqual(merged, {'seller_code2product': {(8, 'C-3'): [6, 7]}})
+            self.assertFalse(conflicts)
@@ -0,0 +1,5 @@
+from . import identifier
+from . import external_call
+from . import mapped_index
+from . import fuzzy
+from . import speedy_snapshot
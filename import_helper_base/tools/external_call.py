@@ -0,0 +1,133 @@
+# Copyright 2023 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+# Guard for the calls to external services done during an import
+# (VIES, DNS for e-mail deliverability, OpenAI...):
+# - each call runs in a worker thread with a per-service timeout; each
+#   service has its own thread pool, so that the hung calls of a service
+#   (the threads can't be killed) don't delay the calls of the others,
+# - a global time budget is shared by all the calls of the import,
+# - after max_failures consecutive failures (timeout or error), the circuit
+#   breaker of the service trips and the next calls are skipped,
+# - the skipped calls are counted per service, to be displayed in the logs.
+# shutdown() must be called at the end of the import, even if it fails
+# (or use ExternalCalls as a context manager).
+# It doesn't depend on the ORM.
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# seconds
+DEFAULT_TIMEOUTS = {
+    'vies': 10,
+    'dns': 5,
+    'openai': 30,
+    }
+DEFAULT_TIMEOUT = 10
+
+
+class ExternalServiceSkipped(Exception):
+    pass
+
+
+class ExternalServiceTimeout(Exception):
+    pass
+
+
+class ExternalCalls:
+
+    def __init__(self, timeouts=None, max_failures=5, budget=0, max_workers=4):
+        # max_workers: size of the thread pool of each service
+        # budget: total number of seconds for all the external calls
+        # (0 = no budget)
+        self.timeouts = dict(DEFAULT_TIMEOUTS, **(timeouts or {}))
+        self.max_failures = max_failures
+        self.budget = budget
+        self.spent = 0.0
+        self.failures = defaultdict(int)  # consecutive failures per service
+        self.tripped = {}  # service -> reason
+        self.skipped = defaultdict(int)
+        self.max_workers = max_workers
+        self._executors = {}  # service -> ThreadPoolExecutor
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def _get_executor(self, service):
+        if service not in self._executors:
+            self._executors[service] = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix='import_helper_external_%s' % service)
+        return self._executors[service]
+
+    def remaining_budget(self):
+        if not self.budget:
+            return None
+        return max(self.budget - self.spent, 0)
+
+    def skip_reason(self, service):
+        if service in self.tripped:
+            return self.tripped[service]
+        if self.budget and self.remaining_budget() <= 0:
+            return 'time budget of %s seconds exhausted' % self.budget
+        return None
+
+    def call(self, service, func, *args, ok_exceptions=(), **kwargs):
+        # Return the result of func(*args, **kwargs)
+        # Raise ExternalServiceSkipped if the service is skipped,
+        # ExternalServiceTimeout on timeout, or the exception of func.
+        # The exceptions of ok_exceptions are answers of the service
+        # (ex: EmailNotValidError), so they are not counted as failures.
+        reason = self.skip_reason(service)
+        if reason:
+            self.skipped[service] += 1
+            raise ExternalServiceSkipped('%s skipped: %s' % (service, reason))
+        timeout = self.timeouts.get(service, DEFAULT_TIMEOUT)
+        remaining = self.remaining_budget()
+        if remaining is not None:
+            timeout = min(timeout, remaining)
+        start = time.monotonic()
+        future = self._get_executor(service).submit(func, *args, **kwargs)
+        try:
+            res = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            # the thread can't be killed, but we don't wait for it
+            future.cancel()
+            self._failure(service, 'timeout after %s seconds' % timeout)
+            raise ExternalServiceTimeout('%s: no answer after %s seconds' % (service, timeout))
+        except ok_exceptions:
+            self.failures[service] = 0
+            raise
+        except Exception as e:
+            self._failure(service, str(e))
+            raise
+        finally:
+            self.spent += time.monotonic() - start
+        self.failures[service] = 0
+        return res
+
+    def _failure(self, service, error):
+        self.failures[service] += 1
+        if self.failures[service] >= self.max_failures and service not in self.tripped:
+            self.tripped[service] = '%d consecutive failures (last one: %s)' % (
+                self.failures[service], error)
+            logger.warning(
+                'External service %s is now skipped for the rest of the import: %s',
+                service, self.tripped[service])
+
+    def shutdown(self):
+        # the running calls can't be stopped, but the queued ones are dropped
+        for executor in self._executors.values():
+            try:
+                executor.shutdown(wait=False, cancel_futures=True)
+            except TypeError:  # python < 3.9
+                executor.shutdown(wait=False)
+        self._executors = {}
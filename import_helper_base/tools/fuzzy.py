@@ -0,0 +1,92 @@
+# Copyright 2023 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+# In-process fuzzy matching of names (countries, industries, categories...)
+# based on character trigrams: the similarity of 2 names is the Dice
+# coefficient of their sets of trigrams. The candidates are found with an
+# inverted index trigram -> names, so a lookup doesn't scan all the names.
+# It doesn't depend on the ORM.
+
+from collections import defaultdict
+import re
+import unicodedata
+
+# a looser threshold matches names that only differ by one meaningful word
+# ('Chaussures femme' / 'Chaussures homme': 0.76)
+DEFAULT_THRESHOLD = 0.85
+# below this length, trigrams are not reliable
+MIN_LENGTH = 4
+
+
+def normalize(text):
+    # 'Catégorie  Électronique ' -> 'categorie electronique'
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(re.findall(r'\w+', text.lower()))
+
+
+def trigrams(text):
+    text = '  %s ' % text
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def similarity(trigrams1, trigrams2):
+    if not trigrams1 or not trigrams2:
+        return 0.0
+    return 2.0 * len(trigrams1 & trigrams2) / (len(trigrams1) + len(trigrams2))
+
+
+class FuzzyIndex:
+
+    def __init__(self, names=None, threshold=DEFAULT_THRESHOLD):
+        self.threshold = threshold
+        self.entries = {}  # normalized name -> (original name, trigrams)
+        self.trigram2names = defaultdict(set)
+        self.cache = {}  # name -> result of match()
+        for name in names or []:
+            self.add(name)
+
+    def add(self, name):
+        norm = normalize(name)
+        if len(norm) < MIN_LENGTH or norm in self.entries:
+            return
+        tgrams = trigrams(norm)
+        self.entries[norm] = (name, tgrams)
+        self.cache.clear()
+        for tgram in tgrams:
+            self.trigram2names[tgram].add(norm)
+
+    def match(self, name):
+        # Return (original name, score) of the best match above the threshold,
+        # or None if there is no match or if the best match is ambiguous
+        if name not in self.cache:
+            self.cache[name] = self._match(name)
+        return self.cache[name]
+
+    def _match(self, name):
+        norm = normalize(name)
+        if len(norm) < MIN_LENGTH:
+            return None
+        if norm in self.entries:
+            return self.entries[norm][0], 1.0
+        tgrams = trigrams(norm)
+        # a candidate must share enough trigrams to reach the threshold
+        counts = defaultdict(int)
+        for tgram in tgrams:
+            for candidate in self.trigram2names.get(tgram, ()):
+                counts[candidate] += 1
+        best = None
+        best_score = second_score = 0.0
+        for candidate, count in counts.items():
+            cand_tgrams = self.entries[candidate][1]
+            if 2.0 * count / (len(tgrams) + len(cand_tgrams)) < self.threshold:
+                continue
+            score = similarity(tgrams, cand_tgrams)
+            if score > best_score:
+                best, best_score, second_score = candidate, score, best_score
+            elif score > second_score:
+                second_score = score
+        if best is None or best_score == second_score:
+            return None
+        return self.entries[best][0], best_score
@@ -0,0 +1,186 @@
+# Copyright 2023 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+# Normalization and validation of the identifiers found in import files
+# (VAT, SIREN, SIRET, IBAN, EAN). Each normalize_xxx() function does a single
+# clean + validate pass and returns a tuple (clean_value, error_msg) where
+# error_msg is None when the identifier is valid.
+# These functions don't depend on the ORM, so they can be used by
+# all the import helper modules.
+
+from string import ascii_uppercase, digits
+
+from stdnum.eu.vat import is_valid as vat_is_valid
+from stdnum.iban import is_valid as iban_is_valid
+
+
+class _KeepTable(dict):
+    # Translation table for str.translate() that keeps the chars of 'keep'
+    # (after upper-casing if 'upper' is True) and deletes all the others.
+    # The table is filled lazily, so each char is only analysed once.
+    def __init__(self, keep, upper=False):
+        super().__init__()
+        self.keep = frozenset(keep)
+        self.upper = upper
+
+    def __missing__(self, code):
+        char = chr(code)
+        if self.upper:
+            char = char.upper()
+        value = char if char in self.keep else None
+        self[code] = value
+        return value
+
+
+ALNUM_UPPER_TABLE = _KeepTable(ascii_uppercase + digits, upper=True)
+DIGITS_TABLE = _KeepTable(digits)
+EAN_LENGTHS = (8, 13, 14)
+# The SIRETs of the establishments of La Poste don't use the Luhn checksum:
+# the sum of their digits is a multiple of 5 (except the head office)
+LA_POSTE_SIREN = '356000000'
+LA_POSTE_HEAD_OFFICE_SIRET = '35600000000048'
+
+
+def clean_alnum(value):
+    # equivalent to ''.join(re.findall(r'[A-Z0-9]+', value.upper()))
+    if isinstance(value, int):
+        value = str(value)
+    return value.translate(ALNUM_UPPER_TABLE)
+
+
+def clean_digits(value):
+    # equivalent to ''.join(re.findall(r'[0-9]+', value))
+    if isinstance(value, int):
+        value = str(value)
+    return value.translate(DIGITS_TABLE)
+
+
+def luhn_is_valid(number):
+    total = 0
+    for i, char in enumerate(reversed(number)):
+        digit = ord(char) - 48
+        if i % 2:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        total += digit
+    return total % 10 == 0
+
+
+def ean_checksum_is_valid(number):
+    total = 0
+    for i, char in enumerate(reversed(number[:-1])):
+        total += (ord(char) - 48) * (3 if i % 2 == 0 else 1)
+    return (10 - total % 10) % 10 == ord(number[-1]) - 48
+
+
+def iban_checksum_is_valid(iban):
+    # ISO 7064 mod 97-10, computed by chunks to stay on small integers
+    if len(iban) < 5 or not iban[:2].isalpha() or not iban[2:4].isdigit():
+        return False
+    remainder = 0
+    for char in iban[4:] + iban[:4]:
+        if char.isdigit():
+            remainder = (remainder * 10 + ord(char) - 48) % 97
+        else:
+            remainder = (remainder * 100 + ord(char) - 55) % 97
+    return remainder == 1
+
+
+def normalize_vat(value):
+    vat = clean_alnum(value)
+    if not vat:
+        return False, None
+    if len(vat) < 4 or not vat[:2].isalpha() or not vat_is_valid(vat):
+        return vat, 'VAT is not valid'
+    return vat, None
+
+
+def normalize_iban(value):
+    iban = clean_alnum(value)
+    if not iban:
+        return False, None
+    # the mod 97 checksum rejects most invalid IBANs without going through
+    # the country-specific BBAN checks of stdnum
+    if not iban_checksum_is_valid(iban) or not iban_is_valid(iban):
+        return iban, 'IBAN is not valid'
+    return iban, None
+
+
+def normalize_siren(value):
+    siren = clean_digits(value)
+    if len(siren) != 9:
+        return siren, 'SIREN has a length of %d instead of 9' % len(siren)
+    if not luhn_is_valid(siren):
+        return siren, 'SIREN is not valid (wrong checksum)'
+    return siren, None
+
+
+def normalize_siret(value):
+    siret = clean_digits(value)
+    if len(siret) != 14:
+        return siret, 'SIRET has a length of %d instead of 14' % len(siret)
+    if not luhn_is_valid(siret[:9]):
+        return siret, 'SIRET is not valid (wrong checksum)'
+    if siret.startswith(LA_POSTE_SIREN) and siret != LA_POSTE_HEAD_OFFICE_SIRET:
+        valid = sum(ord(char) - 48 for char in siret) % 5 == 0
+    else:
+        valid = luhn_is_valid(siret)
+    if not valid:
+        return siret, 'SIRET is not valid (wrong checksum)'
+    return siret, None
+
+
+def normalize_siren_or_siret(value):
+    number = clean_digits(value)
+    if len(number) == 9:
+        return normalize_siren(number)
+    elif len(number) == 14:
+        return normalize_siret(number)
+    return number, 'SIREN/SIRET has a length of %d instead of 9 or 14' % len(number)
+
+
+def normalize_ean(value):
+    # barcodes are not cleaned: a barcode with spaces is not an EAN
+    barcode = value
+    if isinstance(barcode, int):
+        barcode = str(barcode)
+    if len(barcode) not in EAN_LENGTHS:
+        return barcode, 'Barcode %s has %d caracters (should be 8, 13 or 14 for an EAN barcode)' % (barcode, len(barcode))
+    if not barcode.isdigit() or not ean_checksum_is_valid(barcode):
+        return barcode, 'Barcode %s has an invalid checksum' % barcode
+    return barcode, None
+
+
+NORMALIZERS = {
+    'vat': normalize_vat,
+    'iban': normalize_iban,
+    'siren': normalize_siren,
+    'siret': normalize_siret,
+    'siren_or_siret': normalize_siren_or_siret,
+    'ean': normalize_ean,
+    }
+
+
+def normalize(kind, value):
+    return NORMALIZERS[kind](value)
+
+
+def normalize_column(kind, values, cache=None):
+    # Vectorized entry point: normalize a whole column of identifiers.
+    # Identical values are only validated once; pass a 'cache' dict to share
+    # the results between several columns/chunks of the same import.
+    # Empty values give (False, None).
+    func = NORMALIZERS[kind]
+    if cache is None:
+        cache = {}
+    res = []
+    for value in values:
+        if not value:
+            res.append((False, None))
+            continue
+        if value not in cache:
+            cache[value] = func(value)
+        res.append(cache[value])
+    return res
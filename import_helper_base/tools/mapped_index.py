@@ -0,0 +1,121 @@
+# Copyright 2023 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+# Read-only string -> string index stored in a file and accessed via mmap,
+# so that big reference indexes (zip codes, snapshots of speedy...) can be
+# shared by several processes without loading them in memory.
+# File format (little-endian):
+# - header: magic (8 bytes), number of slots (uint64), number of keys (uint64)
+# - hash table: one uint64 per slot = offset of the record in the file
+#   (0 for an empty slot), open addressing with linear probing
+# - records: key length (uint32), value length (uint32), key, value (UTF-8)
+# It doesn't depend on the ORM.
+
+import mmap
+import os
+import struct
+import zlib
+
+MAGIC = b'IHMIDX01'
+HEADER = struct.Struct('<8sQQ')
+SLOT = struct.Struct('<Q')
+RECORD = struct.Struct('<II')
+
+
+def _hash(key_bytes):
+    # stable between processes, unlike hash()
+    return zlib.crc32(key_bytes)
+
+
+def build_mapped_index(path, items):
+    # items is an iterable of (key, value) strings; if a key is given several
+    # times, the last value wins. The file is written in a temporary file
+    # then renamed, so that readers never see a partial index.
+    data = {}
+    for key, value in items:
+        data[key.encode('utf-8')] = value.encode('utf-8')
+    slot_count = 8
+    while slot_count < len(data) * 2:
+        slot_count *= 2
+    slots = [0] * slot_count
+    offset = HEADER.size + SLOT.size * slot_count
+    records = []
+    for key, value in data.items():
+        slot = _hash(key) & (slot_count - 1)
+        while slots[slot]:
+            slot = (slot + 1) & (slot_count - 1)
+        slots[slot] = offset
+        records.append(RECORD.pack(len(key), len(value)) + key + value)
+        offset += RECORD.size + len(key) + len(value)
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, slot_count, len(data)))
+        f.write(struct.pack('<%dQ' % slot_count, *slots))
+        for record in records:
+            f.write(record)
+    os.replace(tmp_path, path)
+    return len(data)
+
+
+class MappedIndex:
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.slot_count, self.key_count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('%s is not an index file' % path)
+
+    def get(self, key, default=None):
+        key = key.encode('utf-8')
+        mask = self.slot_count - 1
+        slot = _hash(key) & mask
+        while True:
+            offset = SLOT.unpack_from(self._mmap, HEADER.size + slot * SLOT.size)[0]
+            if not offset:
+                return default
+            key_len, value_len = RECORD.unpack_from(self._mmap, offset)
+            start = offset + RECORD.size
+            if key_len == len(key) and self._mmap[start:start + key_len] == key:
+                start += key_len
+                return self._mmap[start:start + value_len].decode('utf-8')
+            slot = (slot + 1) & mask
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __len__(self):
+        return self.key_count
+
+    def items(self):
+        # the records are stored one after the other after the hash table
+        offset = HEADER.size + SLOT.size * self.slot_count
+        end = len(self._mmap)
+        while offset < end:
+            key_len, value_len = RECORD.unpack_from(self._mmap, offset)
+            start = offset + RECORD.size
+            key = self._mmap[start:start + key_len].decode('utf-8')
+            value = self._mmap[start + key_len:start + key_len + value_len].decode('utf-8')
+            yield key, value
+            offset = start + key_len + value_len
+
+    def keys(self):
+        for key, value in self.items():
+            yield key
+
+    def __iter__(self):
+        return self.keys()
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
@@ -0,0 +1,141 @@
+# Copyright 2023 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+# Snapshot of the read-only lookup tables of speedy (countries, banks,
+# products, accounts...), so that the workers of a parallel import attach
+# to the tables built once instead of rebuilding them.
+# Each table is a dict stored in a memory-mapped index (cf mapped_index.py)
+# in the snapshot directory. The values are encoded in JSON. The keys are
+# encoded with repr() and decoded with ast.literal_eval(), so that the int
+# keys (ex: id2code) stay int and the tuple keys (ex: (supplier, code))
+# stay tuples: JSON would turn them into lists, which are not hashable.
+# In a worker, each table is replaced by a SnapshotDict: the reads go to
+# the mapped index, the writes (new banks, categories...) go to an overlay
+# dict that is kept per worker. The overlays of the workers (the deltas)
+# are reconciled at the end of the import.
+# It doesn't depend on the ORM.
+
+from collections.abc import MutableMapping
+import ast
+import json
+import os
+
+from .mapped_index import MappedIndex, build_mapped_index
+
+META_FILE = 'snapshot.json'
+
+
+def encode_key(key):
+    # str, int, float, bool, None or tuple of these
+    return repr(key)
+
+
+def decode_key(key):
+    return ast.literal_eval(key)
+
+
+class SnapshotDict(MutableMapping):
+
+    def __init__(self, index):
+        self.index = index
+        self.overlay = {}
+        self.deleted = set()
+
+    def __getitem__(self, key):
+        if key in self.overlay:
+            return self.overlay[key]
+        if key in self.deleted:
+            raise KeyError(key)
+        value = self.index.get(encode_key(key))
+        if value is None:
+            raise KeyError(key)
+        return json.loads(value)
+
+    def __setitem__(self, key, value):
+        self.deleted.discard(key)
+        self.overlay[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.overlay.pop(key, None)
+        self.deleted.add(key)
+
+    def __iter__(self):
+        yield from self.overlay
+        for key in self.index.keys():
+            key = decode_key(key)
+            if key not in self.overlay and key not in self.deleted:
+                yield key
+
+    def __len__(self):
+        new = sum(1 for key in self.overlay if encode_key(key) not in self.index)
+        deleted = sum(1 for key in self.deleted if encode_key(key) in self.index)
+        return len(self.index) + new - deleted
+
+    def close(self):
+        self.index.close()
+
+
+def _table_file(path):
+    return '%s.idx' % path
+
+
+def export_snapshot(directory, tables):
+    # tables: {path: dict}, path is the dotted path of the table in speedy
+    # (ex: 'country.code2id')
+    os.makedirs(directory, exist_ok=True)
+    for path, table in tables.items():
+        build_mapped_index(
+            os.path.join(directory, _table_file(path)),
+            ((encode_key(key), json.dumps(value)) for (key, value) in table.items()))
+    with open(os.path.join(directory, META_FILE), 'w') as f:
+        json.dump({'tables': sorted(tables)}, f)
+
+
+def attach_snapshot(directory):
+    # Return {path: SnapshotDict}
+    with open(os.path.join(directory, META_FILE)) as f:
+        meta = json.load(f)
+    return {
+        path: SnapshotDict(MappedIndex(os.path.join(directory, _table_file(path))))
+        for path in meta['tables']}
+
+
+def close_snapshot(tables):
+    # Close the mapped indexes of the tables attached by attach_snapshot()
+    for table in tables.values():
+        if isinstance(table, SnapshotDict):
+            table.close()
+
+
+def snapshot_delta(tables):
+    # Return the mutable part of the tables {path: [[key, value], ...]}
+    # as lists of pairs with the encoded keys, to be serialized in JSON
+    return {
+        path: [[encode_key(key), value] for (key, value) in table.overlay.items()]
+        for path, table in tables.items()
+        if isinstance(table, SnapshotDict) and table.overlay}
+
+
+def reconcile_deltas(deltas):
+    # deltas is the list of the results of snapshot_delta() of the workers
+    # Return (merged, conflicts) where merged is {path: {key: value}}
+    # and conflicts is {path: {key: [values]}} for the keys that got
+    # different values in different workers (ex: the same category
+    # created by 2 workers)
+    merged = {}
+    conflicts = {}
+    for delta in deltas:
+        for path, pairs in delta.items():
+            table = merged.setdefault(path, {})
+            for key, value in pairs:
+                key = decode_key(key)
+                if key in table and table[key] != value:
+                    values = conflicts.setdefault(path, {}).setdefault(key, [table[key]])
+                    if value not in values:
+                        values.append(value)
+                else:
+                    table[key] = value
+    return merged, conflicts
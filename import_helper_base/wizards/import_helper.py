@@ -2,9 +2,15 @@
 # @author: Alexis de Lattre <alexis.delattre@akretion.com>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
-from odoo import api, fields, models, tools, _
+from odoo import api, fields, models, tools, Command, _
 from odoo.exceptions import UserError
+from odoo.tools import float_compare, split_every
+from odoo.addons.import_helper_base.tools import identifier
+from odoo.addons.import_helper_base.tools.external_call import ExternalCalls, DEFAULT_TIMEOUTS
+from odoo.addons.import_helper_base.tools.fuzzy import FuzzyIndex, DEFAULT_THRESHOLD
+from odoo.addons.import_helper_base.tools import speedy_snapshot
 from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime
 
 import logging
@@ -15,6 +21,12 @@ try:
 except ImportError:
     logger.debug('Cannot import openai')
 
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+    logger.debug('Cannot import pandas')
+
 
 class ImportHelper(models.TransientModel):
     _name = "import.helper"
@@ -28,6 +40,20 @@ class ImportHelper(models.TransientModel):
         speedy = {
             'aiengine': aiengine,
             'field2label': {},
+            # True when the vals come from _import_columns(), which already
+            # stripped the strings column-at-a-time
+            'columnar': False,
+            # {'ean': {'4006381333931': ('4006381333931', None)}}
+            # filled by the column-at-a-time validation of _import_columns()
+            'identifier_cache': defaultdict(dict),
+            # guard for the calls to VIES, DNS, OpenAI..., cf tools/external_call.py
+            'external': self._prepare_external_calls(),
+            # {'country': FuzzyIndex}, filled by _fuzzy_match()
+            'fuzzy': {},
+            'fuzzy_threshold': float(tools.config.get('import_helper_fuzzy_threshold', DEFAULT_THRESHOLD)),
+            # directory of the snapshot the lookup tables are attached to,
+            # cf _prepare_speedy_from_snapshot()
+            'snapshot': self._context.get('import_helper_snapshot', False),
             'logs': {},
         # 'logs' is a dict {'res.partner': [], 'product.product': []}
         # where the value is a list of dict :
@@ -48,6 +74,272 @@ class ImportHelper(models.TransientModel):
             speedy['openai_tokens'] = 0
         return speedy
 
+    # Prepare speedy for an import and release its resources (the threads
+    # of the external calls) at the end, even if the import fails:
+    # with import_obj._speedy_session() as speedy:
+    #     ...
+    @api.model
+    @contextmanager
+    def _speedy_session(self, aiengine='chatgpt'):
+        speedy = self._prepare_speedy(aiengine=aiengine)
+        try:
+            yield speedy
+        finally:
+            speedy['external'].shutdown()
+
+    # Snapshot of the lookup tables of speedy, for the parallel imports:
+    # the tables are built once by _prepare_speedy(), exported with
+    # _export_speedy_snapshot() and the workers attach to them with
+    # _prepare_speedy_from_snapshot() instead of rebuilding them.
+    # When the context key import_helper_snapshot is set, the inherits of
+    # _prepare_speedy() must not load the tables of _speedy_snapshot_tables().
+    @api.model
+    def _speedy_snapshot_tables(self):
+        # Inherit this method to add the dotted paths of the lookup
+        # tables of speedy (dict with str/int keys and JSON values)
+        return []
+
+    @api.model
+    def _export_speedy_snapshot(self, speedy, directory):
+        tables = {}
+        for path in self._speedy_snapshot_tables():
+            tables[path] = self._speedy_table(speedy, path)
+        speedy_snapshot.export_snapshot(directory, tables)
+        logger.info('Snapshot of %d speedy tables exported in %s', len(tables), directory)
+
+    @api.model
+    def _prepare_speedy_from_snapshot(self, directory, aiengine='chatgpt'):
+        speedy = self.with_context(import_helper_snapshot=directory)._prepare_speedy(aiengine=aiengine)
+        tables = speedy_snapshot.attach_snapshot(directory)
+        for path, table in tables.items():
+            keys = path.split('.')
+            parent = speedy
+            for key in keys[:-1]:
+                parent = parent[key]
+            parent[keys[-1]] = table
+        # to close the memory-mapped files, cf _close_speedy_snapshot()
+        speedy['snapshot_tables'] = tables
+        return speedy
+
+    @api.model
+    def _close_speedy_snapshot(self, speedy):
+        speedy_snapshot.close_snapshot(speedy.pop('snapshot_tables', {}))
+
+    @api.model
+    def _speedy_snapshot_delta(self, speedy):
+        # Return the entries added by this worker to the tables of the snapshot
+        # (new banks, categories...), to be reconciled with
+        # speedy_snapshot.reconcile_deltas()
+        return speedy_snapshot.snapshot_delta({
+            path: self._speedy_table(speedy, path) for path in self._speedy_snapshot_tables()})
+
+    @api.model
+    def _speedy_table(self, speedy, path):
+        table = speedy
+        for key in path.split('.'):
+            table = table[key]
+        return table
+
+    @api.model
+    def _prepare_external_calls(self):
+        # Odoo server configuration file:
+        # import_helper_<service>_timeout (seconds, service = vies, dns, openai)
+        # import_helper_external_max_failures: number of consecutive failures
+        #   after which the service is skipped for the rest of the import
+        # import_helper_external_budget: total number of seconds for all the
+        #   external calls of an import (0 = no limit)
+        config = tools.config
+        timeouts = {}
+        for service, timeout in DEFAULT_TIMEOUTS.items():
+            timeouts[service] = float(config.get('import_helper_%s_timeout' % service, timeout))
+        return ExternalCalls(
+            timeouts=timeouts,
+            max_failures=int(config.get('import_helper_external_max_failures', 5)),
+            budget=float(config.get('import_helper_external_budget', 0)))
+
+    @api.model
+    def _fuzzy_match(self, kind, name, names, speedy, threshold=None):
+        # Approximate match of name among names (ex: the keys of
+        # speedy['industry_name2id']), cf tools/fuzzy.py
+        # The index of 'kind' is built on the first call, with threshold
+        # (default: speedy['fuzzy_threshold'])
+        # Return (matched name, score) or None
+        if kind not in speedy['fuzzy']:
+            speedy['fuzzy'][kind] = FuzzyIndex(names, threshold=threshold or speedy['fuzzy_threshold'])
+        return speedy['fuzzy'][kind].match(name)
+
+    @api.model
+    def _fuzzy_add(self, kind, name, speedy):
+        # to call when a new record is created during the import
+        if kind in speedy['fuzzy']:
+            speedy['fuzzy'][kind].add(name)
+
+    @api.model
+    def _normalize_identifier(self, kind, value, speedy):
+        # Return (clean_value, error_msg), cf tools/identifier.py
+        # Use the results of the column-at-a-time validation when available
+        res = speedy['identifier_cache'][kind].get(value)
+        if res is None:
+            res = identifier.normalize(kind, value)
+        return res
+
+    @api.model
+    def _import_columns(self, model, columns, speedy, first_line=1, **kwargs):
+        # Columnar front-end for tabular imports
+        # columns is a dict {key: list of values} (all lists have the same
+        # length), a pandas DataFrame or a pyarrow Table
+        # The normalizations are done column-at-a-time, then each row
+        # is given to the usual row hook (_create_partner(), _create_product()...)
+        if hasattr(columns, 'to_pydict'):  # pyarrow Table
+            if pd is not None:
+                columns = columns.to_pandas()
+            else:
+                columns = columns.to_pydict()
+        if pd is not None and isinstance(columns, pd.DataFrame):
+            columns = self._dataframe2columns(columns)
+        else:
+            columns = self._columns_strip(columns)
+        columns = self._columns_normalize(model, columns, speedy)
+        keys = list(columns.keys())
+        count = 0
+        speedy['columnar'] = True
+        try:
+            for index, row in enumerate(zip(*[columns[key] for key in keys])):
+                vals = dict(zip(keys, row))
+                if not vals.get('line'):
+                    vals['line'] = first_line + index
+                if self._import_column_row(model, vals, speedy, **kwargs):
+                    count += 1
+        finally:
+            speedy['columnar'] = False
+        logger.info('%d %s imported from columns', count, model)
+        return count
+
+    @api.model
+    def _columns_strip(self, columns):
+        res = {}
+        for key, values in columns.items():
+            res[key] = [
+                (value.strip() or False) if isinstance(value, str) else value
+                for value in values]
+        return res
+
+    @api.model
+    def _dataframe2columns(self, df):
+        res = {}
+        for key in df.columns:
+            serie = df[key]
+            if serie.dtype == object or pd.api.types.is_string_dtype(serie.dtype):
+                stripped = serie.str.strip()
+                # the .str accessor gives NaN for non-string values: keep them
+                serie = stripped.where(stripped.notna(), serie).replace('', False)
+            serie = serie.astype(object)
+            res[key] = serie.where(serie.notna(), False).tolist()
+        return res
+
+    @api.model
+    def _columns_normalize(self, model, columns, speedy):
+        # Inherit this method to add column-at-a-time normalizations
+        # for a model. The results of the identifier checks are stored
+        # in speedy['identifier_cache'] and re-used by the row hooks.
+        return columns
+
+    @api.model
+    def _columns_normalize_identifier(self, kind, values, speedy):
+        # The values are first converted to strings in place, so that the
+        # row hooks get the same values as the identifier cache
+        values[:] = self._columns_identifier2str(values)
+        return identifier.normalize_column(
+            kind, values, cache=speedy['identifier_cache'][kind])
+
+    @api.model
+    def _columns_identifier2str(self, values):
+        # A numeric column of identifiers (barcodes...) with empty cells
+        # is read as floats by pandas: 3760123456789.0 -> '3760123456789'
+        # and NaN -> False
+        res = []
+        for value in values:
+            if isinstance(value, float):
+                if value != value:  # NaN
+                    value = False
+                elif value.is_integer():
+                    value = str(int(value))
+                else:
+                    value = str(value)
+            elif isinstance(value, int) and not isinstance(value, bool):
+                value = str(value)
+            res.append(value)
+        return res
+
+    @api.model
+    def _import_column_row(self, model, vals, speedy, **kwargs):
+        # Inherit this method to import one row of _import_columns()
+        raise UserError(_("Import from columns is not supported for model '%s'.") % model)
+
+    @api.model
+    def _bulk_create(self, model, vals_list, chunk_size=1000):
+        record_ids = []
+        for chunk in split_every(chunk_size, vals_list, list):
+            record_ids += self.env[model].create(chunk).ids
+            logger.info('%d/%d %s created', len(record_ids), len(vals_list), model)
+        return self.env[model].browse(record_ids)
+
+    @api.model
+    def _bulk_write(self, model, id2vals, chunk_size=1000):
+        # id2vals is a dict {record_id: vals}
+        # The records that receive identical vals are written together,
+        # so we have one write() per group of records (and per chunk)
+        key2vals = {}
+        key2ids = defaultdict(list)
+        for record_id, vals in id2vals.items():
+            if not vals:
+                continue
+            key = repr(sorted(vals.items()))
+            key2vals[key] = vals
+            key2ids[key].append(record_id)
+        count = 0
+        for key, record_ids in key2ids.items():
+            for chunk in split_every(chunk_size, record_ids, list):
+                self.env[model].browse(chunk).write(key2vals[key])
+                count += len(chunk)
+        logger.info('%d %s updated with %d distinct vals', count, model, len(key2vals))
+        return count
+
+    @api.model
+    def _diff_vals(self, model, vals, current):
+        # Return the part of vals (for write()) that differs from current,
+        # which is the result of read(load=None) on the record
+        diff = {}
+        model_fields = self.env[model]._fields
+        for key, value in vals.items():
+            field = model_fields.get(key)
+            if field is None or key not in current:
+                diff[key] = value
+                continue
+            old_value = current[key]
+            if field.type in ('one2many', 'many2many'):
+                # we can only compare Command.set(); the other commands are always written
+                if (
+                        isinstance(value, list) and len(value) == 1
+                        and value[0][0] == Command.SET
+                        and set(value[0][2]) == set(old_value)):
+                    continue
+            elif field.type in ('float', 'monetary'):
+                digits = field.type == 'float' and field.get_digits(self.env)
+                precision_digits = digits and digits[1] or 6
+                if not float_compare(value or 0, old_value or 0, precision_digits=precision_digits):
+                    continue
+            elif field.type == 'date':
+                if fields.Date.to_date(value) == old_value:
+                    continue
+            elif field.type == 'datetime':
+                if fields.Datetime.to_datetime(value) == old_value:
+                    continue
+            elif (value or False) == (old_value or False):
+                continue
+            diff[key] = value
+        return diff
+
     def _field_label(self, field, speedy):
         if field not in speedy['field2label']:
             field_split = field.split(',')
@@ -66,6 +358,9 @@ class ImportHelper(models.TransientModel):
         html = '<p><small>For the logs in <span style="color: red">red</span>, the data was <b>not imported</b> in Odoo</small><br/>'
         if speedy.get('aiengine') == 'chatgpt':
             html += '<small><b>%d</b> OpenAI tokens where used</small></p>' % speedy['openai_tokens']
+        external_skipped = speedy.get('external') and speedy['external'].skipped or speedy.get('external_skipped')
+        for service, count in (external_skipped or {}).items():
+            html += '<p style="color: darkorange"><small><b>%d</b> %s checks were skipped (service unavailable or time budget exhausted)</small></p>' % (count, service)
         for obj_name, log_list in speedy['logs'].items():
             obj_rec = self.env['ir.model'].search([('model', '=', obj_name)], limit=1)
             assert obj_rec
@@ -111,16 +406,46 @@ class ImportHelper(models.TransientModel):
         return html
 
     def _result_action(self, speedy):
+        speedy['external'].shutdown()
+        return self._result_action_html(self._convert_logs2html(speedy))
+
+    def _result_action_html(self, logs_html):
         action = {
             'name': 'Result',
             'type': 'ir.actions.act_window',
             'res_model': 'import.helper',
             'view_mode': 'form',
             'target': 'new',
-            'context': dict(self._context, default_logs=self._convert_logs2html(speedy)),
+            'context': dict(self._context, default_logs=logs_html),
             }
         return action
 
+    # Import entry points that can be run in background jobs:
+    # {method name: mode}. The method is called with (vals, speedy, **kwargs)
+    # for each vals if mode='row' or with (vals_list, speedy, **kwargs)
+    # for each chunk if mode='batch'.
+    # Inherit this method to add the entry points of a module.
+    @api.model
+    def _import_job_methods(self):
+        return {}
+
+    # Run an import in background jobs: vals_list is split in chunks,
+    # each chunk is processed in its own transaction by the cron workers
+    # (or by queue_job if installed). method is the name of an entry point
+    # of _import_job_methods() (ex: '_create_partner', '_upsert_products').
+    # vals_list and kwargs must be serializable in JSON (datetimes and
+    # dates are supported).
+    # With snapshot=True, the lookup tables of speedy are built once and
+    # the chunks attach to the snapshot (cf _export_speedy_snapshot())
+    # Return the import.helper.job
+    @api.model
+    def _submit_import_job(
+            self, method, vals_list, mode=False, chunk_size=1000, aiengine='chatgpt',
+            name=False, snapshot=False, **kwargs):
+        return self.env['import.helper.job']._submit(
+            method, vals_list, mode=mode, chunk_size=chunk_size, aiengine=aiengine,
+            name=name, snapshot=snapshot, kwargs=kwargs)
+
     def _prepare_create_date(self, vals, speedy):
         create_date = vals.get('create_date')
         create_date_dt = False
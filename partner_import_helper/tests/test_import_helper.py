@@ -2,7 +2,9 @@
 # @author: Alexis de Lattre <alexis.delattre@akretion.com>
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html).
 
-from odoo.tests.common import SavepointCase
+from datetime import datetime
+
+from odoo.tests.common import SavepointCase, TransactionCase, new_test_user
 
 
 class TestBaseImportHelper(SavepointCase):
@@ -24,3 +26,196 @@ class TestBaseImportHelper(SavepointCase):
         self.assertEqual(country_id, self.env.ref('base.us').id)
         country_id = rpo._match_country("España", speeddict)
         self.assertEqual(country_id, self.env.ref('base.es').id)
+
+
+class TestPartnerImport(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.env = cls.env(context=dict(cls.env.context, tracking_disable=True))
+        cls.iho = cls.env['import.helper']
+
+    def _partner_vals(self, **kwargs):
+        vals = {
+            'line': 2,
+            'name': 'Test Upsert Corp',
+            'is_company': True,
+            'ref': 'TEST-UPS-1',
+            'email': 'contact@akretion.com',
+            'child_ids': [(0, 0, {'name': 'John Test', 'email': 'john@akretion.com'})],
+            }
+        vals.update(kwargs)
+        return vals
+
+    def test_upsert_partners(self):
+        rpo = self.env['res.partner']
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        res = self.iho._upsert_partners(
+            [self._partner_vals()], speedy, email_check_deliverability=False)
+        self.assertEqual(res, {'create': 1, 'update': 0, 'noop': 0})
+        partner = rpo.search([('ref', '=', 'TEST-UPS-1')])
+        self.assertEqual(len(partner), 1)
+        self.assertEqual(partner.child_ids.mapped('name'), ['John Test'])
+        # the same partner on 2 lines of the file is created once
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        res = self.iho._upsert_partners([
+            self._partner_vals(ref='TEST-UPS-2', email='other@akretion.com'),
+            self._partner_vals(ref='TEST-UPS-2', email='other@akretion.com', line=3, city='Lyon'),
+            ], speedy, email_check_deliverability=False)
+        self.assertEqual(res['create'], 1)
+        self.assertEqual(rpo.search([('ref', '=', 'TEST-UPS-2')]).city, 'Lyon')
+        # re-import: the partner is updated, the contact is not duplicated
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        res = self.iho._upsert_partners(
+            [self._partner_vals(city='Lyon')], speedy, email_check_deliverability=False)
+        self.assertEqual(res, {'create': 0, 'update': 1, 'noop': 0})
+        self.assertEqual(partner.city, 'Lyon')
+        self.assertEqual(partner.child_ids.mapped('name'), ['John Test'])
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        res = self.iho._upsert_partners(
+            [self._partner_vals(city='Lyon')], speedy, email_check_deliverability=False)
+        self.assertEqual(res, {'create': 0, 'update': 0, 'noop': 1})
+        self.assertEqual(rpo.search_count([('ref', '=', 'TEST-UPS-1')]), 1)
+
+    def test_upsert_partners_invalid_vat(self):
+        # the values reset by the validation don't overwrite the values
+        # of the existing partner
+        partner = self.env['res.partner'].create({
+            'name': 'Test VAT Corp',
+            'is_company': True,
+            'ref': 'TEST-VAT-1',
+            'vat': 'FR40303265045',
+            'country_id': self.env.ref('base.fr').id,
+            'city': 'Paris',
+            })
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        res = self.iho._upsert_partners([{
+            'line': 2,
+            'name': 'Test VAT Corp',
+            'is_company': True,
+            'ref': 'TEST-VAT-1',
+            'vat': 'FR40303265046',
+            'country_name': 'Zzyzx',
+            'city': 'Lyon',
+            }], speedy, email_check_deliverability=False)
+        self.assertEqual(res, {'create': 0, 'update': 1, 'noop': 0})
+        self.assertEqual(partner.city, 'Lyon')
+        self.assertEqual(partner.vat, 'FR40303265045')
+        self.assertEqual(partner.country_id, self.env.ref('base.fr'))
+        self.assertIn(
+            'res.partner,vat',
+            [log['field'] for log in speedy['logs']['res.partner'] if log.get('reset')])
+        # an empty value given by the file is written
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        self.iho._upsert_partners([{
+            'line': 2, 'name': 'Test VAT Corp', 'ref': 'TEST-VAT-1', 'city': False,
+            }], speedy, email_check_deliverability=False)
+        self.assertFalse(partner.city)
+        self.assertEqual(partner.vat, 'FR40303265045')
+
+    def test_create_partners(self):
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        vals_list = [
+            self._partner_vals(ref='TEST-BATCH-%d' % i, line=i, child_ids=[
+                (0, 0, {'name': 'Contact %d-%d' % (i, j)}) for j in (1, 2)])
+            for i in (2, 3)]
+        vals_list[1]['email'] = 'not an email'
+        partners = self.iho._create_partners(
+            vals_list, speedy, email_check_deliverability=False)
+        self.assertEqual(len(partners), 2)
+        for partner, i in zip(partners, (2, 3)):
+            self.assertEqual(partner.ref, 'TEST-BATCH-%d' % i)
+            self.assertEqual(
+                sorted(partner.child_ids.mapped('name')),
+                ['Contact %d-1' % i, 'Contact %d-2' % i])
+        self.assertEqual(partners[0].email, 'contact@akretion.com')
+        self.assertFalse(partners[1].email)
+        # the wrong e-mail is logged on the line of the partner
+        logs = [log for log in speedy['logs']['res.partner'] if log['field'] == 'res.partner,email']
+        self.assertEqual(len(logs), 1)
+        self.assertEqual(logs[0]['vals']['line'], 3)
+
+    def test_create_partners_duplicates(self):
+        rpo = self.env['res.partner']
+        existing = rpo.create({'name': 'Test Duplicate Gamma', 'zip': '38999', 'is_company': True})
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        vals_list = [
+            {'line': 2, 'name': 'Test Duplicate Alpha', 'zip': '38999', 'is_company': True},
+            # duplicate of line 2, in the same chunk
+            {'line': 3, 'name': 'Test Duplicate Alpha SARL', 'zip': '38999', 'is_company': True},
+            {'line': 4, 'name': 'Test Duplicate Beta', 'zip': '38999', 'is_company': True},
+            # duplicate of an existing partner
+            {'line': 5, 'name': 'Test Duplicate Gamma', 'zip': '38999', 'is_company': True},
+            ]
+        partners = self.iho._create_partners(
+            vals_list, speedy, email_check_deliverability=False, duplicate_mode='skip')
+        self.assertEqual(partners.mapped('name'), ['Test Duplicate Alpha', 'Test Duplicate Beta'])
+        logs = [log for log in speedy['logs']['res.partner'] if log['field'] == 'res.partner,name']
+        self.assertEqual([log['vals']['line'] for log in logs], [3, 5])
+        self.assertTrue(all(log['reset'] for log in logs))
+        self.assertIn('of line 2', logs[0]['msg'])
+        self.assertIn('ID %d' % existing.id, logs[1]['msg'])
+        # the partners created by the previous chunks are in the index
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        partners = self.iho._create_partners([
+            {'line': 2, 'name': 'Test Duplicate Delta', 'zip': '38999', 'is_company': True},
+            {'line': 3, 'name': 'Test Duplicate Delta SARL', 'zip': '38999', 'is_company': True},
+            ], speedy, email_check_deliverability=False, duplicate_mode='skip', chunk_size=1)
+        self.assertEqual(partners.mapped('name'), ['Test Duplicate Delta'])
+
+    def test_import_partner_banks(self):
+        rpbo = self.env['res.partner.bank']
+        partner = self.env['res.partner'].create({'name': 'Test Bank Partner', 'ref': 'TEST-BANK-1'})
+        contact = self.env['res.partner'].create({'name': 'Test Bank Contact', 'parent_id': partner.id})
+        unknown_id = self.env['res.partner'].with_context(active_test=False).search(
+            [], order='id desc', limit=1).id + 1000
+        rows = [
+            {'line': 2, 'ref': 'TEST-BANK-1', 'iban': 'FR14 2004 1010 0505 0001 3M02 606',
+             'bic': 'TESTFRPP', 'bank_name': 'Test Bank'},
+            {'line': 3, 'ref': 'TEST-BANK-UNKNOWN', 'iban': 'FR7630006000011234567890189'},
+            {'line': 4, 'ref': 'TEST-BANK-1', 'iban': 'FR7630006000011234567890188'},
+            {'line': 5, 'partner_id': str(partner.id), 'iban': 'FR7630006000011234567890189'},
+            {'line': 6, 'partner_id': contact.id, 'iban': 'FR7630006000011234567890189'},
+            {'line': 7, 'partner_id': unknown_id, 'iban': 'FR7630006000011234567890189'},
+            ]
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        res = self.iho._import_partner_banks([dict(row) for row in rows], speedy)
+        self.assertEqual(res, {'create': 2, 'update': 0, 'noop': 0})
+        bank_accounts = rpbo.search([('partner_id', '=', partner.id)], order='id')
+        self.assertEqual(
+            bank_accounts.mapped('sanitized_acc_number'),
+            ['FR1420041010050500013M02606', 'FR7630006000011234567890189'])
+        self.assertEqual(bank_accounts[0].bank_id.bic, 'TESTFRPP')
+        self.assertFalse(rpbo.search_count([('partner_id', 'in', (contact.id, unknown_id))]))
+        # the unknown partners, the contact and the wrong IBAN are logged
+        self.assertEqual(
+            sorted(log['vals']['line'] for log in speedy['logs']['res.partner.bank'] if log.get('reset')),
+            [3, 4, 6, 7])
+        # re-import: nothing is created
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        res = self.iho._import_partner_banks([dict(row) for row in rows], speedy)
+        self.assertEqual(res, {'create': 0, 'update': 0, 'noop': 2})
+        self.assertEqual(rpbo.search_count([('partner_id', '=', partner.id)]), 2)
+        self.assertEqual(self.env['res.bank'].search_count([('bic', '=', 'TESTFRPP')]), 1)
+
+    def test_import_job(self):
+        user = new_test_user(
+            self.env, login='partner_import_job_user',
+            groups='base.group_user,base.group_partner_manager')
+        vals_list = [
+            {'line': i, 'name': 'Test Job Partner %d' % i, 'create_date': datetime(2021, 3, i)}
+            for i in (2, 3)]
+        job = self.iho.with_user(user)._submit_import_job(
+            '_create_partner', vals_list, chunk_size=1, name='Test job', aiengine=False,
+            email_check_deliverability=False)
+        self.assertEqual(job.user_id, user)
+        self.assertEqual(job.chunk_count, 2)
+        for chunk in job.sudo().chunk_ids:
+            chunk._process()
+        self.assertEqual(job.state, 'done')
+        partners = self.env['res.partner'].search([('name', 'like', 'Test Job Partner')], order='name')
+        self.assertEqual(len(partners), 2)
+        partners.invalidate_recordset(['create_date'])
+        self.assertEqual(partners.mapped('create_uid'), user)
+        self.assertEqual(partners.mapped('create_date'), [datetime(2021, 3, 2), datetime(2021, 3, 3)])
@@ -2,22 +2,41 @@
 # @author: Alexis de Lattre <alexis.delattre@akretion.com>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
-from odoo import api, models, Command, _
+from odoo import api, models, tools, Command, _
 from odoo.exceptions import UserError
+from odoo.tools import split_every
 from odoo.addons.phone_validation.tools import phone_validation
+from odoo.addons.import_helper_base.tools import fuzzy, identifier
+from odoo.addons.import_helper_base.tools.external_call import ExternalServiceSkipped
+from odoo.addons.import_helper_base.tools.mapped_index import MappedIndex, build_mapped_index
 
+import io
 import re
+import zipfile
 from unidecode import unidecode
 import pycountry
-from stdnum.eu.vat import is_valid as vat_is_valid, check_vies
-from stdnum.iban import is_valid as iban_is_valid
-from stdnum.fr.siret import is_valid as siret_is_valid
-from stdnum.fr.siren import is_valid as siren_is_valid
+from stdnum.eu.vat import check_vies
 from email_validator import validate_email, EmailNotValidError
 
 import logging
 logger = logging.getLogger(__name__)
 
+# Separator of the keys and values of the GeoNames zip index
+GEONAMES_SEP = '\x1f'
+# Key of the GeoNames zip index that contains the list of countries
+GEONAMES_COUNTRIES_KEY = '\x00countries'
+# Similarity threshold of the approximate match of the country names:
+# stricter than the default threshold because a wrong country is worse
+# than asking ChatGPT
+FUZZY_COUNTRY_THRESHOLD = 0.85
+# For these domains, the duplicate detection uses the full e-mail
+WEBMAIL_DOMAINS = (
+    'gmail.com', 'googlemail.com', 'yahoo.com', 'yahoo.fr', 'hotmail.com',
+    'hotmail.fr', 'outlook.com', 'outlook.fr', 'live.com', 'live.fr', 'msn.com',
+    'icloud.com', 'me.com', 'aol.com', 'orange.fr', 'wanadoo.fr', 'free.fr',
+    'sfr.fr', 'laposte.net', 'gmx.fr', 'gmx.de', 'web.de', 'protonmail.com',
+    )
+
 
 class ImportHelper(models.TransientModel):
     _inherit = 'import.helper'
@@ -56,33 +75,26 @@ class ImportHelper(models.TransientModel):
                 },
             },
             'industry_name2id': {},
+            # {'vat': {'FR40303265045': partner_id}, ...}
+            # filled by _prepare_partner_match_index()
+            'partner_match': {},
             'fiscal_position': {},
             # _phone_get_number_fields() is a method of phone_validation that return ['phone', 'mobile']
             'phone_fields': self.env['res.partner']._phone_get_number_fields(),
+            # (country code, zip) -> cities, cf _build_geonames_zip_index()
+            'geonames': False,
+            'geonames_countries': set(),
         })
-        cyd = speedy['country']
-        code2to3 = {}
-        for country in pycountry.countries:
-            code2to3[country.alpha_2] = country.alpha_3
-        for country in self.env['res.country'].search_read([], ['code', 'name']):
-            cyd['code2id'][country['code']] = country['id']
-            cyd['id2code'][country['id']] = country['code']
-            cyd['code2name'][country['code']] = country['name']
-            code3 = code2to3.get(country['code'])
-            if code3:
-                cyd['code2id'][code3] = country['id']
-                cyd['code2name'][code3] = country['name']
-        for bank in self.env['res.bank'].with_context(active_test=False).search_read([('bic', '!=', False)], ['name', 'bic']):
-            bic = bank['bic'].upper()
-            speedy['bank']['bic2id'][bic] = bank['id']
-            speedy['bank']['bic2name'][bic] = bank['name']
-        for lang in self.env['res.lang'].search([]):
-            logger.info('Working on lang %s', lang.code)
-            for country in self.env['res.country'].with_context(lang=lang.code).search_read([], ['code', 'name']):
-                country_name_match = self._prepare_country_name_match(country['name'])
-                cyd['name2code'][country_name_match] = country['code']
-        for indus in self.env['res.partner.industry'].with_context(active_test=False).search_read([('name', '!=', False)], ['name']):
-            speedy['industry_name2id'][indus['name']] = indus['id']
+        geonames_zip_index = tools.config.get('geonames_zip_index')
+        if geonames_zip_index:
+            speedy['geonames'] = MappedIndex(geonames_zip_index)
+            speedy['geonames_countries'] = set(
+                speedy['geonames'].get(GEONAMES_COUNTRIES_KEY, '').split(GEONAMES_SEP))
+            logger.info(
+                'GeoNames zip index %s loaded (%d countries)',
+                geonames_zip_index, len(speedy['geonames_countries']))
+        if not speedy['snapshot']:
+            self._prepare_speedy_partner_lookup_tables(speedy)
         if (
                 self.env.company.country_id.code == 'FR' and
                 hasattr(self.env['res.partner'], 'property_account_position_id') and
@@ -110,6 +122,39 @@ class ImportHelper(models.TransientModel):
                     speedy['fiscal_position']['id2name'][fp['id']] = fp['name']
         return speedy
 
+    # Tables of _speedy_snapshot_tables()
+    @api.model
+    def _prepare_speedy_partner_lookup_tables(self, speedy):
+        cyd = speedy['country']
+        code2to3 = {}
+        for country in pycountry.countries:
+            code2to3[country.alpha_2] = country.alpha_3
+        for country in self.env['res.country'].search_read([], ['code', 'name']):
+            cyd['code2id'][country['code']] = country['id']
+            cyd['id2code'][country['id']] = country['code']
+            cyd['code2name'][country['code']] = country['name']
+            code3 = code2to3.get(country['code'])
+            if code3:
+                cyd['code2id'][code3] = country['id']
+                cyd['code2name'][code3] = country['name']
+        for bank in self.env['res.bank'].with_context(active_test=False).search_read([('bic', '!=', False)], ['name', 'bic']):
+            bic = bank['bic'].upper()
+            speedy['bank']['bic2id'][bic] = bank['id']
+            speedy['bank']['bic2name'][bic] = bank['name']
+        for lang in self.env['res.lang'].search([]):
+            logger.info('Working on lang %s', lang.code)
+            for country in self.env['res.country'].with_context(lang=lang.code).search_read([], ['code', 'name']):
+                country_name_match = self._prepare_country_name_match(country['name'])
+                cyd['name2code'][country_name_match] = country['code']
+        for indus in self.env['res.partner.industry'].with_context(active_test=False).search_read([('name', '!=', False)], ['name']):
+            speedy['industry_name2id'][indus['name']] = indus['id']
+
+    @api.model
+    def _speedy_snapshot_tables(self):
+        return super()._speedy_snapshot_tables() + [
+            'country.name2code', 'country.code2id', 'country.id2code', 'country.code2name',
+            'bank.bic2id', 'bank.bic2name', 'industry_name2id']
+
     @api.model
     def _prepare_country_name_match(self, country_name):
         assert country_name
@@ -118,11 +163,263 @@ class ImportHelper(models.TransientModel):
         assert country_name_match
         return country_name_match
 
+    @api.model
+    def _columns_normalize(self, model, columns, speedy):
+        columns = super()._columns_normalize(model, columns, speedy)
+        if model == 'res.partner':
+            for kind in ('vat', 'iban', 'siren', 'siret'):
+                if columns.get(kind):
+                    self._columns_normalize_identifier(kind, columns[kind], speedy)
+            if columns.get('bic'):
+                columns['bic'] = [
+                    bic.upper() if isinstance(bic, str) else bic
+                    for bic in columns['bic']]
+        return columns
+
+    @api.model
+    def _import_job_methods(self):
+        res = super()._import_job_methods()
+        res.update({
+            '_create_partner': 'row',
+            '_create_partners': 'batch',
+            '_upsert_partners': 'batch',
+            '_import_partner_banks': 'batch',
+            })
+        return res
+
+    @api.model
+    def _import_column_row(self, model, vals, speedy, **kwargs):
+        if model == 'res.partner':
+            return self._create_partner(vals, speedy, **kwargs)
+        return super()._import_column_row(model, vals, speedy, **kwargs)
+
     def _create_partner(self, vals, speedy, email_check_deliverability=True, create_bank=True):
         rvals = self._prepare_partner_vals(
             vals, speedy, email_check_deliverability=email_check_deliverability,
             create_bank=create_bank)
         partner = self.env['res.partner'].create(rvals)
+        self._post_create_partner(partner, vals, speedy)
+        return partner
+
+    # Batch version of _create_partner(): the partners are created by chunks.
+    # With flatten_contacts=True, the contacts (child_ids) are not created
+    # inside the create() of their parent: all the contacts of a chunk are
+    # created in one create() after the parents, with parent_id set.
+    # duplicate_mode: 'log' or 'skip' to detect the probable duplicates of
+    # existing partners or of previous lines, cf _detect_partner_duplicates()
+    def _create_partners(
+            self, vals_list, speedy, email_check_deliverability=True, create_bank=True,
+            flatten_contacts=True, duplicate_mode=False, duplicate_threshold=0.8,
+            chunk_size=1000):
+        assert duplicate_mode in (False, 'log', 'skip')
+        if duplicate_mode:
+            self._prepare_partner_duplicate_index(speedy)
+        partner_ids = []
+        for chunk in split_every(chunk_size, vals_list, list):
+            to_create = []
+            for vals in chunk:
+                rvals = self._prepare_partner_vals(
+                    vals, speedy, email_check_deliverability=email_check_deliverability,
+                    create_bank=create_bank)
+                to_create.append((vals, rvals))
+            if duplicate_mode:
+                index2dup = self._detect_partner_duplicates(
+                    [vals for (vals, rvals) in to_create], speedy, threshold=duplicate_threshold)
+                self._log_partner_duplicates(to_create, index2dup, duplicate_mode, speedy)
+                if duplicate_mode == 'skip' and index2dup:
+                    to_create = [
+                        item for (index, item) in enumerate(to_create) if index not in index2dup]
+                if not to_create:
+                    continue
+            partner_ids += self._create_partners_chunk(
+                to_create, speedy, flatten_contacts=flatten_contacts).ids
+        return self.env['res.partner'].browse(partner_ids)
+
+    def _log_partner_duplicates(self, to_create, index2dup, duplicate_mode, speedy):
+        for index, (partner_id, score, dup_index) in index2dup.items():
+            vals = to_create[index][0]
+            if partner_id:
+                msg = "Probable duplicate of the existing partner '%s' (ID %d, similarity %d%%)" % (
+                    speedy['partner_dup']['id2name'][partner_id], partner_id, score * 100)
+            else:
+                dup_vals = to_create[dup_index][0]
+                msg = "Probable duplicate of the partner '%s' of line %s (similarity %d%%)" % (
+                    dup_vals.get('name'), dup_vals.get('line'), score * 100)
+            speedy['logs']['res.partner'].append({
+                'msg': msg + (duplicate_mode == 'skip' and ': PARTNER NOT IMPORTED' or ''),
+                'value': vals.get('name'),
+                'vals': vals,
+                'field': 'res.partner,name',
+                'reset': duplicate_mode == 'skip',
+                })
+
+    # to_create is a list of (vals, rvals), cf _prepare_partner_vals()
+    # When the phones/emails are stored in phone_ids (speedy['o2m_phone']),
+    # the res.partner.phone of the partners and contacts of the chunk are
+    # created in one create() after the partners, so that the phone/email
+    # fields of the partners are computed once per chunk.
+    def _create_partners_chunk(self, to_create, speedy, flatten_contacts=True):
+        rpo = self.env['res.partner']
+        phone_vals_list = []  # [(partner, phone vals)], filled by _pop_phone_commands()
+        children = []  # [(parent index, child vals)]
+        if flatten_contacts:
+            for index, (vals, rvals) in enumerate(to_create):
+                for command in rvals.pop('child_ids', None) or []:
+                    if command[0] == Command.CREATE:
+                        children.append((index, command[2]))
+                    else:
+                        rvals.setdefault('child_ids', []).append(command)
+        parent_phones = [self._pop_phone_commands(rvals, speedy) for (vals, rvals) in to_create]
+        partners = rpo.create([rvals for (vals, rvals) in to_create])
+        for partner, (vals, rvals), phones in zip(partners, to_create, parent_phones):
+            self._post_create_partner(partner, vals, speedy)
+            phone_vals_list += [(partner, phone_vals) for phone_vals in phones]
+        if children:
+            child_rvals_list = []
+            child_phones = []
+            for index, child_vals in children:
+                # the logs of the contact are displayed under the line of the parent
+                child_vals.setdefault('line', to_create[index][0].get('line'))
+                child_rvals = self._prepare_child_partner_rvals(child_vals, speedy)
+                child_rvals['parent_id'] = partners[index].id
+                child_phones.append(self._pop_phone_commands(child_rvals, speedy))
+                child_rvals_list.append(child_rvals)
+            childs = rpo.create(child_rvals_list)
+            for child, (index, child_vals), phones in zip(childs, children, child_phones):
+                child_vals['id'] = child.id
+                child_vals['display_name'] = child.display_name
+                phone_vals_list += [(child, phone_vals) for phone_vals in phones]
+            logger.info('%d partners and %d contacts created', len(partners), len(childs))
+        if phone_vals_list:
+            self.env['res.partner.phone'].create([
+                dict(phone_vals, partner_id=partner.id)
+                for (partner, phone_vals) in phone_vals_list])
+            logger.info('%d phones/emails created', len(phone_vals_list))
+        return partners
+
+    @api.model
+    def _pop_phone_commands(self, rvals, speedy):
+        # Remove the creation commands of phone_ids from rvals
+        # and return the list of vals of the phones to create
+        phones = []
+        if not speedy['o2m_phone']:
+            return phones
+        commands = []
+        for command in rvals.pop('phone_ids', None) or []:
+            if command[0] == Command.CREATE:
+                phones.append(command[2])
+            else:
+                commands.append(command)
+        if commands:
+            rvals['phone_ids'] = commands
+        return phones
+
+    @api.model
+    def _prepare_child_partner_rvals(self, child_vals, speedy):
+        # child_vals has been processed by _prepare_parent_child_partner_vals()
+        rvals = dict(child_vals)
+        for key in ['line', 'create_date', 'title_code', 'country_name']:
+            rvals.pop(key, None)
+        return rvals
+
+    # Load the blocking keys of the existing partners (only the parent
+    # partners) used to detect duplicates, with a single narrow SQL query.
+    # Blocking keys: VAT, SIRET, e-mail (domain + start of the name, or the
+    # full e-mail for webmail domains), zip + start of the name.
+    def _prepare_partner_duplicate_index(self, speedy):
+        if speedy.get('partner_dup'):
+            return
+        rpo = self.env['res.partner']
+        speedy['partner_dup'] = {
+            'key2ids': {},  # (block, key) -> [partner IDs]
+            'id2name': {},
+            }
+        columns = ['id', 'name', 'vat', 'email', 'zip']
+        if 'siret' in rpo._fields and rpo._fields['siret'].store:
+            columns.append('siret')
+        # columns only contains names of stored fields
+        self._cr.execute(
+            "SELECT %s FROM res_partner WHERE parent_id IS NULL AND name IS NOT NULL"
+            % ', '.join(columns))
+        for row in self._cr.dictfetchall():
+            self._partner_duplicate_index_add(row['id'], row, speedy)
+        logger.info(
+            'Partner duplicate index loaded: %d partners, %d keys',
+            len(speedy['partner_dup']['id2name']), len(speedy['partner_dup']['key2ids']))
+
+    def _partner_duplicate_index_add(self, partner_id, vals, speedy):
+        speedy['partner_dup']['id2name'][partner_id] = vals['name']
+        for key in self._partner_duplicate_keys(vals):
+            speedy['partner_dup']['key2ids'].setdefault(key, []).append(partner_id)
+
+    @api.model
+    def _partner_duplicate_keys(self, vals):
+        keys = []
+        name = vals.get('name')
+        compact_name = isinstance(name, str) and fuzzy.normalize(name).replace(' ', '')
+        if vals.get('vat') and isinstance(vals['vat'], str):
+            keys.append(('vat', identifier.clean_alnum(vals['vat'])))
+        if vals.get('siret') and isinstance(vals['siret'], str):
+            keys.append(('siret', identifier.clean_digits(vals['siret'])))
+        email = vals.get('email')
+        if email and isinstance(email, str) and '@' in email and compact_name:
+            email = email.strip().lower()
+            domain = email.rsplit('@', 1)[1]
+            if domain in WEBMAIL_DOMAINS:
+                keys.append(('email', email))
+            else:
+                keys.append(('email_domain', '%s|%s' % (domain, compact_name[:4])))
+        if vals.get('zip') and compact_name:
+            keys.append(('zip_name', '%s|%s' % (str(vals['zip']).replace(' ', '').upper(), compact_name[:4])))
+        return keys
+
+    # vals_list: vals prepared by _prepare_partner_vals()
+    # Return {index in vals_list: (partner_id, score, dup_index)} for the
+    # probable duplicates (score >= threshold) of the existing partners
+    # (dup_index is None) or of a previous line of vals_list (partner_id is
+    # False): the keys of each line that is not a duplicate are added to a
+    # local index as we go. VAT, SIRET and webmail addresses are strong
+    # keys; for the other keys, the score is the similarity of names.
+    def _detect_partner_duplicates(self, vals_list, speedy, threshold=0.8):
+        key2ids = speedy['partner_dup']['key2ids']
+        id2name = speedy['partner_dup']['id2name']
+        key2indexes = {}  # (block, key) -> [index in vals_list]
+        res = {}
+        for index, vals in enumerate(vals_list):
+            keys = self._partner_duplicate_keys(vals)
+            if not keys:
+                continue
+            name = vals.get('name')
+            name_trigrams = isinstance(name, str) and fuzzy.trigrams(fuzzy.normalize(name)) or set()
+            best = (False, 0.0, None)
+            for block, key in keys:
+                for partner_id in key2ids.get((block, key), []):
+                    score = self._partner_duplicate_score(block, name_trigrams, id2name[partner_id])
+                    if score > best[1]:
+                        best = (partner_id, score, None)
+                for dup_index in key2indexes.get((block, key), []):
+                    score = self._partner_duplicate_score(block, name_trigrams, vals_list[dup_index].get('name'))
+                    if score > best[1]:
+                        best = (False, score, dup_index)
+            if best[1] and best[1] >= threshold:
+                res[index] = best
+            else:
+                for key in keys:
+                    key2indexes.setdefault(key, []).append(index)
+        logger.info('%d probable duplicates detected among %d partners', len(res), len(vals_list))
+        return res
+
+    @api.model
+    def _partner_duplicate_score(self, block, name_trigrams, other_name):
+        if block in ('vat', 'siret'):
+            return 1.0
+        elif block == 'email':
+            return 0.9
+        if not name_trigrams or not isinstance(other_name, str):
+            return 0.0
+        return fuzzy.similarity(name_trigrams, fuzzy.trigrams(fuzzy.normalize(other_name)))
+
+    def _post_create_partner(self, partner, vals, speedy):
         create_date_dt = self._prepare_create_date(vals, speedy)
         if create_date_dt:
             self._cr.execute(
@@ -130,8 +427,340 @@ class ImportHelper(models.TransientModel):
                 (create_date_dt, partner.id))
         vals['display_name'] = partner.display_name
         vals['id'] = partner.id
+        if 'partner_match_ids' in speedy and not partner.parent_id:
+            speedy['partner_match_ids'].add(partner.id)
+        if speedy.get('partner_match'):
+            for match_key, value in self._partner_match_values(vals, speedy['partner_match']).items():
+                speedy['partner_match'][match_key].setdefault(value, partner.id)
+        if speedy.get('partner_dup') and vals.get('name'):
+            self._partner_duplicate_index_add(partner.id, vals, speedy)
         logger.info('New partner created: %s ID %d from line %d', partner.display_name, partner.id, vals['line'])
-        return partner
+
+    # Load the indexes used to match the imported partners with the existing
+    # partners (only the parent partners) with a single narrow SQL query
+    # match_keys is a list of keys among 'ref', 'vat', 'siret', 'email'
+    def _prepare_partner_match_index(self, speedy, match_keys=('ref', 'vat', 'siret', 'email')):
+        rpo = self.env['res.partner']
+        match_keys = [
+            key for key in match_keys
+            if key in rpo._fields and rpo._fields[key].store]
+        speedy['partner_match'] = {key: {} for key in match_keys}
+        # IDs of the parent partners, to check the partner IDs given in the file
+        speedy['partner_match_ids'] = set()
+        # match_keys only contains names of stored fields
+        self._cr.execute(
+            "SELECT %s FROM res_partner WHERE parent_id IS NULL ORDER BY id"
+            % ', '.join(['id'] + match_keys))
+        for row in self._cr.fetchall():
+            partner_id = row[0]
+            speedy['partner_match_ids'].add(partner_id)
+            for match_key, value in zip(match_keys, row[1:]):
+                value = value and self._partner_match_normalize(match_key, value)
+                if value:
+                    # if several partners have the same key, the oldest wins
+                    speedy['partner_match'][match_key].setdefault(value, partner_id)
+        logger.info(
+            'Partner match index loaded: %s',
+            ', '.join(['%d %s' % (len(index), key) for key, index in speedy['partner_match'].items()]))
+
+    @api.model
+    def _partner_match_normalize(self, match_key, value):
+        if not isinstance(value, str):
+            return False
+        if match_key == 'vat':
+            return identifier.clean_alnum(value)
+        elif match_key == 'siret':
+            return identifier.clean_digits(value)
+        elif match_key == 'email':
+            return value.strip().lower()
+        return value.strip()
+
+    def _partner_match_values(self, vals, partner_match):
+        res = {}
+        for match_key in partner_match:
+            value = vals.get(match_key) and self._partner_match_normalize(match_key, vals[match_key])
+            if value:
+                res[match_key] = value
+        return res
+
+    def _match_existing_partner(self, vals, speedy):
+        # the order of speedy['partner_match'] is the priority of the keys
+        for match_key, value in self._partner_match_values(vals, speedy['partner_match']).items():
+            partner_id = speedy['partner_match'][match_key].get(value)
+            if partner_id:
+                return partner_id
+        return False
+
+    # Update-or-create mode: vals_list is a list of vals with the same keys
+    # as for _create_partner()
+    # The existing partner is matched on the first key of match_keys
+    # that has a match. Matched partners are updated with the fields that
+    # changed; the contacts, bank accounts and phones are merged with the
+    # existing ones instead of being recreated. Creations are done by batches.
+    def _upsert_partners(
+            self, vals_list, speedy, match_keys=('ref', 'vat', 'siret', 'email'),
+            email_check_deliverability=True, create_bank=True, flatten_contacts=True,
+            chunk_size=1000):
+        rpo = self.env['res.partner']
+        self._prepare_partner_match_index(speedy, match_keys=match_keys)
+        id2update = {}  # {partner_id: (vals, rvals)}
+        to_create = []  # [(vals, rvals)]
+        key2create_index = {}
+        for vals in vals_list:
+            # match on the identifiers of the file, before the validation
+            # resets the invalid ones
+            raw_vals = dict(vals)
+            partner_id = self._match_existing_partner(vals, speedy)
+            match_values = self._partner_match_values(vals, speedy['partner_match'])
+            rvals = self._prepare_partner_vals(
+                vals, speedy, email_check_deliverability=email_check_deliverability,
+                create_bank=create_bank)
+            if partner_id:
+                self._drop_reset_partner_rvals(raw_vals, rvals)
+                if partner_id in id2update:
+                    self._merge_partner_rvals(id2update[partner_id][1], rvals)
+                else:
+                    id2update[partner_id] = (vals, rvals)
+                continue
+            index = next((
+                key2create_index[key] for key in match_values.items()
+                if key in key2create_index), None)
+            if index is not None:
+                self._merge_partner_rvals(to_create[index][1], rvals)
+                continue
+            for key in match_values.items():
+                key2create_index[key] = len(to_create)
+            to_create.append((vals, rvals))
+        # UPDATE
+        id2diff = {}
+        noop = 0
+        for chunk in split_every(chunk_size, list(id2update), list):
+            self._merge_partner_o2m_commands(chunk, id2update, speedy)
+            fields_list = list({
+                key for partner_id in chunk for key in id2update[partner_id][1]})
+            fields_list.append('display_name')
+            for current in rpo.browse(chunk).read(fields_list, load=None):
+                vals, rvals = id2update[current['id']]
+                vals['id'] = current['id']
+                vals['display_name'] = current['display_name']
+                diff = self._diff_vals('res.partner', rvals, current)
+                if diff:
+                    id2diff[current['id']] = diff
+                else:
+                    noop += 1
+        self._bulk_write('res.partner', id2diff, chunk_size=chunk_size)
+        # CREATE
+        for chunk in split_every(chunk_size, to_create, list):
+            self._create_partners_chunk(chunk, speedy, flatten_contacts=flatten_contacts)
+        logger.info(
+            'Partner upsert: %d created, %d updated, %d unchanged',
+            len(to_create), len(id2diff), noop)
+        return {'create': len(to_create), 'update': len(id2diff), 'noop': noop}
+
+    # The values reset by the validation (invalid VAT or SIRET, country not
+    # found...) must not overwrite the values of the existing partner:
+    # only the empty values given by the file are written
+    @api.model
+    def _drop_reset_partner_rvals(self, raw_vals, rvals):
+        for key in [key for (key, value) in rvals.items() if value is False or value is None]:
+            if key not in raw_vals or raw_vals[key]:
+                rvals.pop(key)
+
+    @api.model
+    def _merge_partner_rvals(self, rvals, new_rvals):
+        for key, value in new_rvals.items():
+            if key in ('child_ids', 'bank_ids', 'phone_ids') and rvals.get(key):
+                rvals[key] = rvals[key] + value
+            else:
+                rvals[key] = value
+
+    # Remove the creation commands of contacts, bank accounts and phones
+    # that already exist on the matched partners. Existing records are loaded
+    # with one query per o2m field for the whole chunk.
+    def _merge_partner_o2m_commands(self, partner_ids, id2update, speedy):
+        def key_child(vals):
+            return ((vals.get('name') or '').strip().lower(), (vals.get('email') or '').strip().lower())
+
+        def key_bank(vals):
+            return identifier.clean_alnum(vals.get('acc_number') or '')
+
+        def key_phone(vals):
+            return (vals.get('phone') or '', (vals.get('email') or '').lower())
+
+        o2m_conf = [
+            ('child_ids', 'res.partner', 'parent_id', ['name', 'email'], key_child),
+            ('bank_ids', 'res.partner.bank', 'partner_id', ['acc_number'], key_bank),
+            ]
+        if speedy['o2m_phone']:
+            o2m_conf.append(
+                ('phone_ids', 'res.partner.phone', 'partner_id', ['phone', 'email'], key_phone))
+        for o2m_field, model, parent_field, read_fields, key_func in o2m_conf:
+            to_check = [
+                partner_id for partner_id in partner_ids
+                if id2update[partner_id][1].get(o2m_field)]
+            if not to_check:
+                continue
+            existing = set()
+            for rec in self.env[model].with_context(active_test=False).search_read(
+                    [(parent_field, 'in', to_check)], read_fields + [parent_field], load=None):
+                existing.add((rec[parent_field], key_func(rec)))
+            for partner_id in to_check:
+                rvals = id2update[partner_id][1]
+                commands = []
+                for command in rvals[o2m_field]:
+                    if command[0] == Command.CREATE:
+                        key = (partner_id, key_func(command[2]))
+                        if key in existing:
+                            continue
+                        existing.add(key)
+                    commands.append(command)
+                if commands:
+                    rvals[o2m_field] = commands
+                else:
+                    rvals.pop(o2m_field)
+
+    # rows is a list of dict, one per line of the bank accounts file:
+    # - line: Excel/CSV import ref in logs
+    # - partner_id: ID of the partner, or the keys of match_keys
+    #   ('ref', 'vat', 'siret', 'email') to match the partner
+    # - iban
+    # - bic
+    # - bank_name: used if a new bank is created for the BIC
+    # The IBANs are validated in a single pass over the column. A bank account
+    # with the same IBAN on the same partner is updated (only if the bank
+    # changed), the others are created. The missing banks are created in
+    # one create() if create_bank is True.
+    def _import_partner_banks(
+            self, rows, speedy, match_keys=('ref', 'vat', 'siret', 'email'),
+            create_bank=True, chunk_size=1000):
+        speedy['logs'].setdefault('res.partner.bank', [])
+        if 'partner_match_ids' not in speedy:
+            self._prepare_partner_match_index(speedy, match_keys=match_keys)
+        key2bank, acc_number2partner_ids = self._prepare_partner_bank_index()
+        ibans = self._columns_normalize_identifier(
+            'iban', [row.get('iban') for row in rows], speedy)
+        lines = []  # [(row, partner_id, iban, bic)]
+        missing_bic2row = {}
+        for row, (iban, error) in zip(rows, ibans):
+            log = {
+                'vals': row,
+                'reset': True,
+                }
+            partner_id = self._import_partner_bank_partner(row, log, speedy)
+            if not partner_id:
+                continue
+            if not iban or error:
+                speedy['logs']['res.partner.bank'].append(dict(
+                    log, msg=error or 'Missing IBAN', value=iban or '',
+                    field='res.partner.bank,acc_number'))
+                continue
+            bic = self._import_partner_bank_bic(row, log, speedy, create_bank, missing_bic2row)
+            lines.append((row, partner_id, iban, bic))
+        if missing_bic2row:
+            banks = self._bulk_create('res.bank', [
+                self._prepare_res_bank(row, speedy) for row in missing_bic2row.values()],
+                chunk_size=chunk_size)
+            for bank, (bic, row) in zip(banks, missing_bic2row.items()):
+                speedy['bank']['bic2id'][bic] = bank.id
+                speedy['bank']['bic2name'][bic] = bank.name
+                speedy['logs']['res.partner.bank'].append({
+                    'msg': "BIC not found in Odoo. New bank named '%s' created (ID %d)" % (bank.name, bank.id),
+                    'value': bic,
+                    'vals': row,
+                    'field': 'res.bank,bic',
+                    })
+        key2create = {}  # if the same key is on several lines, the last line wins
+        id2vals = {}
+        noop = 0
+        for row, partner_id, iban, bic in lines:
+            bank_id = bic and speedy['bank']['bic2id'].get(bic) or False
+            key = (iban, partner_id)
+            bank = key2bank.get(key)
+            if bank:
+                diff = {}
+                if not bank['active']:
+                    diff['active'] = True
+                if bank_id and bank_id != bank['bank_id']:
+                    diff['bank_id'] = bank_id
+                if diff:
+                    id2vals.setdefault(bank['id'], {}).update(diff)
+                else:
+                    noop += 1
+                continue
+            other_partner_ids = [pid for pid in acc_number2partner_ids.get(iban, []) if pid != partner_id]
+            if other_partner_ids:
+                speedy['logs']['res.partner.bank'].append({
+                    'msg': 'This IBAN is also used by other partners (IDs %s)' % ', '.join(str(pid) for pid in other_partner_ids),
+                    'value': iban,
+                    'vals': row,
+                    'field': 'res.partner.bank,acc_number',
+                    })
+            key2create[key] = {
+                'partner_id': partner_id,
+                'acc_number': iban,
+                'bank_id': bank_id,
+                }
+        logger.info(
+            'Bank account import: %d to create, %d to update, %d unchanged',
+            len(key2create), len(id2vals), noop)
+        self._bulk_create('res.partner.bank', list(key2create.values()), chunk_size=chunk_size)
+        self._bulk_write('res.partner.bank', id2vals, chunk_size=chunk_size)
+        return {'create': len(key2create), 'update': len(id2vals), 'noop': noop}
+
+    # (sanitized IBAN, partner_id) -> bank account dict
+    # sanitized IBAN -> [partner_id]
+    def _prepare_partner_bank_index(self):
+        key2bank = {}
+        acc_number2partner_ids = {}
+        for bank in self.env['res.partner.bank'].with_context(active_test=False).search_read(
+                [('sanitized_acc_number', '!=', False)],
+                ['sanitized_acc_number', 'partner_id', 'bank_id', 'active'], load=None):
+            key2bank[(bank['sanitized_acc_number'], bank['partner_id'])] = bank
+            acc_number2partner_ids.setdefault(bank['sanitized_acc_number'], []).append(bank['partner_id'])
+        logger.info('%d existing bank accounts loaded', len(key2bank))
+        return key2bank, acc_number2partner_ids
+
+    # The partner_id given in the file must be the ID of an existing
+    # parent partner (the bank accounts are on the commercial entity)
+    def _import_partner_bank_partner(self, row, log, speedy):
+        if row.get('partner_id'):
+            partner_id = row['partner_id']
+            if isinstance(partner_id, float) and partner_id.is_integer():
+                partner_id = int(partner_id)
+            elif isinstance(partner_id, str) and partner_id.strip().isdigit():
+                partner_id = int(partner_id)
+            if partner_id in speedy['partner_match_ids']:
+                return partner_id
+            speedy['logs']['res.partner.bank'].append(dict(
+                log, msg='No parent partner found with this ID', value=row['partner_id'],
+                field='res.partner.bank,partner_id'))
+            return False
+        partner_id = self._match_existing_partner(row, speedy)
+        if not partner_id:
+            speedy['logs']['res.partner.bank'].append(dict(
+                log, msg='No partner found with %s' % ', '.join(speedy['partner_match']),
+                value=' / '.join(str(row[key]) for key in speedy['partner_match'] if row.get(key)),
+                field='res.partner.bank,partner_id'))
+        return partner_id
+
+    def _import_partner_bank_bic(self, row, log, speedy, create_bank, missing_bic2row):
+        bic = isinstance(row.get('bic'), str) and row['bic'].strip().upper()
+        if not bic:
+            return False
+        if len(bic) not in (8, 11):
+            speedy['logs']['res.partner.bank'].append(dict(
+                log, msg='Wrong BIC: length is %d, should be 8 or 11' % len(bic),
+                value=bic, field='res.bank,bic'))
+            return False
+        if bic not in speedy['bank']['bic2id']:
+            if create_bank:
+                missing_bic2row.setdefault(bic, dict(row, bic=bic))
+            else:
+                speedy['logs']['res.partner.bank'].append(dict(
+                    log, msg='BIC not found in Odoo.', value=bic,
+                    field='res.bank,bic', reset=False))
+                return False
+        return bic
 
     @api.model
     def _prepare_parent_child_partner_vals(self, vals, parent_or_child, speedy, email_check_deliverability=True, parent_country_id=False):
@@ -139,9 +768,12 @@ class ImportHelper(models.TransientModel):
         assert isinstance(vals, dict)
         assert isinstance(speedy, dict)
         assert parent_or_child in ('parent', 'child')
-        for key, value in vals.items():
-            if isinstance(value, str):
-                vals[key] = value.strip() or False
+        # when the import is done via _import_columns(), the strings of
+        # the parent have already been stripped
+        if parent_or_child == 'child' or not speedy['columnar']:
+            for key, value in vals.items():
+                if isinstance(value, str):
+                    vals[key] = value.strip() or False
         # STREET
         if vals.get('street2') and not vals.get('street'):
             vals['street'] = vals['street2']
@@ -240,7 +872,8 @@ class ImportHelper(models.TransientModel):
                     'vals': vals,
                     'field': 'res.partner,zip',
                     })
-            # if we have geonames, we could compare it with the DB of zip
+        if country_code and vals.get('zip') and country_code in speedy['geonames_countries']:
+            self._geonames_check_zip_city(vals, country_code, speedy)
 
     # vals is a dict to create a res.partner
     # It must contain a 'line' key, to indicate Excel/CSV import ref in logs
@@ -278,12 +911,10 @@ class ImportHelper(models.TransientModel):
         # VAT
         vat = False
         if vals.get('vat') and (not country_id or country_id in speedy['eu_country_ids']):
-            vat = vals['vat'].upper()
-            # clean VAT
-            vat = ''.join(re.findall(r'[A-Z0-9]+', vat))
-            if not vat_is_valid(vat):
+            vat, error = self._normalize_identifier('vat', vals['vat'], speedy)
+            if error:
                 speedy['logs']['res.partner'].append({
-                    'msg': 'VAT is not valid',
+                    'msg': error,
                     'value': vat,
                     'vals': vals,
                     'field': 'res.partner,vat',
@@ -293,7 +924,7 @@ class ImportHelper(models.TransientModel):
             if vat:
                 try:
                     logger.info('Checking VAT %s on VIES', vat)
-                    res = check_vies(vat)
+                    res = speedy['external'].call('vies', check_vies, vat)
                     if not res.valid:
                         logger.warning('VIES said that VAT %s is not valid', vat)
                         speedy['logs']['res.partner'].append({
@@ -304,6 +935,9 @@ class ImportHelper(models.TransientModel):
                             'reset': True,
                             })
                         vat = False
+                except ExternalServiceSkipped:
+                    # counted in speedy['external'].skipped
+                    pass
                 except Exception as e:
                     logger.warning('Could not perform VIES validation on VAT %s: %s', vat, e)
                     speedy['logs']['res.partner'].append({
@@ -316,11 +950,11 @@ class ImportHelper(models.TransientModel):
         # IBAN / BIC
         iban = False
         if vals.get('iban'):
-            iban = vals['iban'].upper().replace(' ', '')
+            iban, error = self._normalize_identifier('iban', vals['iban'], speedy)
             bic = False
-            if not iban_is_valid(iban):
+            if error:
                 speedy['logs']['res.partner'].append({
-                    'msg': 'IBAN is not valid',
+                    'msg': error,
                     'value': iban,
                     'vals': vals,
                     'field': 'res.partner.bank,acc_number',
@@ -365,10 +999,7 @@ class ImportHelper(models.TransientModel):
                 vals['bank_ids'] = [(0, 0, {'acc_number': iban, 'bank_id': bank_id})]
         # SIREN_OR_SIRET
         if vals.get('siren_or_siret') and hasattr(self.env['res.partner'], 'siret'):
-            siren_or_siret = vals['siren_or_siret']
-            if isinstance(siren_or_siret, int):
-                siren_or_siret = str(siren_or_siret)
-            siren_or_siret = ''.join(re.findall(r'[0-9]+', siren_or_siret))
+            siren_or_siret = identifier.clean_digits(vals['siren_or_siret'])
             if siren_or_siret:
                 if len(siren_or_siret) == 14:
                     vals['siret'] = siren_or_siret
@@ -384,30 +1015,16 @@ class ImportHelper(models.TransientModel):
                         })
         # SIREN
         if vals.get('siren') and hasattr(self.env['res.partner'], 'siren'):
-            siren = vals['siren']
-            if isinstance(siren, int):
-                siren = str(siren)
-            siren = ''.join(re.findall(r'[0-9]+', siren))
-            if len(siren) != 9:
+            siren, error = self._normalize_identifier('siren', vals['siren'], speedy)
+            if error:
                 speedy['logs']['res.partner'].append({
-                    'msg': 'SIREN has a length of %d instead of 9' % len(siren),
+                    'msg': error,
                     'value': siren,
                     'vals': vals,
                     'field': 'res.partner,siren',
                     'reset': True,
                     })
                 siren = False
-                vals.pop('siren')
-            if not siren_is_valid(siren):
-                speedy['logs']['res.partner'].append({
-                    'msg': 'SIREN is not valid (wrong checksum)',
-                    'value': siren,
-                    'vals': vals,
-                    'field': 'res.partner,siren',
-                    'reset': True,
-                    })
-                siren = False
-                vals.pop('siren')
             vals['siren'] = siren
             if siren and vat:
                 if vat[:2] != 'FR':
@@ -426,30 +1043,16 @@ class ImportHelper(models.TransientModel):
                     })
         # SIRET
         if vals.get('siret') and hasattr(self.env['res.partner'], 'siret'):
-            siret = vals['siret']
-            if isinstance(siret, int):
-                siret = str(siret)
-            siret = ''.join(re.findall(r'[0-9]+', siret))
-            if len(siret) != 14:
-                speedy['logs']['res.partner'].append({
-                    'msg': 'SIRET has a length of %d instead of 14' % len(siret),
-                    'value': siret,
-                    'vals': vals,
-                    'field': 'res.partner,siret',
-                    'reset': True,
-                    })
-                siret = False
-                vals.pop('siret')
-            elif not siret_is_valid(siret):
+            siret, error = self._normalize_identifier('siret', vals['siret'], speedy)
+            if error:
                 speedy['logs']['res.partner'].append({
-                    'msg': 'SIRET is not valid (wrong checksum)',
+                    'msg': error,
                     'value': siret,
                     'vals': vals,
                     'field': 'res.partner,siret',
                     'reset': True,
                     })
                 siret = False
-                vals.pop('siret')
             vals['siret'] = siret
             if siret and vat:
                 if vat[:2] != 'FR':
@@ -481,10 +1084,23 @@ class ImportHelper(models.TransientModel):
                 vals.pop('siren')
         # INDUSTRY
         if vals.get('industry_name'):
-            if vals['industry_name'] not in speedy['industry_name2id']:
-                indus = self.env['res.partner.industry'].create(self._prepare_industry(vals, speedy))
-                speedy['industry_name2id'][vals['industry_name']] = indus.id
-            vals['industry_id'] = speedy['industry_name2id'][vals['industry_name']]
+            industry_name = vals['industry_name']
+            if industry_name not in speedy['industry_name2id']:
+                res = self._fuzzy_match('industry', industry_name, speedy['industry_name2id'], speedy)
+                if res:
+                    speedy['logs']['res.partner'].append({
+                        'msg': "To review: approximate match, industry '%s' has been matched with industry '%s' (similarity %d%%)" % (industry_name, res[0], res[1] * 100),
+                        'value': industry_name,
+                        'vals': vals,
+                        'field': 'res.partner,industry_id',
+                        'reset': True,
+                        })
+                    industry_name = res[0]
+                else:
+                    indus = self.env['res.partner.industry'].create(self._prepare_industry(vals, speedy))
+                    speedy['industry_name2id'][industry_name] = indus.id
+                    self._fuzzy_add('industry', industry_name, speedy)
+            vals['industry_id'] = speedy['industry_name2id'][industry_name]
         if 'industry_name' in vals:
             vals.pop('industry_name')
         if country_id:
@@ -542,6 +1158,88 @@ class ImportHelper(models.TransientModel):
             rvals.pop('siret')
         return rvals
 
+    # Build the (country code, zip) -> cities index used to validate the
+    # zip/city of the partners from a GeoNames postal codes dump
+    # (https://download.geonames.org/export/zip/: allCountries.zip, FR.zip...,
+    # the .zip file or the extracted .txt file).
+    # Set the path of the index as 'geonames_zip_index' in the Odoo server
+    # configuration file.
+    @api.model
+    def _build_geonames_zip_index(self, dump_path, index_path):
+        key2cities = {}
+        countries = set()
+        if zipfile.is_zipfile(dump_path):
+            with zipfile.ZipFile(dump_path) as zf:
+                for name in zf.namelist():
+                    if name.endswith('.txt') and name != 'readme.txt':
+                        with zf.open(name) as f:
+                            self._geonames_read_dump(
+                                io.TextIOWrapper(f, encoding='utf-8'), key2cities, countries)
+        else:
+            with open(dump_path, encoding='utf-8') as f:
+                self._geonames_read_dump(f, key2cities, countries)
+        items = [
+            (key, GEONAMES_SEP.join(cities)) for (key, cities) in key2cities.items()]
+        items.append((GEONAMES_COUNTRIES_KEY, GEONAMES_SEP.join(sorted(countries))))
+        count = build_mapped_index(index_path, items)
+        logger.info(
+            'GeoNames zip index %s built with %d zip codes of %d countries',
+            index_path, count - 1, len(countries))
+        return count - 1
+
+    @api.model
+    def _geonames_read_dump(self, lines, key2cities, countries):
+        # tab-separated: country code, postal code, place name, admin names/codes...
+        for line in lines:
+            cols = line.split('\t')
+            if len(cols) < 3 or not cols[0] or not cols[1] or not cols[2]:
+                continue
+            countries.add(cols[0])
+            key = self._geonames_key(cols[0], cols[1])
+            cities = key2cities.setdefault(key, [])
+            if cols[2] not in cities:
+                cities.append(cols[2])
+
+    @api.model
+    def _geonames_key(self, country_code, zipcode):
+        return '%s%s%s' % (country_code, GEONAMES_SEP, str(zipcode).replace(' ', '').upper())
+
+    @api.model
+    def _prepare_city_match(self, city):
+        return ''.join(re.findall(r'[a-z0-9]+', unidecode(city).lower()))
+
+    # Check the zip/city of vals with the GeoNames index: fill the city if
+    # it is empty, replace it by the spelling of GeoNames if it matches,
+    # log a warning if it doesn't match
+    def _geonames_check_zip_city(self, vals, country_code, speedy):
+        cities = speedy['geonames'].get(self._geonames_key(country_code, vals['zip']))
+        log = {
+            'vals': vals,
+            'field': 'res.partner,zip',
+            'value': vals['zip'],
+            }
+        if not cities:
+            speedy['logs']['res.partner'].append(dict(
+                log, msg='Zip code not found in GeoNames for country %s' % country_code))
+            return
+        cities = cities.split(GEONAMES_SEP)
+        city = vals.get('city')
+        if not city or not isinstance(city, str):
+            if len(cities) == 1:
+                vals['city'] = cities[0]
+            else:
+                speedy['logs']['res.partner'].append(dict(
+                    log, msg='City is empty and this zip code has several cities in GeoNames: %s' % ', '.join(cities)))
+            return
+        city_match = self._prepare_city_match(city)
+        for gcity in cities:
+            if self._prepare_city_match(gcity) == city_match:
+                vals['city'] = gcity
+                return
+        speedy['logs']['res.partner'].append(dict(
+            log, field='res.partner,city', value=city,
+            msg="City doesn't match zip code %s. Cities of this zip code in GeoNames: %s" % (vals['zip'], ', '.join(cities))))
+
     def _prepare_industry(self, vals, speedy):
         return {'name': vals['industry_name']}
 
@@ -572,7 +1270,12 @@ class ImportHelper(models.TransientModel):
         if not email:
             return False
         try:
-            validate_email(email, check_deliverability=email_check_deliverability)
+            validate_email(email, check_deliverability=False)
+            if email_check_deliverability:
+                # DNS queries
+                speedy['external'].call(
+                    'dns', validate_email, email, check_deliverability=True,
+                    ok_exceptions=(EmailNotValidError, ))
         except EmailNotValidError as e:
             speedy['logs']['res.partner'].append({
                 'msg': 'Invalid e-mail: %s' % e,
@@ -582,6 +1285,17 @@ class ImportHelper(models.TransientModel):
                 'reset': True,
                 })
             email = False
+        except ExternalServiceSkipped:
+            # counted in speedy['external'].skipped
+            pass
+        except Exception as e:
+            logger.warning('Could not check the deliverability of e-mail %s: %s', email, e)
+            speedy['logs']['res.partner'].append({
+                'msg': 'Could not check the deliverability of the e-mail: %s' % e,
+                'value': email,
+                'vals': vals,
+                'field': 'res.partner,email',
+                })
         return email
 
     def _prepare_res_bank(self, vals, speedy):
@@ -628,15 +1342,34 @@ class ImportHelper(models.TransientModel):
             logger.info("Country '%s' matched on country %s (%s)", country_name, cyd['code2name'][country_code], country_code)
             country_id = cyd['code2id'][country_code]
             return country_id
+        res = self._fuzzy_match(
+            'country', country_name_match, cyd['name2code'], speedy,
+            threshold=float(tools.config.get('import_helper_fuzzy_country_threshold', FUZZY_COUNTRY_THRESHOLD)))
+        if res:
+            country_code = cyd['name2code'][res[0]]
+            logger.info("Country '%s' approximately matched on country %s (%s)", country_name, cyd['code2name'][country_code], country_code)
+            speedy['logs']['res.partner'].append(dict(log, msg="To review: approximate match, country name has been matched with '%s' (similarity %d%%)" % (cyd['code2name'][country_code], res[1] * 100), reset=True))
+            return cyd['code2id'][country_code]
         logger.info("No direct match for country '%s': now asking ChatGPT.", country_name)
         # ask ChatGPT !
         content = """ISO country code of "%s", nothing else""" % country_name
         logger.debug('ChatGPT question: %s', content)
-        chat_completion = speedy['openai_client'].chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": content}],
-            temperature=0,
-        )
+        try:
+            chat_completion = speedy['external'].call(
+                'openai', speedy['openai_client'].chat.completions.create,
+                model="gpt-3.5-turbo",
+                messages=[{"role": "user", "content": content}],
+                temperature=0,
+            )
+        except ExternalServiceSkipped:
+            speedy['logs']['res.partner'].append(
+                dict(log, msg='Country name could not be found in Odoo and ChatGPT is skipped', reset=True))
+            return False
+        except Exception as e:
+            logger.warning('ChatGPT error: %s', e)
+            speedy['logs']['res.partner'].append(
+                dict(log, msg='Country name could not be found in Odoo and ChatGPT failed: %s' % e, reset=True))
+            return False
 
         # print the chat completion
         tokens = chat_completion.usage.total_tokens
@@ -0,0 +1,249 @@
+# Copyright 2023 Akretion France (http://www.akretion.com/)
+# @author: Alexis de Lattre <alexis.delattre@akretion.com>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from odoo.tests.common import TransactionCase
+
+
+class TestProductImport(TransactionCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.env = cls.env(context=dict(cls.env.context, tracking_disable=True))
+        cls.iho = cls.env['import.helper']
+
+    def test_attribute_value_fullname(self):
+        attribute = self.env['product.attribute'].create({
+            'name': 'Test Color',
+            'value_ids': [(0, 0, {'name': 'Red'})],
+            })
+        value = attribute.value_ids
+        self.assertEqual(value.fullname, 'Test Color : Red')
+        attribute.write({'name': 'Test Colour'})
+        self.assertEqual(value.fullname, 'Test Colour : Red')
+        attribute.update_field_translations('name', {'en_US': 'Test Shade'})
+        self.assertEqual(value.fullname, 'Test Shade : Red')
+        # the fullname is always in en_US
+        self.env['res.lang']._activate_lang('fr_FR')
+        value.with_context(lang='fr_FR').write({'name': 'Rouge'})
+        self.assertEqual(value.fullname, 'Test Shade : Red')
+        value.update_field_translations('name', {'en_US': 'Dark red'})
+        self.assertEqual(value.fullname, 'Test Shade : Dark red')
+
+    def test_import_supplierinfo(self):
+        psio = self.env['product.supplierinfo']
+        supplier = self.env['res.partner'].create({'name': 'Test Supplier', 'is_company': True})
+        product = self.env['product.product'].create({
+            'name': 'Test Single', 'default_code': 'TEST-SI-1'})
+        attribute = self.env['product.attribute'].create({
+            'name': 'Test Size',
+            'value_ids': [(0, 0, {'name': 'S'}), (0, 0, {'name': 'M'})],
+            })
+        template = self.env['product.template'].create({
+            'name': 'Test Variants',
+            'attribute_line_ids': [(0, 0, {
+                'attribute_id': attribute.id,
+                'value_ids': [(6, 0, attribute.value_ids.ids)],
+                })],
+            })
+        variant_s, variant_m = template.product_variant_ids
+        variant_s.default_code = 'TEST-SI-S'
+        variant_m.default_code = 'TEST-SI-M'
+        rows = [
+            {'line': 2, 'supplier_id': supplier.id, 'default_code': 'TEST-SI-1',
+             'supplier_price': 10, 'supplier_product_code': 'SUP-1'},
+            {'line': 3, 'supplier_id': supplier.id, 'default_code': 'TEST-SI-S',
+             'supplier_price': 20, 'supplier_product_code': 'SUP-S'},
+            {'line': 4, 'supplier_id': supplier.id, 'default_code': 'TEST-SI-M',
+             'supplier_price': 21, 'supplier_product_code': 'SUP-M'},
+            {'line': 5, 'supplier_id': supplier.id, 'default_code': 'TEST-SI-UNKNOWN',
+             'supplier_price': 1},
+            ]
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        res = self.iho._import_supplierinfo([dict(row) for row in rows], speedy)
+        self.assertEqual(res, {'create': 3, 'update': 0, 'noop': 0})
+        logs = speedy['logs']['product.supplierinfo']
+        self.assertEqual([log['vals']['line'] for log in logs], [5])
+        # the supplierinfo of a template with one variant is on the template,
+        # the supplierinfo of a variant is specific to the variant
+        seller = psio.search([('partner_id', '=', supplier.id), ('product_tmpl_id', '=', product.product_tmpl_id.id)])
+        self.assertEqual(len(seller), 1)
+        self.assertFalse(seller.product_id)
+        sellers = psio.search([('partner_id', '=', supplier.id), ('product_tmpl_id', '=', template.id)])
+        self.assertEqual(sellers.product_id, variant_s | variant_m)
+        # re-import: nothing is created
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        res = self.iho._import_supplierinfo([dict(row) for row in rows], speedy)
+        self.assertEqual(res, {'create': 0, 'update': 0, 'noop': 3})
+        self.assertEqual(psio.search_count([('partner_id', '=', supplier.id)]), 3)
+        # a variant matched by its supplier product code, only its price is updated
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        res = self.iho._import_supplierinfo([{
+            'line': 2, 'supplier_id': supplier.id, 'supplier_product_code': 'SUP-M',
+            'supplier_price': 22}], speedy)
+        self.assertEqual(res, {'create': 0, 'update': 1, 'noop': 0})
+        self.assertEqual(sellers.filtered(lambda s: s.product_id == variant_m).price, 22)
+        self.assertEqual(sellers.filtered(lambda s: s.product_id == variant_s).price, 20)
+        self.assertEqual(psio.search_count([('partner_id', '=', supplier.id)]), 3)
+
+    def test_import_supplierinfo_template_seller(self):
+        # the prices of the variants don't overwrite the supplierinfo
+        # of their template
+        psio = self.env['product.supplierinfo']
+        supplier = self.env['res.partner'].create({'name': 'Test Supplier', 'is_company': True})
+        attribute = self.env['product.attribute'].create({
+            'name': 'Test Size',
+            'value_ids': [(0, 0, {'name': 'S'}), (0, 0, {'name': 'M'})],
+            })
+        template = self.env['product.template'].create({
+            'name': 'Test Variants',
+            'attribute_line_ids': [(0, 0, {
+                'attribute_id': attribute.id,
+                'value_ids': [(6, 0, attribute.value_ids.ids)],
+                })],
+            'seller_ids': [(0, 0, {'partner_id': supplier.id, 'price': 5})],
+            })
+        template_seller = template.seller_ids
+        variant_s, variant_m = template.product_variant_ids
+        variant_s.default_code = 'TEST-SI-S'
+        variant_m.default_code = 'TEST-SI-M'
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        res = self.iho._import_supplierinfo([
+            {'line': 2, 'supplier_id': supplier.id, 'default_code': 'TEST-SI-S', 'supplier_price': 20},
+            {'line': 3, 'supplier_id': supplier.id, 'default_code': 'TEST-SI-M', 'supplier_price': 21},
+            ], speedy)
+        self.assertEqual(res, {'create': 2, 'update': 0, 'noop': 0})
+        self.assertEqual(template_seller.price, 5)
+        self.assertFalse(template_seller.product_id)
+        sellers = psio.search([('partner_id', '=', supplier.id), ('product_id', '!=', False)])
+        self.assertEqual(
+            sorted((seller.product_id.default_code, seller.price) for seller in sellers),
+            [('TEST-SI-M', 21), ('TEST-SI-S', 20)])
+
+    def test_match_or_create_category(self):
+        pco = self.env['product.category']
+        categ = pco.create({'name': 'Test Chaussures homme'})
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        speedy['logs'].setdefault('product.product', [])
+        vals_list = [
+            {'line': 2, 'categ_name': 'Test Chaussures hommes'},
+            {'line': 3, 'categ_name': 'Test Chaussures femme'},
+            {'line': 4, 'categ_name': 'Test Chaussures hommes'},
+            ]
+        categ_ids = [
+            self.iho._match_or_create_category(
+                vals, 'categ_name', 'product_categ2id', 'product.category', 'categ_id',
+                self.iho._prepare_product_category, speedy)
+            for vals in vals_list]
+        # a near miss is not matched with the existing category
+        new_categ = pco.search([('name', '=', 'Test Chaussures femme')])
+        self.assertEqual(len(new_categ), 1)
+        self.assertEqual(categ_ids, [categ.id, new_categ.id, categ.id])
+        # the approximate match is logged as to review on each line
+        logs = speedy['logs']['product.product']
+        self.assertEqual([log['vals']['line'] for log in logs], [2, 4])
+        self.assertTrue(all(log['reset'] for log in logs))
+
+    def test_upsert_products(self):
+        ppo = self.env['product.product']
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        res = self.iho._upsert_products([
+            {'line': 2, 'name': 'Test Upsert 1', 'default_code': 'TEST-UPS-P1', 'list_price': 10},
+            {'line': 3, 'name': 'Test Upsert 2', 'default_code': 'TEST-UPS-P2', 'list_price': 10},
+            # the same product on 2 lines of the file is created once
+            {'line': 4, 'name': 'Test Upsert 2', 'default_code': 'TEST-UPS-P2', 'list_price': 11},
+            ], speedy)
+        self.assertEqual(res, {'create': 2, 'update': 0, 'noop': 0})
+        product = ppo.search([('default_code', '=', 'TEST-UPS-P1')])
+        self.assertEqual(len(product), 1)
+        self.assertEqual(ppo.search([('default_code', '=', 'TEST-UPS-P2')]).list_price, 11)
+        # re-import: the product is updated, the stock_qty is not applied but logged
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        res = self.iho._upsert_products([{
+            'line': 2, 'name': 'Test Upsert 1', 'default_code': 'TEST-UPS-P1',
+            'list_price': 12, 'stock_qty': 5}], speedy)
+        self.assertEqual(res, {'create': 0, 'update': 1, 'noop': 0})
+        self.assertEqual(product.list_price, 12)
+        logs = speedy['logs']['product.product']
+        self.assertEqual(len(logs), 1)
+        self.assertEqual(logs[0]['field'], 'product.product,qty_available')
+        self.assertEqual(logs[0]['value'], 5)
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        res = self.iho._upsert_products([{
+            'line': 2, 'name': 'Test Upsert 1', 'default_code': 'TEST-UPS-P1', 'list_price': 12}], speedy)
+        self.assertEqual(res, {'create': 0, 'update': 0, 'noop': 1})
+        self.assertEqual(ppo.search_count([('default_code', '=', 'TEST-UPS-P1')]), 1)
+
+    def test_upsert_products_conflict(self):
+        # 2 lines with the same barcode but different internal references
+        # are not merged: the second line is logged and skipped
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        res = self.iho._upsert_products([
+            {'line': 2, 'name': 'Test Conflict 1', 'default_code': 'TEST-CONF-1', 'barcode': '3760123456784'},
+            {'line': 3, 'name': 'Test Conflict 2', 'default_code': 'TEST-CONF-2', 'barcode': '3760123456784'},
+            ], speedy)
+        self.assertEqual(res, {'create': 1, 'update': 0, 'noop': 0})
+        product = self.env['product.product'].search([('barcode', '=', '3760123456784')])
+        self.assertEqual(product.default_code, 'TEST-CONF-1')
+        self.assertEqual(product.name, 'Test Conflict 1')
+        logs = speedy['logs']['product.product']
+        self.assertEqual(len(logs), 1)
+        self.assertEqual(logs[0]['vals']['line'], 3)
+        self.assertTrue(logs[0]['reset'])
+
+    def test_import_opening_stock(self):
+        ppo = self.env['product.product']
+        product = ppo.create({'name': 'Test Stock', 'default_code': 'TEST-STOCK-1', 'detailed_type': 'product'})
+        product_lot = ppo.create({
+            'name': 'Test Stock Lot', 'default_code': 'TEST-STOCK-LOT',
+            'detailed_type': 'product', 'tracking': 'lot'})
+        product_serial = ppo.create({
+            'name': 'Test Stock Serial', 'default_code': 'TEST-STOCK-SN',
+            'detailed_type': 'product', 'tracking': 'serial'})
+        stock_location = self.env['stock.warehouse'].search(
+            [('company_id', '=', self.env.company.id)], limit=1).lot_stock_id
+        shelf = self.env['stock.location'].create({
+            'name': 'Test Shelf', 'location_id': stock_location.id, 'usage': 'internal'})
+        rows = [
+            {'line': 2, 'default_code': 'TEST-STOCK-1', 'qty': 10},
+            {'line': 3, 'default_code': 'TEST-STOCK-1', 'location': shelf.complete_name, 'qty': '2,5'},
+            {'line': 4, 'default_code': 'TEST-STOCK-LOT', 'lot': 'LOT-A', 'qty': 3},
+            # added up with the previous line
+            {'line': 5, 'default_code': 'TEST-STOCK-LOT', 'lot': 'LOT-A', 'qty': 2},
+            {'line': 6, 'default_code': 'TEST-STOCK-SN', 'lot': 'SN-1', 'qty': 1},
+            # rejected lines
+            {'line': 7, 'default_code': 'TEST-STOCK-SN', 'lot': 'SN-1', 'qty': 1},
+            {'line': 8, 'default_code': 'TEST-STOCK-SN', 'lot': 'SN-2', 'qty': 2},
+            {'line': 9, 'default_code': 'TEST-STOCK-1', 'qty': 'abc'},
+            {'line': 10, 'default_code': 'TEST-STOCK-1', 'qty': 0},
+            {'line': 11, 'default_code': 'TEST-STOCK-1', 'location': 'Nowhere', 'qty': 1},
+            ]
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        res = self.iho._import_opening_stock(rows, speedy, chunk_size=4)
+        self.assertEqual(res, {'quant': 4, 'lot': 2})
+        self.assertEqual(
+            [log['vals']['line'] for log in speedy['logs']['stock.quant']], [7, 8, 9, 10, 11])
+        self.assertTrue(all(log['reset'] for log in speedy['logs']['stock.quant']))
+        self.assertEqual(product.qty_available, 12.5)
+        self.assertEqual(product.with_context(location=shelf.id).qty_available, 2.5)
+        self.assertEqual(product_lot.qty_available, 5)
+        lot = self.env['stock.lot'].search([('product_id', '=', product_lot.id)])
+        self.assertEqual(lot.name, 'LOT-A')
+        self.assertEqual(product_serial.qty_available, 1)
+        self.assertEqual(
+            self.env['stock.lot'].search([('product_id', '=', product_serial.id)]).mapped('name'),
+            ['SN-1'])
+
+    def test_import_columns_numeric_barcode(self):
+        # a numeric barcode column with an empty cell, as read by pandas
+        speedy = self.iho._prepare_speedy(aiengine=False)
+        count = self.iho._import_columns('product.product', {
+            'name': ['Test Column 1', 'Test Column 2'],
+            'barcode': [3760123456784.0, float('nan')],
+            }, speedy, first_line=2, inventory=False)
+        self.assertEqual(count, 2)
+        product = self.env['product.product'].search([('name', '=', 'Test Column 1')])
+        self.assertEqual(product.barcode, '3760123456784')
+        self.assertFalse(self.env['product.product'].search([('name', '=', 'Test Column 2')]).barcode)
+        self.assertFalse(speedy['logs']['product.product'])
@@ -1,2 +1,2 @@
-#from . import product_attribute_value
+from . import product_attribute_value
 from . import import_helper
@@ -4,8 +4,9 @@
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
 from odoo import api, models, Command, _
-from stdnum.ean import is_valid
 from odoo.exceptions import UserError
+from odoo.tools import float_compare, split_every
+from collections import defaultdict
 from datetime import datetime
 
 import logging
@@ -25,6 +26,9 @@ class ImportHelper(models.TransientModel):
             'product_categ2id': {},
             'product_barcode2name': {},
             'product_default_code2name': {},
+            'product_barcode2id': {},
+            'product_default_code2id': {},
+            'product_id2tmpl_id': {},
             'pos': hasattr(self, 'pos_categ_id'),
             'pos_categ2id': {},
             'account_code2id': {},
@@ -42,6 +46,26 @@ class ImportHelper(models.TransientModel):
             else:
                 logger.warning('Ignoring fiscal classification %s ID %d', fc.display_name, fc.id)
         logger.info('Fiscal classification map: %s', speedy['vat_rate2fc_id'])
+        wh = self.env['stock.warehouse'].search([('company_id', '=', self.env.company.id)], limit=1)
+        if wh:
+            speedy['default_location_id'] = wh.lot_stock_id.id
+        if not speedy['snapshot']:
+            self._prepare_speedy_product_lookup_tables(speedy)
+        route_code2xmlid = {
+            'buy': 'purchase_stock.route_warehouse0_buy',
+            'manufacture': 'mrp.route_warehouse0_manufacture',
+            'mto': 'stock.route_warehouse0_mto',
+            }
+        for route_code, xmlid in route_code2xmlid.items():
+            # I hope raise_if_not_found=False to avoid an error is the module is not installed
+            route = self.env.ref(xmlid, raise_if_not_found=False)
+            if route:
+                speedy["route_code2id"][route_code] = route.id
+        return speedy
+
+    # Tables of _speedy_snapshot_tables()
+    @api.model
+    def _prepare_speedy_product_lookup_tables(self, speedy):
         for cur in self.env['res.currency'].search_read([], ['name']):
             speedy['currency2id'][cur['name']] = cur['id']
         for categ in self.env['product.category'].search_read([], ['name']):
@@ -49,39 +73,66 @@ class ImportHelper(models.TransientModel):
         if speedy['pos']:
             for pos_categ in self.env['pos.category'].search_read([], ['name']):
                 speedy['pos_categ2id'][pos_categ['name']] = pos_categ['id']
-        wh = self.env['stock.warehouse'].search([('company_id', '=', self.env.company.id)], limit=1)
-        if wh:
-            speedy['default_location_id'] = wh.lot_stock_id.id
-        products = self.env['product.product'].with_context(active_test=False).search_read([], ['display_name', 'barcode', 'default_code'])
+        # load=None to get the ID of product_tmpl_id without a name_get()
+        products = self.env['product.product'].with_context(active_test=False).search_read([], ['display_name', 'barcode', 'default_code', 'product_tmpl_id'], load=None)
         for product in products:
+            speedy['product_id2tmpl_id'][product['id']] = product['product_tmpl_id']
             if product['barcode']:
                 speedy['product_barcode2name'][product['barcode']] = '%s (ID %d)' % (product['display_name'], product['id'])
+                speedy['product_barcode2id'][product['barcode']] = product['id']
             if product['default_code']:
                 speedy['product_default_code2name'][product['default_code']] = '%s (ID %d)' % (product['display_name'], product['id'])
+                speedy['product_default_code2id'][product['default_code']] = product['id']
         accounts = self.env["account.account"].search_read(
             [("company_id", "=", self.env.company.id), ("deprecated", "=", False)], ["code"])
         for account in accounts:
             speedy["account_code2id"][account["code"]] = account["id"]
-        route_code2xmlid = {
-            'buy': 'purchase_stock.route_warehouse0_buy',
-            'manufacture': 'mrp.route_warehouse0_manufacture',
-            'mto': 'stock.route_warehouse0_mto',
-            }
-        for route_code, xmlid in route_code2xmlid.items():
-            # I hope raise_if_not_found=False to avoid an error is the module is not installed
-            route = self.env.ref(xmlid, raise_if_not_found=False)
-            if route:
-                speedy["route_code2id"][route_code] = route.id
-        return speedy
+
+    @api.model
+    def _speedy_snapshot_tables(self):
+        return super()._speedy_snapshot_tables() + [
+            'currency2id', 'product_categ2id', 'pos_categ2id',
+            'product_barcode2name', 'product_default_code2name',
+            'product_barcode2id', 'product_default_code2id', 'product_id2tmpl_id',
+            'account_code2id']
+
+    @api.model
+    def _columns_normalize(self, model, columns, speedy):
+        columns = super()._columns_normalize(model, columns, speedy)
+        if model == 'product.product' and columns.get('barcode'):
+            self._columns_normalize_identifier('ean', columns['barcode'], speedy)
+        return columns
+
+    @api.model
+    def _import_job_methods(self):
+        res = super()._import_job_methods()
+        res.update({
+            '_create_product': 'row',
+            '_upsert_products': 'batch',
+            '_import_supplierinfo': 'batch',
+            '_import_orderpoints': 'batch',
+            '_import_opening_stock': 'batch',
+            })
+        return res
+
+    @api.model
+    def _import_column_row(self, model, vals, speedy, **kwargs):
+        if model == 'product.product':
+            return self._create_product(vals, speedy, **kwargs)
+        return super()._import_column_row(model, vals, speedy, **kwargs)
 
     def _create_product(self, vals, speedy, inventory=True, location_id=False):
-        stock_qty = vals.get('stock_qty', 0)
         location_id = location_id or speedy.get('default_location_id')
         rvals = self._prepare_product_vals(vals, location_id, speedy)
         if not rvals:
             logger.warning('Product on line %s skipped', vals.get('line'))
             return False
         product = self.env['product.product'].create(rvals)
+        self._post_create_product(product, vals, speedy, inventory=inventory, location_id=location_id)
+        return product
+
+    def _post_create_product(self, product, vals, speedy, inventory=True, location_id=False):
+        stock_qty = vals.get('stock_qty', 0)
         create_date_dt = self._prepare_create_date(vals, speedy)
         if create_date_dt:
             self._cr.execute(
@@ -92,23 +143,158 @@ class ImportHelper(models.TransientModel):
                 (create_date_dt, product.product_tmpl_id.id))
         vals['display_name'] = product.display_name
         vals['id'] = product.id
+        speedy['product_id2tmpl_id'][product.id] = product.product_tmpl_id.id
+        if 'product_id2tracking' in speedy and product.type == 'product':
+            speedy['product_id2tracking'][product.id] = product.tracking
         if product.barcode:
             speedy['product_barcode2name'][product.barcode] = '%s (ID %d)' % (vals['display_name'], vals['id'])
+            speedy['product_barcode2id'][product.barcode] = product.id
         if product.default_code:
             speedy['product_default_code2name'][product.default_code] = '%s (ID %d)' % (vals['display_name'], vals['id'])
+            speedy['product_default_code2id'][product.default_code] = product.id
         logger.info('New product created: %s ID %d from line %d', product.display_name, product.id, vals['line'])
         if inventory and stock_qty:
             if product.type == 'product':
                 self._set_stock_level(product, stock_qty, location_id, speedy)
             else:
                 speedy['logs']['product.product'].append({
-                    'msg': 'Cannot set stock_qty=%s on product with type=%s' (stock_qty, product.type),
+                    'msg': 'Cannot set stock_qty=%s on product with type=%s' % (stock_qty, product.type),
                     'value': stock_qty,
                     'vals': vals,
                     'field': 'product.product,qty_available',
                     'reset': True,
                     })
-        return product
+
+    # Update-or-create mode: vals_list is a list of vals with the same
+    # keys as for _create_product()
+    # If the internal reference (or else the barcode) matches an existing
+    # product, the product is updated with the fields that changed
+    # (records sharing identical changes are written together),
+    # otherwise it is created. Creations are done by batches.
+    # Supplierinfo, reordering rules and stock_qty are only set on creation:
+    # use _import_supplierinfo(), _import_orderpoints() and
+    # _import_opening_stock() for the existing products (a stock_qty on
+    # an existing product is logged).
+    def _upsert_products(self, vals_list, speedy, inventory=True, location_id=False, chunk_size=1000):
+        location_id = location_id or speedy.get('default_location_id')
+        ppo = self.env['product.product']
+        id2update, to_create = self._prepare_upsert_products(vals_list, speedy, inventory, location_id)
+        # UPDATE
+        id2diff, noop = self._upsert_products_diff(id2update, chunk_size)
+        self._bulk_write('product.product', id2diff, chunk_size=chunk_size)
+        # CREATE
+        # The reordering rules are not created with the products, but in
+        # bulk after the creation of each chunk of products
+        for chunk in split_every(chunk_size, to_create, list):
+            orderpoint_vals_list = [rvals.pop('orderpoint_ids', None) for (vals, rvals) in chunk]
+            products = ppo.create([rvals for (vals, rvals) in chunk])
+            op_vals_list = []
+            for product, (vals, rvals), orderpoint_cmds in zip(products, chunk, orderpoint_vals_list):
+                self._post_create_product(product, vals, speedy, inventory=inventory, location_id=location_id)
+                for orderpoint_cmd in orderpoint_cmds or []:
+                    op_vals_list.append(dict(orderpoint_cmd[2], product_id=product.id))
+            if op_vals_list:
+                self._bulk_create('stock.warehouse.orderpoint', op_vals_list, chunk_size=chunk_size)
+        logger.info(
+            'Product upsert: %d created, %d updated, %d unchanged',
+            len(to_create), len(id2diff), noop)
+        return {'create': len(to_create), 'update': len(id2diff), 'noop': noop}
+
+    # Return (id2update, to_create) where id2update is {product_id: (vals, rvals)}
+    # for the existing products and to_create is [(vals, rvals)]
+    def _prepare_upsert_products(self, vals_list, speedy, inventory, location_id):
+        id2update = {}
+        to_create = []
+        code2create_index = {}  # to merge the lines that will create the same product
+        for vals in vals_list:
+            product_id = self._match_existing_product(vals, speedy)
+            rvals = self._prepare_product_vals(vals, location_id, speedy, product_id=product_id)
+            if not rvals:
+                logger.warning('Product on line %s skipped', vals.get('line'))
+                continue
+            if product_id:
+                rvals.pop('seller_ids', None)
+                rvals.pop('orderpoint_ids', None)
+                if not vals.get('responsible_id'):
+                    # don't reset the responsible of existing products
+                    rvals.pop('responsible_id', None)
+                if inventory and vals.get('stock_qty'):
+                    speedy['logs']['product.product'].append({
+                        'msg': 'stock_qty is not applied on existing products, use _import_opening_stock()',
+                        'value': vals['stock_qty'],
+                        'vals': vals,
+                        'field': 'product.product,qty_available',
+                        'reset': True,
+                        })
+                if product_id in id2update:
+                    id2update[product_id][1].update(rvals)
+                else:
+                    id2update[product_id] = (vals, rvals)
+                continue
+            codes = [
+                ('default_code', rvals['default_code']) if rvals.get('default_code') else None,
+                ('barcode', rvals['barcode']) if rvals.get('barcode') else None,
+                ]
+            index = next((code2create_index[code] for code in codes if code in code2create_index), None)
+            if index is None:
+                for code in codes:
+                    if code:
+                        code2create_index[code] = len(to_create)
+                to_create.append((vals, rvals))
+            elif not self._upsert_products_conflict(vals, rvals, to_create[index], speedy):
+                to_create[index][1].update(rvals)
+        return id2update, to_create
+
+    # Lines that create the same product (same internal reference or
+    # barcode) are merged, unless their internal references or barcodes
+    # are different: the line is logged and skipped
+    def _upsert_products_conflict(self, vals, rvals, first, speedy):
+        first_vals, first_rvals = first
+        key2label = {'default_code': 'internal reference', 'barcode': 'barcode'}
+        for key, other_key in [('default_code', 'barcode'), ('barcode', 'default_code')]:
+            if rvals.get(key) and first_rvals.get(key) and rvals[key] != first_rvals[key]:
+                speedy['logs']['product.product'].append({
+                    'msg': "PRODUCT NOT IMPORTED: %s '%s' is also on line %s, but with %s '%s'" % (
+                        key2label[other_key], rvals[other_key], first_vals.get('line'),
+                        key2label[key], first_rvals[key]),
+                    'value': rvals[key],
+                    'vals': vals,
+                    'field': 'product.product,%s' % key,
+                    'reset': True,
+                    })
+                return True
+        return False
+
+    # Return (id2diff, noop) for the existing products of id2update
+    def _upsert_products_diff(self, id2update, chunk_size):
+        id2diff = {}
+        noop = 0
+        if not id2update:
+            return id2diff, noop
+        fields_list = list({key for (vals, rvals) in id2update.values() for key in rvals})
+        fields_list.append('display_name')
+        for chunk in split_every(chunk_size, list(id2update), list):
+            for current in self.env['product.product'].browse(chunk).read(fields_list, load=None):
+                vals, rvals = id2update[current['id']]
+                vals['id'] = current['id']
+                vals['display_name'] = current['display_name']
+                diff = self._diff_vals('product.product', rvals, current)
+                if diff:
+                    id2diff[current['id']] = diff
+                else:
+                    noop += 1
+        return id2diff, noop
+
+    def _match_existing_product(self, vals, speedy):
+        for key, index in [
+                ('default_code', 'product_default_code2id'),
+                ('barcode', 'product_barcode2id')]:
+            code = vals.get(key)
+            if isinstance(code, str):
+                code = code.strip()
+            if code and code in speedy[index]:
+                return speedy[index][code]
+        return False
 
     def _set_stock_level(self, product, stock_qty, location_id, speedy):
         if not location_id:
@@ -120,6 +306,172 @@ class ImportHelper(models.TransientModel):
         })._apply_inventory()
         logger.info('Stock qty %s set on product %s', stock_qty, product.display_name)
 
+    # rows is a list (or an iterator) of dict, one per line of the opening
+    # stock file:
+    # - line: Excel/CSV import ref in logs
+    # - default_code or barcode: used to match the product
+    # - location: complete name, barcode or ID of the internal location
+    #   (if empty, location_id argument or the stock location of the warehouse)
+    # - lot: name of the lot/serial number (created if it doesn't exist)
+    # - qty
+    # The rows are processed by chunks: the missing lots of the chunk are
+    # created in one create(), then the quants are created in inventory mode
+    # and applied in one call per chunk. The quantities of the lines with
+    # the same product, location and lot are added up.
+    def _import_opening_stock(self, rows, speedy, location_id=False, chunk_size=1000):
+        self._prepare_location_index(speedy)
+        speedy['logs'].setdefault('stock.quant', [])
+        if 'lot_key2id' not in speedy:
+            speedy['lot_key2id'] = {}  # (product_id, lot name) -> lot ID
+            speedy['product_id2tracking'] = {}  # only for storable products
+            # (product_id, location_id, lot_id) -> total qty of the file
+            speedy['opening_stock_key2qty'] = {}
+            # (product_id, serial number) of the lines already imported
+            speedy['opening_stock_serials'] = set()
+            for lot in self.env['stock.lot'].search_read(
+                    [('company_id', '=', self.env.company.id)], ['name', 'product_id'], load=None):
+                speedy['lot_key2id'][(lot['product_id'], lot['name'])] = lot['id']
+            logger.info('%d existing lots loaded', len(speedy['lot_key2id']))
+            for product in self.env['product.product'].with_context(active_test=False).search_read(
+                    [('type', '=', 'product')], ['tracking']):
+                speedy['product_id2tracking'][product['id']] = product['tracking']
+        location_id = location_id or speedy.get('default_location_id')
+        sqo = self.env['stock.quant'].with_context(inventory_mode=True)
+        res = {'quant': 0, 'lot': 0}
+        for chunk in split_every(chunk_size, rows, list):
+            lines = []  # [(row, product_id, location_id, lot name, qty)]
+            for row in chunk:
+                if not speedy['columnar']:
+                    for key, value in row.items():
+                        if isinstance(value, str):
+                            row[key] = value.strip() or False
+                line = self._prepare_opening_stock_line(row, location_id, speedy)
+                if line:
+                    lines.append(line)
+            # Create the missing lots
+            lot_vals_list = []
+            for row, product_id, line_location_id, lot_name, qty in lines:
+                if lot_name and (product_id, lot_name) not in speedy['lot_key2id']:
+                    speedy['lot_key2id'][(product_id, lot_name)] = False
+                    lot_vals_list.append({
+                        'name': lot_name,
+                        'product_id': product_id,
+                        'company_id': self.env.company.id,
+                        })
+            if lot_vals_list:
+                lots = self._bulk_create('stock.lot', lot_vals_list, chunk_size=chunk_size)
+                for lot, lot_vals in zip(lots, lot_vals_list):
+                    speedy['lot_key2id'][(lot_vals['product_id'], lot_vals['name'])] = lot.id
+                res['lot'] += len(lots)
+            # Create and apply the quants
+            key2qty = {}
+            for row, product_id, line_location_id, lot_name, qty in lines:
+                key = (product_id, line_location_id, lot_name and speedy['lot_key2id'][(product_id, lot_name)] or False)
+                qty += speedy['opening_stock_key2qty'].get(key, 0)
+                speedy['opening_stock_key2qty'][key] = key2qty[key] = qty
+            quant_vals_list = [{
+                'product_id': key[0],
+                'location_id': key[1],
+                'lot_id': key[2],
+                'inventory_quantity': qty,
+                } for (key, qty) in key2qty.items()]
+            if quant_vals_list:
+                quants = sqo.create(quant_vals_list)
+                quants._apply_inventory()
+                res['quant'] += len(quants)
+                logger.info('Opening stock: %d quants applied', res['quant'])
+        return res
+
+    # Return (row, product_id, location_id, lot name, qty) or None if the line must be skipped
+    def _prepare_opening_stock_line(self, row, location_id, speedy):
+        log = {
+            'vals': row,
+            'reset': True,
+            }
+        product_id = self._match_existing_product(row, speedy)
+        if not product_id:
+            speedy['logs']['stock.quant'].append(dict(
+                log, msg='No product found with this internal reference or barcode',
+                value=row.get('default_code') or row.get('barcode') or '', field='stock.quant,product_id'))
+            return None
+        tracking = speedy['product_id2tracking'].get(product_id)
+        if not tracking:
+            speedy['logs']['stock.quant'].append(dict(
+                log, msg='Product is not a storable product', value=row.get('default_code') or row.get('barcode'),
+                field='stock.quant,product_id'))
+            return None
+        if row.get('location'):
+            location_id = speedy['location2id'].get(str(row['location']))
+            if not location_id:
+                speedy['logs']['stock.quant'].append(dict(
+                    log, msg='No internal location found with this name, barcode or ID',
+                    value=row['location'], field='stock.quant,location_id'))
+                return None
+        elif not location_id:
+            raise UserError(_("location_id argument is not set and no warehouse in company '%s'.") % self.env.company.display_name)
+        qty = self._prepare_opening_stock_qty(row, log, speedy)
+        if qty is None:
+            return None
+        lot_name = self._prepare_opening_stock_lot(row, product_id, tracking, qty, log, speedy)
+        if lot_name is None:
+            return None
+        return row, product_id, location_id, lot_name, qty
+
+    # Return the quantity of the line or None if the line must be skipped
+    def _prepare_opening_stock_qty(self, row, log, speedy):
+        qty = row.get('qty')
+        if isinstance(qty, str):
+            try:
+                qty = float(qty.replace(',', '.'))
+            except ValueError:
+                speedy['logs']['stock.quant'].append(dict(
+                    log, msg='The quantity is not a number', value=row['qty'],
+                    field='stock.quant,quantity'))
+                return None
+        if qty is not None and (isinstance(qty, bool) or not isinstance(qty, (int, float))):
+            speedy['logs']['stock.quant'].append(dict(
+                log, msg='The quantity is not a number', value=row['qty'],
+                field='stock.quant,quantity'))
+            return None
+        if not qty:
+            speedy['logs']['stock.quant'].append(dict(
+                log, msg='Empty or zero quantity: line skipped', value=row.get('qty') or '',
+                field='stock.quant,quantity'))
+            return None
+        return qty
+
+    # Return the name of the lot/serial number of the line (False for the
+    # products that are not tracked) or None if the line must be skipped
+    def _prepare_opening_stock_lot(self, row, product_id, tracking, qty, log, speedy):
+        lot_name = row.get('lot') or False
+        if isinstance(lot_name, (int, float)):
+            lot_name = str(lot_name)
+        if tracking == 'none':
+            if lot_name:
+                speedy['logs']['stock.quant'].append(dict(
+                    log, msg='Product is not tracked by lot or serial number', value=lot_name,
+                    field='stock.quant,lot_id'))
+                return None
+            return False
+        if not lot_name:
+            speedy['logs']['stock.quant'].append(dict(
+                log, msg='Missing lot or serial number for a product tracked by %s' % tracking, value='',
+                field='stock.quant,lot_id'))
+            return None
+        if tracking == 'serial':
+            if qty != 1:
+                speedy['logs']['stock.quant'].append(dict(
+                    log, msg='The quantity of a product tracked by serial number must be 1',
+                    value=qty, field='stock.quant,quantity'))
+                return None
+            if (product_id, lot_name) in speedy['opening_stock_serials']:
+                speedy['logs']['stock.quant'].append(dict(
+                    log, msg='This serial number is already on another line of the file',
+                    value=lot_name, field='stock.quant,lot_id'))
+                return None
+            speedy['opening_stock_serials'].add((product_id, lot_name))
+        return lot_name
+
     # vals is a dict to create a product.product
     # It must contain a 'line' key, to indicate Excel/CSV import ref in logs
     # (removed before calling create)
@@ -137,17 +489,22 @@ class ImportHelper(models.TransientModel):
     # - orderpoint_min_qty
     # - orderpoint_max_qty
     # - orderpoint_trigger
+    # product_id is the ID of the existing product that will be updated
+    # with these vals (upsert mode)
     @api.model
-    def _prepare_product_vals(self, vals, location_id, speedy):
+    def _prepare_product_vals(self, vals, location_id, speedy, product_id=False):
         # TODO add support for pos_product_multi_barcode
         assert vals
         assert isinstance(vals, dict)
         assert isinstance(speedy, dict)
-        for key, value in vals.items():
-            if isinstance(value, str):
-                vals[key] = value.strip() or False
+        if not speedy['columnar']:
+            for key, value in vals.items():
+                if isinstance(value, str):
+                    vals[key] = value.strip() or False
         if vals.get('default_code'):
-            if vals['default_code'] in speedy['product_default_code2name']:
+            if (
+                    vals['default_code'] in speedy['product_default_code2name']
+                    and speedy['product_default_code2id'].get(vals['default_code']) != product_id):
                 speedy['logs']['product.product'].append({
                     'msg': "PRODUCT NOT IMPORTED: internal reference '%s' used on another product '%s'" % (vals['default_code'], speedy['product_default_code2name'][vals['default_code']]),
                     'value': vals['default_code'],
@@ -158,7 +515,9 @@ class ImportHelper(models.TransientModel):
                 return False
         if vals.get('barcode'):
             barcode = vals['barcode']
-            if barcode in speedy['product_barcode2name']:
+            if (
+                    barcode in speedy['product_barcode2name']
+                    and speedy['product_barcode2id'].get(barcode) != product_id):
                 speedy['logs']['product.product'].append({
                     'msg': "PRODUCT NOT IMPORTED: barcode '%s' used on another product '%s'" % (barcode, speedy['product_barcode2name'][barcode]),
                     'value': barcode,
@@ -167,17 +526,10 @@ class ImportHelper(models.TransientModel):
                     'reset': True,
                     })
                 return False
-            if len(barcode) in (8, 13, 14):
-                if not is_valid(barcode):
-                    speedy['logs']['product.product'].append({
-                        'msg': 'Barcode %s has an invalid checksum' % barcode,
-                        'value': barcode,
-                        'vals': vals,
-                        'field': 'product.product,barcode',
-                        })
-            else:
+            barcode, error = self._normalize_identifier('ean', barcode, speedy)
+            if error:
                 speedy['logs']['product.product'].append({
-                    'msg': 'Barcode %s has %d caracters (should be 8, 13 or 14 for an EAN barcode)' % (barcode, len(barcode)),
+                    'msg': error,
                     'value': barcode,
                     'vals': vals,
                     'field': 'product.product,barcode',
@@ -204,15 +556,13 @@ class ImportHelper(models.TransientModel):
                     'reset': True,
                     })
         if vals.get('categ_name'):
-            if vals['categ_name'] not in speedy['product_categ2id']:
-                categ = self.env['product.category'].create(self._prepare_product_category(vals, speedy))
-                speedy['product_categ2id'][vals['categ_name']] = categ.id
-            vals['categ_id'] = speedy['product_categ2id'][vals['categ_name']]
+            vals['categ_id'] = self._match_or_create_category(
+                vals, 'categ_name', 'product_categ2id', 'product.category', 'categ_id',
+                self._prepare_product_category, speedy)
         if speedy['pos'] and vals.get('pos_categ_name'):
-            if vals['pos_categ_name'] not in speedy['pos_categ2id']:
-                pos_categ = self.env['pos.category'].create(self._prepare_pos_category(vals, speedy))
-                speedy['pos_categ2id'][vals['pos_categ_name']] = pos_categ.id
-            vals['pos_categ_id'] = speedy['pos_categ2id'][vals['pos_categ_name']]
+            vals['pos_categ_id'] = self._match_or_create_category(
+                vals, 'pos_categ_name', 'pos_categ2id', 'pos.category', 'pos_categ_id',
+                self._prepare_pos_category, speedy)
 
         supplierinfo_vals = {}
         if vals.get('supplier_id'):
@@ -226,20 +576,9 @@ class ImportHelper(models.TransientModel):
             if vals.get('supplier_delay'):
                 supplierinfo_vals['delay'] = vals['supplier_delay']
             if vals.get('supplier_currency'):
-                if isinstance(vals['supplier_currency'], int):
-                    supplierinfo_vals['currency_id'] = vals['supplier_currency']
-                elif isinstance(vals['supplier_currency'], str):
-                    currency = vals['supplier_currency'].upper().strip()
-                    if currency in speedy['currency2id']:
-                        supplierinfo_vals['currency_id'] = speedy['currency2id'][currency]
-                    else:
-                        speedy['logs']['product.product'].append({
-                            'msg': '%s is not a known currency ISO code' % currency,
-                            'value': currency,
-                            'vals': vals,
-                            'field': 'product.supplierinfo,currency_id',
-                            'reset': True,
-                            })
+                currency_id = self._match_supplier_currency(vals, speedy, 'product.product')
+                if currency_id:
+                    supplierinfo_vals['currency_id'] = currency_id
             vals['seller_ids'] = [Command.create(supplierinfo_vals)]
         if vals.get('orderpoint_min_qty'):
             if not location_id:
@@ -250,7 +589,7 @@ class ImportHelper(models.TransientModel):
                 'location_id': location_id,
                 }
             if vals.get('orderpoint_trigger'):
-                vals['trigger'] = vals['orderpoint_trigger']
+                orderpoint_vals['trigger'] = vals['orderpoint_trigger']
             vals['orderpoint_ids'] = [Command.create(orderpoint_vals)]
         if 'route_code' in vals:
             route_codes = vals['route_codes']
@@ -278,6 +617,348 @@ class ImportHelper(models.TransientModel):
                 rvals.pop(key)
         return rvals
 
+    def _prepare_location_index(self, speedy):
+        # Indexes of the warehouses and internal locations, built on the first call
+        if 'location2id' in speedy:
+            return
+        company_id = self.env.company.id
+        speedy.update({
+            'warehouse2id': {},  # code, name or ID (str) -> warehouse ID
+            'warehouse_id2location_id': {},
+            'location2id': {},  # complete name, barcode or ID (str) -> location ID
+            'location_id2warehouse_id': {},
+            })
+        for wh in self.env['stock.warehouse'].search_read([('company_id', '=', company_id)], ['code', 'name', 'lot_stock_id'], load=None):
+            for key in (wh['code'], wh['name'], str(wh['id'])):
+                speedy['warehouse2id'][key] = wh['id']
+            speedy['warehouse_id2location_id'][wh['id']] = wh['lot_stock_id']
+        for loc in self.env['stock.location'].search_read([('company_id', '=', company_id), ('usage', '=', 'internal')], ['complete_name', 'barcode', 'warehouse_id'], load=None):
+            for key in (loc['complete_name'], loc['barcode'], str(loc['id'])):
+                if key:
+                    speedy['location2id'][key] = loc['id']
+            speedy['location_id2warehouse_id'][loc['id']] = loc['warehouse_id']
+
+    def _prepare_orderpoint_index(self, speedy):
+        # Indexes used by _import_orderpoints(), built on the first call
+        self._prepare_location_index(speedy)
+        if 'orderpoint_key2op' in speedy:
+            return
+        speedy['orderpoint_key2op'] = {}  # (product_id, location_id) -> orderpoint dict
+        speedy['logs'].setdefault('stock.warehouse.orderpoint', [])
+        for op in self.env['stock.warehouse.orderpoint'].with_context(active_test=False).search_read(
+                [('company_id', '=', self.env.company.id)],
+                ['product_id', 'location_id', 'warehouse_id', 'product_min_qty', 'product_max_qty', 'trigger', 'qty_multiple', 'active'], load=None):
+            speedy['orderpoint_key2op'][(op['product_id'], op['location_id'])] = op
+        logger.info('%d existing orderpoints loaded', len(speedy['orderpoint_key2op']))
+
+    # rows is a list of dict, one per line of the reordering rules file:
+    # - line: Excel/CSV import ref in logs
+    # - default_code or barcode: used to match the product
+    # - warehouse: code, name or ID of the warehouse
+    # - location: complete name, barcode or ID of the internal location
+    #   (if empty, the stock location of the warehouse)
+    # - orderpoint_min_qty
+    # - orderpoint_max_qty (default: orderpoint_min_qty)
+    # - orderpoint_trigger: 'auto' or 'manual'
+    # - orderpoint_multiple
+    # A line updates the existing reordering rule of the same product and
+    # location (only the fields that changed are written, archived rules are
+    # unarchived), otherwise it creates a new reordering rule.
+    # Creations and updates are done by batches, so the computed fields
+    # of the reordering rules (qty_to_order, ...) are computed once per batch.
+    def _import_orderpoints(self, rows, speedy, chunk_size=1000):
+        self._prepare_orderpoint_index(speedy)
+        key2create = {}  # if the same key is on several lines, the last line wins
+        id2vals = {}
+        noop = 0
+        for row in rows:
+            if not speedy['columnar']:
+                for key, value in row.items():
+                    if isinstance(value, str):
+                        row[key] = value.strip() or False
+            product_id = self._match_existing_product(row, speedy)
+            if not product_id:
+                speedy['logs']['stock.warehouse.orderpoint'].append({
+                    'msg': 'No product found with this internal reference or barcode',
+                    'value': row.get('default_code') or row.get('barcode') or '',
+                    'vals': row,
+                    'field': 'stock.warehouse.orderpoint,product_id',
+                    'reset': True,
+                    })
+                continue
+            location = self._match_orderpoint_location(row, speedy)
+            if not location:
+                continue
+            warehouse_id, location_id = location
+            opvals = self._prepare_orderpoint_vals(row, speedy)
+            if opvals is None:
+                continue
+            key = (product_id, location_id)
+            op = speedy['orderpoint_key2op'].get(key)
+            if op:
+                opvals['active'] = True
+                diff = self._diff_vals('stock.warehouse.orderpoint', opvals, op)
+                if diff:
+                    id2vals.setdefault(op['id'], {}).update(diff)
+                else:
+                    noop += 1
+            else:
+                opvals.update({
+                    'product_id': product_id,
+                    'location_id': location_id,
+                    'warehouse_id': warehouse_id,
+                    })
+                key2create[key] = opvals
+        logger.info(
+            'Orderpoint import: %d to create, %d to update, %d unchanged',
+            len(key2create), len(id2vals), noop)
+        orderpoints = self._bulk_create('stock.warehouse.orderpoint', list(key2create.values()), chunk_size=chunk_size)
+        for op in orderpoints.read(['product_id', 'location_id', 'warehouse_id', 'product_min_qty', 'product_max_qty', 'trigger', 'qty_multiple', 'active'], load=None):
+            speedy['orderpoint_key2op'][(op['product_id'], op['location_id'])] = op
+        self._bulk_write('stock.warehouse.orderpoint', id2vals, chunk_size=chunk_size)
+        if id2vals:
+            # keep the index up-to-date for the next calls
+            for op in speedy['orderpoint_key2op'].values():
+                if op['id'] in id2vals:
+                    op.update(id2vals[op['id']])
+        return {'create': len(key2create), 'update': len(id2vals), 'noop': noop}
+
+    # Return (warehouse_id, location_id) or None
+    def _match_orderpoint_location(self, row, speedy):
+        log = {
+            'vals': row,
+            'reset': True,
+            }
+        warehouse_id = location_id = False
+        if row.get('warehouse'):
+            warehouse_id = speedy['warehouse2id'].get(str(row['warehouse']))
+            if not warehouse_id:
+                speedy['logs']['stock.warehouse.orderpoint'].append(dict(
+                    log, msg='No warehouse found with this code, name or ID',
+                    value=row['warehouse'], field='stock.warehouse.orderpoint,warehouse_id'))
+                return None
+        if row.get('location'):
+            location_id = speedy['location2id'].get(str(row['location']))
+            if not location_id:
+                speedy['logs']['stock.warehouse.orderpoint'].append(dict(
+                    log, msg='No internal location found with this name, barcode or ID',
+                    value=row['location'], field='stock.warehouse.orderpoint,location_id'))
+                return None
+            loc_warehouse_id = speedy['location_id2warehouse_id'][location_id]
+            if not loc_warehouse_id or (warehouse_id and loc_warehouse_id != warehouse_id):
+                speedy['logs']['stock.warehouse.orderpoint'].append(dict(
+                    log, msg='Location is not in the warehouse',
+                    value=row['location'], field='stock.warehouse.orderpoint,location_id'))
+                return None
+            warehouse_id = loc_warehouse_id
+        elif warehouse_id:
+            location_id = speedy['warehouse_id2location_id'][warehouse_id]
+        else:
+            location_id = speedy.get('default_location_id')
+            warehouse_id = location_id and speedy['location_id2warehouse_id'].get(location_id)
+            if not warehouse_id:
+                raise UserError(_("No warehouse in company '%s'.") % self.env.company.display_name)
+        return warehouse_id, location_id
+
+    # Return None if the line must be skipped
+    def _prepare_orderpoint_vals(self, row, speedy):
+        min_qty = row.get('orderpoint_min_qty') or 0
+        opvals = {
+            'product_min_qty': min_qty,
+            'product_max_qty': row.get('orderpoint_max_qty') or min_qty,
+            }
+        if row.get('orderpoint_trigger'):
+            if row['orderpoint_trigger'] not in ('auto', 'manual'):
+                speedy['logs']['stock.warehouse.orderpoint'].append({
+                    'msg': "Trigger must be 'auto' or 'manual'",
+                    'value': row['orderpoint_trigger'],
+                    'vals': row,
+                    'field': 'stock.warehouse.orderpoint,trigger',
+                    'reset': True,
+                    })
+                return None
+            opvals['trigger'] = row['orderpoint_trigger']
+        if row.get('orderpoint_multiple'):
+            opvals['qty_multiple'] = row['orderpoint_multiple']
+        return opvals
+
+    def _match_supplier_currency(self, vals, speedy, log_model):
+        if isinstance(vals['supplier_currency'], int):
+            return vals['supplier_currency']
+        elif isinstance(vals['supplier_currency'], str):
+            currency = vals['supplier_currency'].upper().strip()
+            if currency in speedy['currency2id']:
+                return speedy['currency2id'][currency]
+            speedy['logs'][log_model].append({
+                'msg': '%s is not a known currency ISO code' % currency,
+                'value': currency,
+                'vals': vals,
+                'field': 'product.supplierinfo,currency_id',
+                'reset': True,
+                })
+        return False
+
+    # rows is a list of dict, one per line of the supplier price file:
+    # - line: Excel/CSV import ref in logs
+    # - supplier_id: res.partner ID of the supplier
+    # - default_code, barcode or supplier_product_code: used to match the product
+    #   (by that order of priority)
+    # - supplier_price
+    # - supplier_min_qty
+    # - supplier_currency: currency ISO code or ID
+    # - supplier_product_code
+    # - supplier_product_name
+    # - supplier_delay
+    # A line updates the existing supplierinfo of the product with the
+    # same supplier and min qty (only the fields that changed are written),
+    # otherwise it creates a new supplierinfo. When the product is a variant
+    # of a template with several variants, the supplierinfo is specific to
+    # the variant: the supplierinfo of the template is not shared by the
+    # prices of its variants.
+    def _import_supplierinfo(self, rows, speedy, chunk_size=1000):
+        speedy['logs'].setdefault('product.supplierinfo', [])
+        supplier_ids = list({row['supplier_id'] for row in rows if row.get('supplier_id')})
+        seller_code2product, key2seller = self._prepare_supplierinfo_index(supplier_ids)
+        tmpl_id2variant_count = defaultdict(int)
+        for tmpl_id in speedy['product_id2tmpl_id'].values():
+            tmpl_id2variant_count[tmpl_id] += 1
+        price_prec = self.env['decimal.precision'].precision_get('Product Price')
+        key2create = {}  # if the same key is on several lines, the last line wins
+        id2vals = {}
+        noop = 0
+        for row in rows:
+            if not speedy['columnar']:
+                for key, value in row.items():
+                    if isinstance(value, str):
+                        row[key] = value.strip() or False
+            product_tmpl_id, product_id = self._match_supplierinfo_product(row, seller_code2product, speedy)
+            if not product_tmpl_id:
+                continue
+            svals = self._prepare_supplierinfo_vals(row, speedy)
+            if svals is None:
+                continue
+            if product_id and tmpl_id2variant_count[product_tmpl_id] <= 1:
+                product_id = False
+            key = (row['supplier_id'], product_tmpl_id, product_id, float(row.get('supplier_min_qty') or 0))
+            seller = key2seller.get(key)
+            if seller:
+                diff = self._supplierinfo_diff(svals, seller, price_prec)
+                if diff:
+                    id2vals.setdefault(seller['id'], {}).update(diff)
+                else:
+                    noop += 1
+            else:
+                svals.update({
+                    'partner_id': key[0],
+                    'product_tmpl_id': key[1],
+                    'product_id': key[2],
+                    'min_qty': key[3],
+                    })
+                key2create[key] = svals
+        logger.info(
+            'Supplierinfo import: %d to create, %d to update, %d unchanged',
+            len(key2create), len(id2vals), noop)
+        self._bulk_create('product.supplierinfo', list(key2create.values()), chunk_size=chunk_size)
+        self._bulk_write('product.supplierinfo', id2vals, chunk_size=chunk_size)
+        return {'create': len(key2create), 'update': len(id2vals), 'noop': noop}
+
+    # Prebuilt indexes of the existing supplierinfo of the suppliers:
+    # - (supplier_id, supplier product code) -> (product_tmpl_id, product_id)
+    # - (supplier_id, product_tmpl_id, product_id, min_qty) -> supplierinfo dict
+    # product_id is False for the supplierinfo of the template
+    def _prepare_supplierinfo_index(self, supplier_ids):
+        seller_code2product = {}
+        key2seller = {}
+        sellers = self.env['product.supplierinfo'].search_read([
+            ('partner_id', 'in', supplier_ids),
+            ('company_id', 'in', (False, self.env.company.id)),
+            ], ['partner_id', 'product_tmpl_id', 'product_id', 'min_qty', 'price', 'currency_id', 'delay', 'product_code', 'product_name'], load=None)
+        for seller in sellers:
+            product_id = seller['product_id'] or False
+            if seller['product_code']:
+                seller_code2product[(seller['partner_id'], seller['product_code'])] = (seller['product_tmpl_id'], product_id)
+            key2seller[(seller['partner_id'], seller['product_tmpl_id'], product_id, seller['min_qty'])] = seller
+        logger.info('%d existing supplierinfo loaded for %d suppliers', len(sellers), len(supplier_ids))
+        return seller_code2product, key2seller
+
+    # Return the part of svals that differs from the existing supplierinfo
+    def _supplierinfo_diff(self, svals, seller, price_prec):
+        diff = {}
+        for field, value in svals.items():
+            if field == 'price':
+                if float_compare(value, seller['price'], precision_digits=price_prec):
+                    diff[field] = value
+            elif (value or False) != (seller[field] or False):
+                diff[field] = value
+        return diff
+
+    # Return (product_tmpl_id, product_id)
+    def _match_supplierinfo_product(self, row, seller_code2product, speedy):
+        log = {
+            'vals': row,
+            'field': 'product.supplierinfo,product_tmpl_id',
+            'reset': True,
+            }
+        if not row.get('supplier_id'):
+            speedy['logs']['product.supplierinfo'].append(dict(
+                log, msg='Missing supplier', value='', field='product.supplierinfo,partner_id'))
+            return False, False
+        product_id = False
+        if row.get('default_code'):
+            product_id = speedy['product_default_code2id'].get(row['default_code'])
+        if not product_id and row.get('barcode'):
+            product_id = speedy['product_barcode2id'].get(row['barcode'])
+        if product_id:
+            return speedy['product_id2tmpl_id'][product_id], product_id
+        if row.get('supplier_product_code'):
+            product = seller_code2product.get((row['supplier_id'], row['supplier_product_code']))
+            if product:
+                return product
+        speedy['logs']['product.supplierinfo'].append(dict(
+            log, msg='No product found with this internal reference, barcode or supplier product code',
+            value=row.get('default_code') or row.get('barcode') or row.get('supplier_product_code') or ''))
+        return False, False
+
+    # Return None if the line must be skipped
+    def _prepare_supplierinfo_vals(self, row, speedy):
+        svals = {}
+        if 'supplier_price' in row:
+            svals['price'] = row['supplier_price'] or 0
+        for rkey, field in [
+                ('supplier_product_code', 'product_code'),
+                ('supplier_product_name', 'product_name')]:
+            if rkey in row:
+                svals[field] = row[rkey]
+        if row.get('supplier_delay'):
+            svals['delay'] = row['supplier_delay']
+        if row.get('supplier_currency'):
+            currency_id = self._match_supplier_currency(row, speedy, 'product.supplierinfo')
+            if not currency_id:
+                return None
+            svals['currency_id'] = currency_id
+        return svals
+
+    # Match the category name of vals[name_key] with the categories of
+    # speedy[index_key]: exact match, then approximate match (logged as
+    # to review on each line), otherwise the category is created
+    def _match_or_create_category(self, vals, name_key, index_key, model, field, prepare_method, speedy):
+        name = vals[name_key]
+        if name not in speedy[index_key]:
+            res = self._fuzzy_match(model, name, speedy[index_key], speedy)
+            if res:
+                speedy['logs']['product.product'].append({
+                    'msg': "To review: approximate match, category '%s' has been matched with category '%s' (similarity %d%%)" % (name, res[0], res[1] * 100),
+                    'value': name,
+                    'vals': vals,
+                    'field': 'product.product,%s' % field,
+                    'reset': True,
+                    })
+                return speedy[index_key][res[0]]
+            categ = self.env[model].create(prepare_method(vals, speedy))
+            speedy[index_key][name] = categ.id
+            self._fuzzy_add(model, name, speedy)
+        return speedy[index_key][name]
+
     def _prepare_product_category(self, vals, speedy):
         return {'name': vals['categ_name']}
 
@@ -8,9 +8,64 @@ from odoo import api, fields, models
 class ProductAttributeValue(models.Model):
     _inherit = "product.attribute.value"
 
-    fullname = fields.Char(compute="_compute_fullname", store=True)
+    # Single-key lookup for imports: "Attribute : Value" -> ID
+    # (used by the pattern import of product_pattern_import_helper)
+    # Always in en_US, so that it doesn't depend on the language of the
+    # user who created or renamed the attribute or the value
+    fullname = fields.Char(compute="_compute_fullname", store=True, index=True)
 
-    @api.depends("attribute_id.name", "name")
+    # attribute_id.name is not in the dependencies: when an attribute is
+    # renamed (write or translation update), the fullname of all its values
+    # is recomputed in a single SQL query by _recompute_fullname_by_attribute()
+    @api.depends("attribute_id", "name")
     def _compute_fullname(self):
-        for record in self:
+        for record in self.with_context(lang="en_US"):
             record.fullname = f"{record.attribute_id.name} : {record.name}"
+
+    @api.model
+    def _recompute_fullname_by_attribute(self, attribute_ids):
+        if not attribute_ids:
+            return
+        self.flush_model(["name", "attribute_id"])
+        self.env["product.attribute"].flush_model(["name"])
+        self._cr.execute(
+            """
+            UPDATE product_attribute_value pav
+            SET fullname = (pa.name->>'en_US') || ' : ' || (pav.name->>'en_US')
+            FROM product_attribute pa
+            WHERE pa.id = pav.attribute_id
+            AND pa.id IN %(attribute_ids)s
+            """,
+            {"attribute_ids": tuple(attribute_ids)},
+        )
+        self.invalidate_model(["fullname"])
+
+    def _update_field_translations(self, field_name, translations, digest=None):
+        res = super()._update_field_translations(
+            field_name, translations, digest=digest
+        )
+        if field_name == "name":
+            self._recompute_fullname_by_attribute(self.attribute_id.ids)
+        return res
+
+
+class ProductAttribute(models.Model):
+    _inherit = "product.attribute"
+
+    def write(self, vals):
+        res = super().write(vals)
+        if "name" in vals:
+            self.env["product.attribute.value"]._recompute_fullname_by_attribute(
+                self.ids
+            )
+        return res
+
+    def _update_field_translations(self, field_name, translations, digest=None):
+        res = super()._update_field_translations(
+            field_name, translations, digest=digest
+        )
+        if field_name == "name":
+            self.env["product.attribute.value"]._recompute_fullname_by_attribute(
+                self.ids
+            )
+        return res
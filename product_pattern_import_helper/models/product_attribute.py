@@ -0,0 +1,41 @@
+# Copyright 2020 Akretion (https://www.akretion.com).
+# @author Sébastien BEAU <sebastien.beau@akretion.com>
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from odoo import api, models
+
+
+class ProductAttribute(models.Model):
+    _inherit = "product.attribute"
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.env["product.template"]._invalidate_pattern_import_attribute_index()
+        return super().create(vals_list)
+
+    def write(self, vals):
+        if "name" in vals:
+            self.env["product.template"]._invalidate_pattern_import_attribute_index()
+        return super().write(vals)
+
+    def unlink(self):
+        self.env["product.template"]._invalidate_pattern_import_attribute_index()
+        return super().unlink()
+
+
+class ProductAttributeValue(models.Model):
+    _inherit = "product.attribute.value"
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        self.env["product.template"]._invalidate_pattern_import_attribute_index()
+        return super().create(vals_list)
+
+    def write(self, vals):
+        if "name" in vals or "attribute_id" in vals:
+            self.env["product.template"]._invalidate_pattern_import_attribute_index()
+        return super().write(vals)
+
+    def unlink(self):
+        self.env["product.template"]._invalidate_pattern_import_attribute_index()
+        return super().unlink()
@@ -2,52 +2,327 @@
 # @author Sébastien BEAU <sebastien.beau@akretion.com>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
-from odoo import _, models
+from collections import defaultdict
+
+from odoo import _, api, models
 from odoo.exceptions import UserError
 
+ATTRIBUTE_INDEX_KEY = "pattern_import_attribute_index"
+
 
 class ProductTemplate(models.Model):
     _inherit = "product.template"
 
-    # TODO resoudre le soucis d'import des nouvelles ligne
-    # il faut qu'on réutilise les lignes existante et qu'on supprime
-    # les attributes non importé
-    # on va surcharger le write a la bourrin pour la V1
-    # ensuite il faudra faire un truc générique
+    @api.model
+    def _get_pattern_import_attribute_index(self):
+        # The index is built once per pattern import and stored in the
+        # pattern_config dict of the context (like the record_ids of
+        # pattern_import_export), so it is shared by all the rows and
+        # discarded with the import. The names are translatable, so there
+        # is one index per language.
+        # In en_US, the values are not preloaded: they are looked up on
+        # demand with the indexed fullname of product.attribute.value
+        # ("Attribute : Value", always in en_US), cf
+        # _pattern_import_load_attribute_values()
+        holder = self.env.context.get("pattern_config")
+        if holder is None:
+            holder = {}
+        indexes = holder.setdefault(ATTRIBUTE_INDEX_KEY, {})
+        lang = self.env.lang or "en_US"
+        if lang not in indexes:
+            attr_name2ids = defaultdict(list)
+            attr_id2name = {}
+            # (attribute ID, value name) -> value IDs
+            value_key2ids = defaultdict(list)
+            for attr in self.env["product.attribute"].search_read([], ["name"]):
+                attr_name2ids[attr["name"]].append(attr["id"])
+                attr_id2name[attr["id"]] = attr["name"]
+            fullname_lookup = lang == "en_US"
+            if not fullname_lookup:
+                for value in self.env["product.attribute.value"].search_read(
+                    [], ["attribute_id", "name"]
+                ):
+                    value_key2ids[(value["attribute_id"][0], value["name"])].append(
+                        value["id"]
+                    )
+            indexes[lang] = {
+                "attr_name2ids": attr_name2ids,
+                "attr_id2name": attr_id2name,
+                "value_key2ids": value_key2ids,
+                "fullname_lookup": fullname_lookup,
+                # keys of value_key2ids already looked up by fullname
+                "loaded_value_keys": set(),
+            }
+        return indexes[lang]
+
+    @api.model
+    def _pattern_import_load_attribute_values(self, index, keys):
+        # keys: (attribute ID, value name) to resolve, in a single query
+        if not index["fullname_lookup"]:
+            return
+        missing = {key for key in keys if key not in index["loaded_value_keys"]}
+        if not missing:
+            return
+        fullnames = [
+            "{} : {}".format(index["attr_id2name"][attr_id], value_name)
+            for (attr_id, value_name) in missing
+        ]
+        for value in self.env["product.attribute.value"].search_read(
+            [("fullname", "in", fullnames)], ["attribute_id", "name"], load=None
+        ):
+            key = (value["attribute_id"], value["name"])
+            if key in missing:
+                index["value_key2ids"][key].append(value["id"])
+        index["loaded_value_keys"] |= missing
+
+    @api.model
+    def _invalidate_pattern_import_attribute_index(self):
+        holder = self.env.context.get("pattern_config")
+        if holder:
+            holder.pop(ATTRIBUTE_INDEX_KEY, None)
+
+    @api.model
+    def _pattern_import_collect_attribute_values(self, attribute_lines, attr2values):
+        # attr2values: {attribute name: {value name: None}} (dict to keep the order)
+        for attribute_line in attribute_lines:
+            attr_name = attribute_line["attribute_id"].get("name")
+            if attr_name:
+                values = attr2values.setdefault(attr_name, {})
+                for value in attribute_line["value_ids"]:
+                    if value.get("name"):
+                        values[value["name"]] = None
+        return attr2values
+
+    # Opt-in mode (context key pattern_import_create_attribute_value): create
+    # the missing attributes and values of all the rows with a single
+    # create() per model, before the rows are processed, cf load().
+    # New attributes are created with the create_variant mode of the context
+    # key pattern_import_attribute_create_variant (default: 'always') and
+    # the sequences follow the order of the file.
+    @api.model
+    def _pattern_import_create_missing_attribute_values(self, attr2values):
+        pao = self.env["product.attribute"]
+        pavo = self.env["product.attribute.value"]
+        create_variant = self.env.context.get(
+            "pattern_import_attribute_create_variant", "always"
+        )
+        create_variant_modes = [
+            key for (key, label) in pao._fields["create_variant"].selection
+        ]
+        if create_variant not in create_variant_modes:
+            raise UserError(
+                _(
+                    "Wrong value '{}' for pattern_import_attribute_create_variant, "
+                    "it must be one of {}."
+                ).format(create_variant, ", ".join(create_variant_modes))
+            )
+        index = self._get_pattern_import_attribute_index()
+        missing_attrs = [
+            name for name in attr2values if name not in index["attr_name2ids"]
+        ]
+        if missing_attrs:
+            last_attr = pao.search([], order="sequence desc", limit=1)
+            sequence = last_attr.sequence or 0
+            pao.create(
+                [
+                    {
+                        "name": name,
+                        "sequence": sequence + i,
+                        "create_variant": create_variant,
+                    }
+                    for (i, name) in enumerate(missing_attrs, start=1)
+                ]
+            )
+            index = self._get_pattern_import_attribute_index()
+        value_keys = []
+        for attr_name, values in attr2values.items():
+            attr_ids = index["attr_name2ids"].get(attr_name, [])
+            if len(attr_ids) != 1:
+                # reported by _process_pattern_import_attribute_line()
+                continue
+            value_keys += [(attr_ids[0], value_name) for value_name in values]
+        self._pattern_import_load_attribute_values(index, value_keys)
+        missing_values = [
+            key for key in value_keys if not index["value_key2ids"].get(key)
+        ]
+        value_vals_list = []
+        if missing_values:
+            attr2sequence = {}
+            for res in pavo.read_group(
+                [("attribute_id", "in", list({mv[0] for mv in missing_values}))],
+                ["attribute_id", "sequence:max"],
+                ["attribute_id"],
+            ):
+                attr2sequence[res["attribute_id"][0]] = res["sequence"] or 0
+            for attr_id, value_name in missing_values:
+                attr2sequence[attr_id] = attr2sequence.get(attr_id, 0) + 1
+                value_vals_list.append(
+                    {
+                        "attribute_id": attr_id,
+                        "name": value_name,
+                        "sequence": attr2sequence[attr_id],
+                    }
+                )
+        if value_vals_list:
+            pavo.create(value_vals_list)
+        return {"attribute": len(missing_attrs), "value": len(value_vals_list)}
+
+    # Single pass over the flat rows of the file (only the attribute
+    # columns are parsed), so that all the missing attributes and values
+    # are created at once
+    @api.model
+    def _pattern_import_prepare_attribute_values(self, rows):
+        attr2values = {}
+        for row in rows:
+            attr_row = {
+                key: value
+                for (key, value) in row.items()
+                if key and key.startswith("attribute_line_ids|")
+            }
+            if attr_row:
+                result = super()._flatty2json(attr_row)
+                self._pattern_import_collect_attribute_values(
+                    result.get("attribute_line_ids", []), attr2values
+                )
+        return self._pattern_import_create_missing_attribute_values(attr2values)
+
+    @api.model
+    def load(self, fields, data):
+        # Pattern import (cf pattern_import_export): data is the list of
+        # (row index, flat row) of a chunk of the file
+        if self.env.context.get("pattern_config") and self.env.context.get(
+            "pattern_import_create_attribute_value"
+        ):
+            self._pattern_import_prepare_attribute_values([row for (idx, row) in data])
+        return super().load(fields, data)
+
     def _process_pattern_import_attribute_line(self, attribute_lines):
         # We need to ensure that the value match the value
+        # All the errors of the row are reported in a single UserError
+        index = self._get_pattern_import_attribute_index()
+        value_keys = []
+        for attribute_line in attribute_lines:
+            attr_ids = index["attr_name2ids"].get(
+                attribute_line["attribute_id"].get("name"), []
+            )
+            if len(attr_ids) == 1:
+                value_keys += [
+                    (attr_ids[0], value["name"])
+                    for value in attribute_line["value_ids"]
+                    if value.get("name")
+                ]
+        self._pattern_import_load_attribute_values(index, value_keys)
+        errors = []
         for attribute_line in attribute_lines:
             attr_name = attribute_line["attribute_id"].get("name")
             if attr_name:
-                attr = self.env["product.attribute"].search([("name", "=", attr_name)])
-                attribute_line["attribute_id"] = {".id": attr.id}
+                attr_ids = index["attr_name2ids"].get(attr_name, [])
+                if len(attr_ids) > 1:
+                    errors.append(_("Too many attributes found for '{}'").format(attr_name))
+                    continue
+                elif not attr_ids:
+                    errors.append(_("No attribute found for '{}'").format(attr_name))
+                    continue
+                attr_id = attr_ids[0]
+                attribute_line["attribute_id"] = {".id": attr_id}
                 vals = []
                 for value in attribute_line["value_ids"]:
                     value_name = value.get("name")
                     if value_name:
-                        attr_val = self.env["product.attribute.value"].search(
-                            [
-                                ("name", "=", value_name),
-                                ("attribute_id.id", "=", attr.id),
-                            ]
+                        value_ids = index["value_key2ids"].get(
+                            (attr_id, value_name), []
                         )
-                        if len(attr_val) > 1:
-                            raise UserError(
+                        if len(value_ids) > 1:
+                            errors.append(
                                 _("Too many attribute value found for '{}' ").format(
                                     value_name
                                 )
                             )
-                        elif len(attr_val) == 0:
-                            raise UserError(
+                        elif not value_ids:
+                            errors.append(
                                 _("No value found for attribute value '{}' ").format(
                                     value_name
                                 )
                             )
-                        vals.append({".id": attr_val.id})
+                        else:
+                            vals.append({".id": value_ids[0]})
                 attribute_line["value_ids"] = vals
+        if errors:
+            raise UserError("\n".join(errors))
+
+    @api.model
+    def _get_pattern_import_existing_template(self, result):
+        if result.get(".id"):
+            return self.browse(int(result[".id"])).exists()
+        if result.get("id"):
+            record = self.env.ref(result["id"], raise_if_not_found=False)
+            if record and record._name == self._name:
+                return record
+        return self.browse()
+
+    # The attribute lines of existing templates are not rewritten by the
+    # pattern import: _pattern_import_reuse_attribute_lines() reuses the
+    # existing lines and only replaces the values that changed, and
+    # _load_records_write() removes the lines of the attributes that are
+    # not imported anymore
+    def _pattern_import_reuse_attribute_lines(self, attribute_lines):
+        # Diff between the imported attributes/values and the existing lines
+        # of the template (self, empty for a new template), so that
+        # _create_variant_ids only touches the affected variants.
+        # Return the attribute lines in the format of the pattern import,
+        # to be written by the import itself with the rest of the row:
+        # an existing line is referenced by its .id, with its values only
+        # if they changed. The attributes without values are skipped.
+        existing = {line.attribute_id.id: line for line in self.attribute_line_ids}
+        res = []
+        for attribute_line in attribute_lines:
+            attr_id = attribute_line["attribute_id"].get(".id")
+            if not attr_id:
+                continue
+            value_ids = {value[".id"] for value in attribute_line["value_ids"]}
+            line = existing.get(attr_id)
+            if line:
+                line_vals = {".id": line.id}
+                if value_ids and value_ids != set(line.value_ids.ids):
+                    line_vals["value_ids"] = attribute_line["value_ids"]
+                res.append(line_vals)
+            elif value_ids:
+                res.append(attribute_line)
+        return res
+
+    def _load_records_write(self, values):
+        # The lines of the attributes that are not imported anymore are
+        # removed, cf _pattern_import_reuse_attribute_lines()
+        if self.env.context.get("pattern_config") and values.get(
+            "attribute_line_ids"
+        ):
+            commands = values["attribute_line_ids"]
+            if not any(command[0] in (5, 6) for command in commands):
+                kept_ids = {
+                    command[1] for command in commands if command[0] in (1, 4)
+                }
+                values = dict(
+                    values,
+                    attribute_line_ids=commands
+                    + [
+                        (2, line.id)
+                        for line in self.attribute_line_ids
+                        if line.id not in kept_ids
+                    ],
+                )
+        return super()._load_records_write(values)
 
     def _flatty2json(self, row):
         result = super()._flatty2json(row)
         if "attribute_line_ids" in result:
             self._process_pattern_import_attribute_line(result["attribute_line_ids"])
+            template = self._get_pattern_import_existing_template(result)
+            attribute_lines = template._pattern_import_reuse_attribute_lines(
+                result["attribute_line_ids"]
+            )
+            if attribute_lines:
+                result["attribute_line_ids"] = attribute_lines
+            else:
+                # no attribute values on the row: the lines are kept as is
+                result.pop("attribute_line_ids")
         return result
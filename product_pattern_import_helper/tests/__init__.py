@@ -0,0 +1 @@
+from . import test_pattern_import
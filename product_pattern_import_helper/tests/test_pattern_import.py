@@ -0,0 +1,193 @@
+# Copyright 2023 Akretion (https://www.akretion.com).
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from odoo.exceptions import UserError
+from odoo.tests.common import TransactionCase
+
+
+class TestPatternImport(TransactionCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.env = cls.env(context=dict(cls.env.context, tracking_disable=True))
+        cls.pto = cls.env["product.template"]
+        cls.color = cls.env["product.attribute"].create(
+            {
+                "name": "Test Color",
+                "value_ids": [(0, 0, {"name": "Red"}), (0, 0, {"name": "Blue"})],
+            }
+        )
+        cls.red, cls.blue = cls.color.value_ids
+
+    def test_create_missing_attribute_values(self):
+        rows = [
+            {
+                "name": "Shirt",
+                "attribute_line_ids|1|attribute_id|name": "Test Size",
+                "attribute_line_ids|1|value_ids|1|name": "S",
+                "attribute_line_ids|1|value_ids|2|name": "M",
+                "attribute_line_ids|2|attribute_id|name": "Test Color",
+                "attribute_line_ids|2|value_ids|1|name": "Green",
+            },
+            {
+                "name": "Pants",
+                "attribute_line_ids|1|attribute_id|name": "Test Size",
+                "attribute_line_ids|1|value_ids|1|name": "M",
+                "attribute_line_ids|1|value_ids|2|name": "L",
+            },
+        ]
+        pto = self.pto.with_context(
+            pattern_config={},
+            pattern_import_attribute_create_variant="no_variant",
+        )
+        res = pto._pattern_import_prepare_attribute_values(rows)
+        self.assertEqual(res, {"attribute": 1, "value": 4})
+        size = self.env["product.attribute"].search([("name", "=", "Test Size")])
+        self.assertEqual(size.create_variant, "no_variant")
+        self.assertEqual(size.value_ids.sorted("sequence").mapped("name"), ["S", "M", "L"])
+        self.assertIn("Green", self.color.value_ids.mapped("name"))
+        # nothing is created twice
+        res = pto._pattern_import_prepare_attribute_values(rows)
+        self.assertEqual(res, {"attribute": 0, "value": 0})
+
+    def test_create_variant_wrong_value(self):
+        pto = self.pto.with_context(
+            pattern_config={}, pattern_import_attribute_create_variant="never"
+        )
+        with self.assertRaises(UserError):
+            pto._pattern_import_create_missing_attribute_values({"Test Size": {"S": None}})
+        self.assertFalse(
+            self.env["product.attribute"].search([("name", "=", "Test Size")])
+        )
+
+    def test_resolve_attribute_values(self):
+        attribute_lines = [
+            {
+                "attribute_id": {"name": "Test Color"},
+                "value_ids": [{"name": "Red"}, {"name": "Blue"}],
+            }
+        ]
+        self.pto.with_context(pattern_config={})._process_pattern_import_attribute_line(
+            attribute_lines
+        )
+        self.assertEqual(
+            attribute_lines,
+            [
+                {
+                    "attribute_id": {".id": self.color.id},
+                    "value_ids": [{".id": self.red.id}, {".id": self.blue.id}],
+                }
+            ],
+        )
+
+    def test_resolve_by_fullname(self):
+        # in en_US, the values are looked up on demand by their fullname
+        pto = self.pto.with_context(pattern_config={}, lang="en_US")
+        index = pto._get_pattern_import_attribute_index()
+        self.assertTrue(index["fullname_lookup"])
+        self.assertFalse(index["value_key2ids"])
+        attribute_lines = [
+            {"attribute_id": {"name": "Test Color"}, "value_ids": [{"name": "Red"}]}
+        ]
+        pto._process_pattern_import_attribute_line(attribute_lines)
+        self.assertEqual(attribute_lines[0]["value_ids"], [{".id": self.red.id}])
+        self.assertEqual(
+            dict(index["value_key2ids"]), {(self.color.id, "Red"): [self.red.id]}
+        )
+        # in another language, the values are preloaded
+        self.env["res.lang"]._activate_lang("fr_FR")
+        index = self.pto.with_context(
+            pattern_config={}, lang="fr_FR"
+        )._get_pattern_import_attribute_index()
+        self.assertFalse(index["fullname_lookup"])
+        self.assertEqual(index["value_key2ids"][(self.color.id, "Blue")], [self.blue.id])
+
+    def test_resolve_errors_aggregated(self):
+        attribute_lines = [
+            {"attribute_id": {"name": "Test Unknown"}, "value_ids": [{"name": "X"}]},
+            {
+                "attribute_id": {"name": "Test Color"},
+                "value_ids": [{"name": "Green"}, {"name": "Yellow"}],
+            },
+        ]
+        with self.assertRaises(UserError) as error:
+            self.pto.with_context(
+                pattern_config={}
+            )._process_pattern_import_attribute_line(attribute_lines)
+        msg = str(error.exception)
+        self.assertIn("Test Unknown", msg)
+        self.assertIn("Green", msg)
+        self.assertIn("Yellow", msg)
+
+    def test_index_invalidated_on_unlink(self):
+        pto = self.pto.with_context(pattern_config={})
+        index = pto._get_pattern_import_attribute_index()
+        self.assertIn((self.color.id, "Blue"), index["value_key2ids"])
+        self.blue.with_context(pattern_config=pto.env.context["pattern_config"]).unlink()
+        index = pto._get_pattern_import_attribute_index()
+        self.assertNotIn((self.color.id, "Blue"), index["value_key2ids"])
+
+    def _create_template_with_lines(self):
+        size = self.env["product.attribute"].create(
+            {"name": "Test Size", "value_ids": [(0, 0, {"name": "S"})]}
+        )
+        template = self.pto.create(
+            {
+                "name": "Test Shirt",
+                "attribute_line_ids": [
+                    (0, 0, {"attribute_id": self.color.id, "value_ids": [(6, 0, self.red.ids)]}),
+                    (0, 0, {"attribute_id": size.id, "value_ids": [(6, 0, size.value_ids.ids)]}),
+                ],
+            }
+        )
+        return template, size
+
+    def test_reuse_attribute_lines(self):
+        template, size = self._create_template_with_lines()
+        color_line = template.attribute_line_ids.filtered(
+            lambda line: line.attribute_id == self.color
+        )
+        size_line = template.attribute_line_ids - color_line
+        res = template._pattern_import_reuse_attribute_lines(
+            [
+                {
+                    "attribute_id": {".id": self.color.id},
+                    "value_ids": [{".id": self.red.id}, {".id": self.blue.id}],
+                },
+                # unchanged
+                {
+                    "attribute_id": {".id": size.id},
+                    "value_ids": [{".id": size.value_ids.id}],
+                },
+            ]
+        )
+        self.assertEqual(
+            res,
+            [
+                {
+                    ".id": color_line.id,
+                    "value_ids": [{".id": self.red.id}, {".id": self.blue.id}],
+                },
+                {".id": size_line.id},
+            ],
+        )
+        # an attribute without values is kept as is
+        res = template._pattern_import_reuse_attribute_lines(
+            [{"attribute_id": {".id": self.color.id}, "value_ids": []}]
+        )
+        self.assertEqual(res, [{".id": color_line.id}])
+        # and it is skipped on a new template
+        res = self.pto._pattern_import_reuse_attribute_lines(
+            [{"attribute_id": {".id": self.color.id}, "value_ids": []}]
+        )
+        self.assertEqual(res, [])
+
+    def test_remove_attribute_lines_not_imported(self):
+        template, size = self._create_template_with_lines()
+        color_line = template.attribute_line_ids.filtered(
+            lambda line: line.attribute_id == self.color
+        )
+        template.with_context(pattern_config={})._load_records_write(
+            {"attribute_line_ids": [(4, color_line.id), (1, color_line.id, {})]}
+        )
+        self.assertEqual(template.attribute_line_ids, color_line)